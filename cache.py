@@ -0,0 +1,4 @@
+from krunning import cache_main
+
+if __name__ == "__main__":
+    cache_main()
@@ -1,22 +1,63 @@
-from .fitfile import FitFile, load_pandas_from_fitfile
+from .fitfile import FitFile, FitColumns, load_pandas_from_fitfile, load_many
+from .fitdecode import (
+    ActivitySummary,
+    UnsupportedFitFileError,
+    decode_records,
+    read_activity_summary,
+)
+from .activity_index import ActivityIndex
+from .fitcache import FitCache
+from .manifest import FileManifest
+from .curvecache import PowerCurveCache
 from .math import (
     smooth_sliding_time_window,
+    rolling_statistic,
+    mean_maximal_power,
+    log_spaced_durations,
+    MeanMaximalPower,
+    best_of_power_curves,
+    timer_spans,
+    resample_spans,
+    ResampledSpan,
+    distance_grade,
+    QuantileSketch,
     percentile,
     relative_seconds_from_timestamps,
 )
 from .plot import PlotBuilder, MatplotlibPlotBuilder
 from . import reports
-from .entrypoint import report_main
+from .entrypoint import report_main, cache_main
 
 
 __all__ = [
     FitFile,
+    FitColumns,
+    UnsupportedFitFileError,
+    decode_records,
+    ActivitySummary,
+    read_activity_summary,
+    ActivityIndex,
+    FitCache,
+    FileManifest,
+    PowerCurveCache,
     load_pandas_from_fitfile,
+    load_many,
     smooth_sliding_time_window,
+    rolling_statistic,
+    mean_maximal_power,
+    log_spaced_durations,
+    MeanMaximalPower,
+    best_of_power_curves,
+    timer_spans,
+    resample_spans,
+    ResampledSpan,
+    distance_grade,
+    QuantileSketch,
     percentile,
     relative_seconds_from_timestamps,
     PlotBuilder,
     MatplotlibPlotBuilder,
     reports,
     report_main,
+    cache_main,
 ]
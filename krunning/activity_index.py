@@ -0,0 +1,162 @@
+import datetime
+import json
+import os
+import tempfile
+from typing import Dict, List, Optional
+
+import fitparse
+
+from .fitdecode import ActivitySummary, UnsupportedFitFileError, read_activity_summary
+from .manifest import FileManifest
+
+
+class ActivityIndex:
+    """Index of the activities of .fit files, so date-windowed reports only open relevant files.
+
+    Stores the ActivitySummary (start time, sport, duration, distance and record fields) of
+    each file in a JSON file, along with the content hash of the file it was read from.
+    Summaries are only read again for new or changed files, and only from the file_id and
+    session messages.
+    """
+
+    def __init__(self, path: str, manifest: Optional[FileManifest] = None):
+        """
+        Args:
+            path: path to the JSON index
+            manifest: manifest of the files' content hashes. Defaults to a manifest.json
+                next to the index
+        """
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.__directory = directory
+        if manifest is None:
+            manifest = FileManifest(os.path.join(directory, "manifest.json"))
+        self.manifest = manifest
+        self.__entries: Optional[Dict[str, Dict[str, object]]] = None
+
+    def __load(self) -> Dict[str, Dict[str, object]]:
+        if self.__entries is None:
+            self.__entries = {}
+            if os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    self.__entries = json.load(f)
+        return self.__entries
+
+    def __save(self):
+        fd, temp_path = tempfile.mkstemp(dir=self.__directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.__entries, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def summaries(self, paths: List[str]) -> List[ActivitySummary]:
+        """Get the summaries of fit files, reading only new or changed files.
+
+        Args:
+            paths: paths to the .fit files
+
+        Returns:
+            ActivitySummary of each file
+        """
+        entries = self.__load()
+        out = []
+        changed = False
+        with self.manifest.batch():
+            fingerprints = [self.manifest.fingerprint(path) for path in paths]
+        for path, sha1 in zip(paths, fingerprints):
+            key = os.path.abspath(path)
+            entry = entries.get(key)
+            if entry is None or entry["sha1"] != sha1:
+                summary = _read_summary(path)
+                entry = dict(sha1=sha1, summary=summary._asdict())
+                if summary.start_time is not None:
+                    entry["summary"]["start_time"] = summary.start_time.isoformat()
+                entries[key] = entry
+                changed = True
+            summary = dict(entry["summary"])
+            if summary["start_time"] is not None:
+                summary["start_time"] = datetime.datetime.fromisoformat(
+                    summary["start_time"]
+                )
+            out.append(ActivitySummary(**summary))
+        # Forget files which aren't indexed anymore
+        removed = set(entries) - {os.path.abspath(path) for path in paths}
+        for key in removed:
+            if not os.path.exists(key):
+                del entries[key]
+                changed = True
+        if changed:
+            self.__save()
+        return out
+
+    def select(
+        self,
+        paths: List[str],
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        sport: Optional[str] = None,
+    ) -> List[str]:
+        """Keep the fit files of activities in a time window and of a sport.
+
+        Args:
+            paths: paths to the .fit files
+            since: only keep activities starting at or after this time (naive UTC)
+            until: only keep activities starting before this time (naive UTC)
+            sport: only keep activities of this sport (e.g. "running")
+
+        Returns:
+            the selected paths, in order. Files without a start time are only kept when
+            there is no time window
+        """
+        if since is None and until is None and sport is None:
+            return list(paths)
+        selected = []
+        for path, summary in zip(paths, self.summaries(paths)):
+            if sport is not None and summary.sport != sport:
+                continue
+            if since is not None or until is not None:
+                if summary.start_time is None:
+                    continue
+                if since is not None and summary.start_time < since:
+                    continue
+                if until is not None and summary.start_time >= until:
+                    continue
+            selected.append(path)
+        return selected
+
+
+def _read_summary(path: str) -> ActivitySummary:
+    """Read the summary of a fit file, natively if possible, else with fitparse."""
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        return read_activity_summary(data)
+    except UnsupportedFitFileError:
+        pass
+    time_created = None
+    sessions = []
+    fields: Dict[str, None] = {}
+    with fitparse.FitFile(data) as fitfile:
+        for message in fitfile.get_messages(["file_id", "session", "record"]):
+            values = message.get_values()
+            if message.name == "file_id":
+                time_created = values.get("time_created")
+            elif message.name == "session":
+                sessions.append(values)
+            else:
+                fields.update((name, None) for name in values)
+
+    def total(name: str) -> Optional[float]:
+        totals = [
+            session[name] for session in sessions if session.get(name) is not None
+        ]
+        return sum(totals) if totals else None
+
+    first = sessions[0] if sessions else {}
+    return ActivitySummary(
+        start_time=first.get("start_time") or time_created,
+        sport=first.get("sport"),
+        duration=total("total_timer_time"),
+        distance=total("total_distance"),
+        fields=list(fields),
+    )
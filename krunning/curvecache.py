@@ -0,0 +1,59 @@
+import os
+import tempfile
+import numpy as np
+from typing import Optional
+
+
+class PowerCurveCache:
+    """Store of the mean-maximal power curve of each activity.
+
+    Past activities never change, so their curves are computed once and reused by every
+    report. Each curve is a .npz file named after the activity id, holding the best average
+    power for every duration from 1 second to the length of the activity, and a signature of
+    the samples and timer events it was computed from, so a re-uploaded or corrected
+    activity gets recomputed.
+    """
+
+    def __init__(self, directory: str = "cache/power_curves"):
+        """
+        Args:
+            directory: where the curves are stored
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def __path(self, activity_id: int) -> str:
+        return os.path.join(self.directory, "%d.npz" % activity_id)
+
+    def load(self, activity_id: int, signature: str) -> Optional[np.ndarray]:
+        """Load the power curve of an activity.
+
+        Args:
+            activity_id: id of the activity
+            signature: signature of the activity's samples and timer events
+
+        Returns:
+            float ndarray of the best average power for durations 1, 2, ... seconds,
+            or None if not cached for this signature
+        """
+        path = self.__path(activity_id)
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as cached:
+            if str(cached["signature"]) != signature:
+                return None
+            return cached["power"]
+
+    def store(self, activity_id: int, signature: str, power: np.ndarray):
+        """Store the power curve of an activity.
+
+        Args:
+            activity_id: id of the activity
+            signature: signature of the activity's samples and timer events
+            power: float ndarray of the best average power for durations 1, 2, ... seconds
+        """
+        # Write to a temporary file first, so readers never see a partial curve
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".npz")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, signature=np.array(signature), power=power)
+        os.replace(temp_path, self.__path(activity_id))
@@ -1,9 +1,28 @@
+from .cache_manager import CacheManager, CacheStats
+from .memo import ProviderData, ProviderMemo, default_memo
 from .template import DataProviderTemplate
+from .derived_template import DerivedDataProviderTemplate, resolve
 from .fit_files_template import FitFilesDataProviderTemplate
 from .speed_power_grade import SpeedPowerFitFilesDataProvider
+from .efficiency import EfficiencyDataProvider
+from .database_template import (
+    DatabaseDataProviderTemplate,
+    SamplesDatabaseDataProvider,
+    decode_samples_csv,
+)
 
 __all__ = [
     SpeedPowerFitFilesDataProvider,
     FitFilesDataProviderTemplate,
     DataProviderTemplate,
+    DerivedDataProviderTemplate,
+    EfficiencyDataProvider,
+    resolve,
+    DatabaseDataProviderTemplate,
+    SamplesDatabaseDataProvider,
+    decode_samples_csv,
+    CacheManager,
+    CacheStats,
+    ProviderData,
+    ProviderMemo,
 ]
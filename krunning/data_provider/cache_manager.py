@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+from .storage import load_arrays, store_arrays
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where only threads of this process are serialized
+    fcntl = None
+
+# Default size budget of the provider cache, in bytes
+DEFAULT_MAX_BYTES = 2 << 30
+
+
+class CacheStats(NamedTuple):
+    """Usage of a CacheManager."""
+
+    entries: int
+    bytes: int
+    max_bytes: int
+    hits: int
+    misses: int
+    # Number of entries and bytes used by each provider uuid
+    providers: Dict[str, Dict[str, int]]
+    # Number of entries and bytes used by each shared store, by directory name
+    stores: Dict[str, Dict[str, int]]
+
+
+class CacheManager:
+    """Bounded store of data provider results.
+
+    Every (provider uuid, cache key) pair gets its own entry, so switching between the
+    parameters of a provider doesn't recompute what was computed before. Entries are stored
+    with store_arrays, and the least recently used ones are evicted once the total size goes
+    over the budget.
+
+    An index.json records the provider, size and last use of every entry, along with the
+    number of cache hits and misses. It is only updated under a lock, so threads and
+    processes sharing the cache don't lose each other's entries.
+
+    Other caches stored next to it (decoded fit files, per-file partials, power curves...)
+    can share the budget: every subdirectory of the shared directory is then a store, whose
+    files and subdirectories are entries last used when they were last accessed or modified.
+    """
+
+    def __init__(
+        self,
+        directory: str = "cache/providers",
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        shared_directory: Optional[str] = None,
+    ):
+        """
+        Args:
+            directory: where the entries and the index are stored
+            max_bytes: size budget of the entries, in bytes
+            shared_directory: directory whose other subdirectories are stores sharing the
+                budget, e.g. the parent of directory. None to only bound the entries
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.shared_directory = shared_directory
+        self.__index_path = os.path.join(directory, "index.json")
+
+    @contextmanager
+    def __locked(self) -> Iterator[None]:
+        """Hold the cache's lock, across threads and processes."""
+        with _thread_lock(self.directory):
+            if fcntl is None:
+                yield
+                return
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+    def __load_index(self) -> Dict[str, Any]:
+        if not os.path.exists(self.__index_path):
+            return {"entries": {}, "hits": 0, "misses": 0}
+        with open(self.__index_path, "r") as f:
+            return json.load(f)
+
+    def __save_index(self, index: Dict[str, Any]):
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.__index_path)
+
+    @staticmethod
+    def entry_name(uuid: str, cache_key: Any) -> str:
+        """Get the name of the entry of a provider's result for a cache key."""
+        digest = hashlib.sha1(repr(cache_key).encode("utf-8")).hexdigest()
+        return "%s-%s" % (uuid, digest)
+
+    def load(self, uuid: str, cache_key: Any) -> Optional[Dict[str, Any]]:
+        """Load the cached result of a provider, and mark it as recently used.
+
+        Args:
+            uuid: uuid of the provider
+            cache_key: cache key of the provider
+
+        Returns:
+            the cached data, with arrays memory-mapped, or None if not cached
+        """
+        name = self.entry_name(uuid, cache_key)
+        with self.__locked():
+            index = self.__load_index()
+            data = None
+            if name in index["entries"]:
+                data = load_arrays(os.path.join(self.directory, name), cache_key)
+            if data is None:
+                index["misses"] += 1
+            else:
+                index["hits"] += 1
+                index["entries"][name]["last_used"] = time.time()
+            self.__save_index(index)
+        return data
+
+    def store(self, uuid: str, cache_key: Any, data: Dict[str, Any]):
+        """Store the result of a provider, evicting least recently used entries if needed.
+
+        Args:
+            uuid: uuid of the provider
+            cache_key: cache key of the provider
+            data: data to store
+        """
+        name = self.entry_name(uuid, cache_key)
+        entry_directory = os.path.join(self.directory, name)
+        with self.__locked():
+            store_arrays(entry_directory, cache_key, data)
+            index = self.__load_index()
+            index["entries"][name] = dict(
+                uuid=uuid,
+                bytes=_directory_size(entry_directory),
+                last_used=time.time(),
+            )
+            self.__evict(index, self.max_bytes, keep=name)
+            self.__save_index(index)
+
+    def prune(self, max_bytes: Optional[int] = None) -> int:
+        """Evict least recently used entries until the cache fits in a size budget.
+
+        Args:
+            max_bytes: size budget, in bytes. Defaults to the cache's budget
+
+        Returns:
+            number of evicted entries
+        """
+        with self.__locked():
+            index = self.__load_index()
+            evicted = self.__evict(
+                index, self.max_bytes if max_bytes is None else max_bytes
+            )
+            self.__save_index(index)
+        return evicted
+
+    def stats(self) -> CacheStats:
+        """Get the usage of the cache, including the shared stores."""
+        with self.__locked():
+            index = self.__load_index()
+        providers = {}
+        for entry in index["entries"].values():
+            usage = providers.setdefault(entry["uuid"], dict(entries=0, bytes=0))
+            usage["entries"] += 1
+            usage["bytes"] += entry["bytes"]
+        stores = {}
+        for path, size, _ in self.__store_entries():
+            store = os.path.basename(os.path.dirname(path))
+            usage = stores.setdefault(store, dict(entries=0, bytes=0))
+            usage["entries"] += 1
+            usage["bytes"] += size
+        return CacheStats(
+            entries=len(index["entries"]),
+            bytes=sum(entry["bytes"] for entry in index["entries"].values())
+            + sum(usage["bytes"] for usage in stores.values()),
+            max_bytes=self.max_bytes,
+            hits=index["hits"],
+            misses=index["misses"],
+            providers=providers,
+            stores=stores,
+        )
+
+    def __store_entries(self) -> List[Tuple[str, int, float]]:
+        """Get the path, size and last use of every entry of the shared stores."""
+        if self.shared_directory is None or not os.path.isdir(self.shared_directory):
+            return []
+        own_directory = os.path.abspath(self.directory)
+        entries = []
+        for store in sorted(os.listdir(self.shared_directory)):
+            store_directory = os.path.join(self.shared_directory, store)
+            if (
+                not os.path.isdir(store_directory)
+                or os.path.abspath(store_directory) == own_directory
+            ):
+                continue
+            for name in os.listdir(store_directory):
+                # Manifests and indices describe the store rather than being entries
+                if name.endswith(".json"):
+                    continue
+                path = os.path.join(store_directory, name)
+                try:
+                    size, last_used = _usage(path)
+                except FileNotFoundError:
+                    # Removed while listing
+                    continue
+                entries.append((path, size, last_used))
+        return entries
+
+    def __evict(
+        self, index: Dict[str, Any], max_bytes: int, keep: Optional[str] = None
+    ) -> int:
+        entries = index["entries"]
+        # (last used, size, entry name or None, path) of every entry
+        candidates = [
+            (
+                entry["last_used"],
+                entry["bytes"],
+                name,
+                os.path.join(self.directory, name),
+            )
+            for name, entry in entries.items()
+        ]
+        candidates.extend(
+            (last_used, size, None, path)
+            for path, size, last_used in self.__store_entries()
+        )
+        total = sum(size for _, size, _, _ in candidates)
+        evicted = 0
+        for _, size, name, path in sorted(candidates, key=lambda c: c[0]):
+            if total <= max_bytes:
+                break
+            if name is not None and name == keep:
+                continue
+            if name is not None:
+                del entries[name]
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif os.path.exists(path):
+                os.remove(path)
+            total -= size
+            evicted += 1
+        return evicted
+
+
+def _directory_size(directory: str) -> int:
+    """Get the total size of the files in a directory, in bytes."""
+    return sum(
+        os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+    )
+
+
+def _usage(path: str) -> Tuple[int, float]:
+    """Get the total size of a file or directory tree, and when it was last used."""
+    stat = os.stat(path)
+    size = 0 if os.path.isdir(path) else stat.st_size
+    last_used = max(stat.st_atime, stat.st_mtime)
+    for parent, _, names in os.walk(path):
+        for name in names:
+            stat = os.stat(os.path.join(parent, name))
+            size += stat.st_size
+            last_used = max(last_used, stat.st_atime, stat.st_mtime)
+    return size, last_used
+
+
+# Lock of each cache directory, serializing the threads of this process
+_thread_locks: Dict[str, threading.Lock] = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(directory: str) -> threading.Lock:
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(os.path.abspath(directory), threading.Lock())
@@ -0,0 +1,261 @@
+import datetime
+import io
+import numpy as np
+import pandas as pd
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+from .memo import ProviderData
+from .template import DataProviderTemplate
+from ..db.utils import get_conn
+
+# Schema migration the queries of DatabaseDataProviderTemplate are written for
+EXPECTED_MIGRATION = "0001"
+
+# Size of the CSV text decoded at once while exporting samples, in characters
+DECODE_CHUNK_SIZE = 16 << 20
+
+
+class DatabaseDataProviderTemplate(DataProviderTemplate):
+    """Provider of data computed from the samples uploaded to the database.
+
+    Requested fields of every sample of the selected activities are exported in a single
+    COPY ... TO STDOUT, pivoted to one column per field in SQL, and decoded into NumPy
+    arrays by the pandas CSV parser chunk by chunk as it arrives, so no .fit file gets
+    parsed and the export is never held as text. The cache key and the export share one
+    connection.
+
+    Subclasses set the fields they need and override compute_samples.
+    """
+
+    fields: List[str] = []
+
+    def __init__(
+        self,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        sport: Optional[str] = None,
+        connection_dict: Optional[Dict[str, Any]] = None,
+        **kwargs
+    ):
+        """
+        Args:
+            since: only use activities created at or after this time
+            until: only use activities created before this time
+            sport: only use activities of this sport (e.g. "running")
+            connection_dict: psycopg2 connection arguments. Defaults to conn_dict_from_env
+        """
+        super().__init__(**kwargs)
+        self.since = since
+        self.until = until
+        self.sport = sport
+        self.connection_dict = connection_dict
+        self.__cursor = None
+
+    @contextmanager
+    def connect(self):
+        """Get a cursor on the database, checking its schema.
+
+        Within get, the connection opened for the cache key is reused to export the samples.
+        """
+        if self.__cursor is not None:
+            yield self.__cursor
+            return
+        with get_conn(EXPECTED_MIGRATION, self.connection_dict) as cur:
+            self.__cursor = cur
+            try:
+                yield cur
+            finally:
+                self.__cursor = None
+
+    def get(self) -> ProviderData:
+        with self.connect():
+            return super().get()
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["_DatabaseDataProviderTemplate__cursor"] = None
+        return state
+
+    def __activities_filter(self) -> Tuple[str, List[Any]]:
+        """Get the SQL condition on activities `a` selected by the provider."""
+        conditions = ["TRUE"]
+        params = []
+        if self.since is not None:
+            conditions.append("a.created >= %s")
+            params.append(self.since)
+        if self.until is not None:
+            conditions.append("a.created < %s")
+            params.append(self.until)
+        if self.sport is not None:
+            conditions.append("a.sport = %s")
+            params.append(self.sport)
+        return " AND ".join(conditions), params
+
+    @property
+    def cache_key(self):
+        # Uploads and re-uploads change the ids and number of samples
+        condition, params = self.__activities_filter()
+        with self.connect() as cur:
+            cur.execute(
+                """
+                SELECT COUNT(*), MAX(s.id) FROM samples s
+                INNER JOIN activities a ON a.id = s.activity_id
+                WHERE %s;
+                """ % condition,
+                params,
+            )
+            signature = cur.fetchone()
+        return (
+            list(self.fields),
+            self.since,
+            self.until,
+            self.sport,
+            signature,
+            self.parameters,
+        )
+
+    @property
+    def parameters(self):
+        """Parameters of the provider, other than which samples it reads."""
+        return ()
+
+    def read_samples(self) -> Dict[str, np.ndarray]:
+        """Export the requested fields of every selected sample from the database.
+
+        Returns:
+            dict of N ndarrays, ordered by activity and time: "activity_id" (int64),
+            "timestamp" (float64 seconds since the Unix epoch), and one float64 array per
+            field, NaN where a sample has no value for the field
+        """
+        condition, params = self.__activities_filter()
+        # COALESCE of REAL and BIGINT is REAL, which would round large integers such as
+        # positions, so both are cast to double precision
+        columns = "".join(
+            ",\n MAX(CASE WHEN f.field_name = %s "
+            "THEN COALESCE(sv.float_value::float8, sv.int_value::float8) END)"
+            for _ in self.fields
+        )
+        decoder = _SamplesCsvDecoder(self.fields)
+        with self.connect() as cur:
+            query = cur.mogrify(
+                """
+                SELECT s.activity_id, EXTRACT(EPOCH FROM s.sampled_at)%s
+                FROM samples s
+                INNER JOIN activities a ON a.id = s.activity_id
+                LEFT JOIN sample_values sv ON sv.sample_id = s.id AND sv.field_id IN (
+                    SELECT id FROM fields WHERE field_name = ANY(%%s)
+                )
+                LEFT JOIN fields f ON f.id = sv.field_id
+                WHERE %s
+                GROUP BY s.id
+                ORDER BY s.activity_id, s.sampled_at, s.message_id
+                """ % (columns, condition),
+                list(self.fields) + [list(self.fields)] + params,
+            ).decode("utf-8")
+            cur.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT csv)" % query, decoder)
+        return decoder.samples()
+
+    def compute_samples(self, samples: Dict[str, np.ndarray]) -> Dict[str, Any]:
+        """Compute the provider's data from the exported samples.
+
+        Args:
+            samples: samples, as returned by read_samples
+
+        Returns:
+            the provider's data. Defaults to the samples themselves
+        """
+        return samples
+
+    def compute(self) -> Dict[str, Any]:
+        return self.compute_samples(self.read_samples())
+
+
+class SamplesDatabaseDataProvider(DatabaseDataProviderTemplate):
+    """Provider of the raw samples of some fields, from the database."""
+
+    uuid = "4a0b3c1e-5d47-4f0e-9a53-0f6a2b8c7d91"
+
+    def __init__(self, fields: List[str], **kwargs):
+        """
+        Args:
+            fields: names of the fields to read (e.g. "Power", "heart_rate")
+        """
+        self.fields = list(fields)
+        super().__init__(**kwargs)
+
+
+def decode_samples_csv(
+    buffer: io.TextIOBase, fields: List[str]
+) -> Dict[str, np.ndarray]:
+    """Decode the CSV export of read_samples into NumPy arrays.
+
+    Args:
+        buffer: CSV with activity id, epoch seconds and one column per field, without header
+        fields: names of the fields
+
+    Returns:
+        dict of ndarrays, see read_samples
+    """
+    names = ["activity_id", "timestamp"] + list(fields)
+    dtypes = {name: np.float64 for name in names}
+    dtypes["activity_id"] = np.int64
+    df = pd.read_csv(buffer, header=None, names=names, dtype=dtypes, engine="c")
+    return {name: df[name].to_numpy() for name in names}
+
+
+class _SamplesCsvDecoder(io.TextIOBase):
+    """Text file decoding the CSV export of read_samples as it gets written.
+
+    COPY writes the export row by row. Complete lines are decoded with decode_samples_csv
+    once DECODE_CHUNK_SIZE characters are pending, so only one chunk of text is held at once.
+    """
+
+    def __init__(self, fields: List[str], chunk_size: int = DECODE_CHUNK_SIZE):
+        """
+        Args:
+            fields: names of the fields
+            chunk_size: number of characters decoded at once
+        """
+        super().__init__()
+        self.fields = list(fields)
+        self.chunk_size = chunk_size
+        self.__pending = []
+        self.__pending_size = 0
+        self.__chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        self.__pending.append(text)
+        self.__pending_size += len(text)
+        if self.__pending_size >= self.chunk_size:
+            pending = "".join(self.__pending)
+            end = pending.rfind("\n") + 1
+            self.__decode(pending[:end])
+            self.__pending = [pending[end:]]
+            self.__pending_size = len(pending) - end
+        return len(text)
+
+    def samples(self) -> Dict[str, np.ndarray]:
+        """Decode the rest of the export, and get every sample.
+
+        Returns:
+            dict of ndarrays, see read_samples
+        """
+        self.__decode("".join(self.__pending))
+        self.__pending = []
+        self.__pending_size = 0
+        if len(self.__chunks) == 1:
+            return self.__chunks[0]
+        if not self.__chunks:
+            return decode_samples_csv(io.StringIO(""), self.fields)
+        return {
+            name: np.concatenate([chunk[name] for chunk in self.__chunks])
+            for name in self.__chunks[0]
+        }
+
+    def __decode(self, text: str):
+        if text:
+            self.__chunks.append(decode_samples_csv(io.StringIO(text), self.fields))
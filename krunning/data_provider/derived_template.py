@@ -0,0 +1,100 @@
+from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from .memo import ProviderData, ProviderMemo
+from .template import DataProviderTemplate
+
+
+class DerivedDataProviderTemplate(DataProviderTemplate):
+    """Provider of data computed from the data of other providers.
+
+    A derived provider declares the providers it depends on, which may be derived providers
+    themselves. Its cache key is made of theirs, so it only gets recomputed when the data of
+    one of its dependencies changes, and their cached data is reused rather than recomputed.
+
+    Subclasses override compute_derived.
+    """
+
+    def __init__(self, dependencies: Dict[str, DataProviderTemplate], **kwargs):
+        """
+        Args:
+            dependencies: providers the data is computed from, by name
+        """
+        super().__init__(**kwargs)
+        self.dependencies = dict(dependencies)
+
+    @property
+    def cache_key(self):
+        return (
+            [
+                (name, dependency.uuid, dependency.cache_key)
+                for name, dependency in sorted(self.dependencies.items())
+            ],
+            self.parameters,
+        )
+
+    @property
+    def parameters(self):
+        """Parameters of the provider, other than its dependencies."""
+        return ()
+
+    @abstractmethod
+    def compute_derived(self, inputs: Dict[str, ProviderData]) -> Dict[str, Any]:
+        """Compute the provider's data from the data of its dependencies.
+
+        Args:
+            inputs: data of each dependency, by name
+
+        Returns:
+            the provider's data
+        """
+        pass
+
+    def compute(self) -> Dict[str, Any]:
+        names = list(self.dependencies)
+        data = resolve([self.dependencies[name] for name in names])
+        return self.compute_derived(dict(zip(names, data)))
+
+
+def resolve(
+    providers: List[DataProviderTemplate], workers: Optional[int] = None
+) -> List[ProviderData]:
+    """Get the data of providers, along with every provider they depend on.
+
+    Providers are grouped by depth in the dependency graph, leaves first. The providers of a
+    group don't depend on each other, so they are got in parallel threads, and each provider
+    shared by several others is only got once.
+
+    Args:
+        providers: providers to get
+        workers: number of threads. Defaults to the number of providers in the largest group
+
+    Returns:
+        the data of each provider
+    """
+    keys = {}
+    depths = {}
+    nodes = {}
+
+    def visit(provider: DataProviderTemplate) -> int:
+        key = ProviderMemo.key(provider.uuid, provider.cache_key)
+        keys[id(provider)] = key
+        if key not in depths:
+            dependencies = getattr(provider, "dependencies", {}).values()
+            depths[key] = 1 + max(map(visit, dependencies), default=-1)
+            nodes[key] = provider
+        return depths[key]
+
+    for provider in providers:
+        visit(provider)
+    levels = [[] for _ in range(1 + max(depths.values(), default=-1))]
+    for key, depth in depths.items():
+        levels[depth].append(key)
+
+    data = {}
+    for level in levels:
+        with ThreadPoolExecutor(workers or len(level)) as executor:
+            results = executor.map(lambda key: nodes[key].get(), level)
+            data.update(zip(level, results))
+    return [data[keys[id(provider)]] for provider in providers]
@@ -0,0 +1,30 @@
+from typing import Any, Dict
+import numpy as np
+
+from .derived_template import DerivedDataProviderTemplate
+from .memo import ProviderData
+from .speed_power_grade import SpeedPowerFitFilesDataProvider
+
+
+class EfficiencyDataProvider(DerivedDataProviderTemplate):
+    """Provider of the running efficiency of the samples of a SpeedPowerFitFilesDataProvider.
+
+    Efficiency is the distance covered per unit of work, in meters per kilojoule.
+    """
+
+    uuid = "b7d5e2a4-1c3f-4e8a-9f06-3d2b7c5a8e41"
+
+    def __init__(self, speed_power: SpeedPowerFitFilesDataProvider, **kwargs):
+        """
+        Args:
+            speed_power: provider of the samples' speeds and powers
+        """
+        super().__init__(dependencies=dict(speed_power=speed_power), **kwargs)
+
+    def compute_derived(self, inputs: Dict[str, ProviderData]) -> Dict[str, Any]:
+        speed_power = inputs["speed_power"]
+        return {
+            "efficiencies": 1000 * speed_power["speeds"] / speed_power["powers"],
+            "grades": np.asarray(speed_power["grades"]),
+            "hrs": np.asarray(speed_power["hrs"]),
+        }
@@ -1,18 +1,231 @@
+import datetime
+import hashlib
+import logging
+import multiprocessing
 import os
+import shutil
+from abc import abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
 
+from .storage import load_arrays, store_arrays
 from .template import DataProviderTemplate
+from ..activity_index import ActivityIndex
+from ..fitcache import FitCache
+from ..manifest import FileManifest
 
 
 class FitFilesDataProviderTemplate(DataProviderTemplate):
-    def __init__(self, directory: str = "data", **kwargs):
+    """Provider of data computed from every .fit file of a directory.
+
+    Each file's partial result is cached on its own with store_arrays, under
+    <cache_directory>/<uuid>/<file>/<parameters>/, and the partials are memory-mapped and
+    merged into the provider's data. Adding a file only computes the new file's partial, and
+    the partials of files removed from the directory get dropped. Worker processes store the
+    partials they compute rather than sending them back.
+
+    Files are identified by their content hash, from a manifest in the cache directory, so
+    an edited or re-downloaded file gets computed again while unchanged files aren't re-read.
+
+    Activities can be restricted to a time window and a sport, from an ActivityIndex of the
+    files' summaries.
+    """
+
+    def __init__(
+        self,
+        directory: str = "data",
+        workers: Optional[int] = None,
+        since: Optional[datetime.datetime] = None,
+        until: Optional[datetime.datetime] = None,
+        sport: Optional[str] = None,
+        **kwargs
+    ):
+        """
+        Args:
+            directory: directory of the .fit files
+            workers: number of processes computing the partials of files which aren't
+                cached. Defaults to the number of CPUs. With 1, files are computed in this
+                process
+            since: only use activities starting at or after this time (naive UTC)
+            until: only use activities starting before this time (naive UTC)
+            sport: only use activities of this sport (e.g. "running")
+        """
         super().__init__(**kwargs)
         self.directory = directory
-        self.files = [
+        self.workers = workers
+        self.manifest = FileManifest(
+            os.path.join(self.cache_directory, "manifest.json")
+        )
+        self.fit_cache = FitCache(
+            os.path.join(self.cache_directory, "fit"), manifest=self.manifest
+        )
+        self.partials_directory = os.path.join(self.cache_directory, self.uuid)
+        self.activity_index = ActivityIndex(
+            os.path.join(self.cache_directory, "activities.json"), self.manifest
+        )
+        self.directory_files = [
             os.path.join(self.directory, name)
             for name in sorted(os.listdir(self.directory))
             if name.endswith(".fit")
         ]
+        # Files outside of the window are skipped from their summary, without decoding them
+        self.files = self.activity_index.select(
+            self.directory_files, since=since, until=until, sport=sport
+        )
+
+    @property
+    def parameters(self):
+        """Parameters of the provider, which the partial result of each file depends on."""
+        return ()
 
     @property
     def cache_key(self):
-        return self.files
+        with self.manifest.batch():
+            fingerprints = [
+                (filepath, self.manifest.fingerprint(filepath))
+                for filepath in self.files
+            ]
+        return fingerprints, self.parameters
+
+    @abstractmethod
+    def compute_file(self, filepath: str) -> Dict[str, Any]:
+        """Compute the partial result of a single .fit file.
+
+        Args:
+            filepath: path to the .fit file
+
+        Returns:
+            partial result, to be merged with the other files' by merge
+        """
+        pass
+
+    @abstractmethod
+    def merge(self, partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Merge the partial results of the files into the provider's data.
+
+        Args:
+            partials: partial result of each file, in the order of self.files
+
+        Returns:
+            the provider's data
+        """
+        pass
+
+    def get(self):
+        self.drop_removed_files()
+        return super().get()
+
+    def compute(self) -> Dict[str, Any]:
+        partials = [self.load_file(filepath) for filepath in self.files]
+        missing = [
+            filepath
+            for filepath, partial in zip(self.files, partials)
+            if partial is None
+        ]
+        if self.workers == 1 or len(missing) <= 1:
+            computed = map(self.get_file, missing)
+        else:
+            pool = multiprocessing.Pool(
+                min(self.workers or os.cpu_count(), len(missing)),
+                initializer=_set_worker_provider,
+                initargs=(self,),
+            )
+            with pool:
+                cached = pool.map(_cache_file, missing)
+            computed = map(self.get_file, cached)
+        computed = dict(zip(missing, computed))
+        partials = [
+            computed[filepath] if partial is None else partial
+            for filepath, partial in zip(self.files, partials)
+        ]
+        return self.merge(partials)
+
+    def load_file(self, filepath: str) -> Optional[Dict[str, Any]]:
+        """Load the cached partial result of a .fit file.
+
+        Args:
+            filepath: path to the .fit file
+
+        Returns:
+            partial result of the file, with arrays memory-mapped, or None if not cached
+        """
+        return load_arrays(*self.__file_cache(filepath))
+
+    def cache_file(self, filepath: str):
+        """Compute and cache the partial result of a .fit file, unless cached already.
+
+        Args:
+            filepath: path to the .fit file
+        """
+        entry_directory, cache_key = self.__file_cache(filepath)
+        if load_arrays(entry_directory, cache_key) is not None:
+            return
+        logging.info("Processing %s", filepath)
+        partial = self.compute_file(filepath)
+        os.makedirs(os.path.dirname(entry_directory), exist_ok=True)
+        store_arrays(entry_directory, cache_key, partial)
+        # Drop the gzipped pickle of older versions
+        legacy_file = entry_directory + ".pkl.gz"
+        if os.path.exists(legacy_file):
+            os.remove(legacy_file)
+
+    def get_file(self, filepath: str) -> Dict[str, Any]:
+        """Get the partial result of a .fit file, from the cache if possible.
+
+        Args:
+            filepath: path to the .fit file
+
+        Returns:
+            partial result of the file, with arrays memory-mapped
+        """
+        self.cache_file(filepath)
+        return self.load_file(filepath)
+
+    def __file_cache(self, filepath: str) -> Tuple[str, Any]:
+        """Get the cache directory and cache key of the partial result of a .fit file."""
+        cache_key = (
+            os.path.abspath(filepath),
+            self.manifest.fingerprint(filepath),
+            self.parameters,
+        )
+        entry_directory = os.path.join(
+            self.partials_directory,
+            _digest(os.path.abspath(filepath)),
+            _digest(repr(self.parameters)),
+        )
+        return entry_directory, cache_key
+
+    def drop_removed_files(self):
+        """Delete the cached partials of files which aren't in the directory anymore."""
+        if not os.path.isdir(self.partials_directory):
+            return
+        current = {
+            _digest(os.path.abspath(filepath)) for filepath in self.directory_files
+        }
+        for name in os.listdir(self.partials_directory):
+            if name not in current:
+                shutil.rmtree(
+                    os.path.join(self.partials_directory, name), ignore_errors=True
+                )
+
+
+# Provider computing partials in a worker process of FitFilesDataProviderTemplate.compute
+_worker_provider: Optional[FitFilesDataProviderTemplate] = None
+
+
+def _set_worker_provider(provider: FitFilesDataProviderTemplate):
+    global _worker_provider
+    _worker_provider = provider
+
+
+def _cache_file(filepath: str) -> str:
+    """Compute and cache the partial result of a file (runs in compute's workers).
+
+    Only the path goes back to the parent, which memory-maps the stored partial.
+    """
+    _worker_provider.cache_file(filepath)
+    return filepath
+
+
+def _digest(text: str) -> str:
+    """Get a file name safe digest of a string."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
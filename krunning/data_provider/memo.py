@@ -0,0 +1,112 @@
+import collections
+import threading
+import weakref
+import numpy as np
+from typing import Any, Dict, Hashable, Optional
+
+# Default memory budget of the memo, in bytes
+DEFAULT_MAX_BYTES = 512 << 20
+
+
+class ProviderData(dict):
+    """Result of a data provider.
+
+    A plain dict can't be weakly referenced, so the memo hands out this subclass instead.
+    """
+
+
+class ProviderMemo:
+    """In-process memo of data provider results.
+
+    Reports and sections asking for the same provider with the same cache key get the very
+    same data back, without loading it from the cache again. Arrays are made read-only, so
+    one caller can't change the data seen by another.
+
+    The most recently used results are kept alive up to a memory budget. Older ones are only
+    weakly referenced: they are reused as long as some caller still holds them, and freed
+    with the last reference.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Args:
+            max_bytes: memory budget of the results kept alive, in bytes
+        """
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__recent = collections.OrderedDict()
+        self.__alive = weakref.WeakValueDictionary()
+
+    @staticmethod
+    def key(uuid: str, cache_key: Any) -> Hashable:
+        """Get the memo key of a provider's result for a cache key."""
+        # Cache keys hold lists, which aren't hashable
+        return uuid, repr(cache_key)
+
+    def load(self, uuid: str, cache_key: Any) -> Optional[ProviderData]:
+        """Get the memoized result of a provider, and mark it as recently used.
+
+        Args:
+            uuid: uuid of the provider
+            cache_key: cache key of the provider
+
+        Returns:
+            the memoized data, or None if not in memory
+        """
+        key = self.key(uuid, cache_key)
+        with self.__lock:
+            data = self.__alive.get(key)
+            if data is not None:
+                self.__keep(key, data)
+            return data
+
+    def store(self, uuid: str, cache_key: Any, data: Dict[str, Any]) -> ProviderData:
+        """Memoize the result of a provider.
+
+        Args:
+            uuid: uuid of the provider
+            cache_key: cache key of the provider
+            data: data to memoize
+
+        Returns:
+            the memoized data, to use in place of `data`
+        """
+        data = ProviderData(data)
+        for value in data.values():
+            if isinstance(value, np.ndarray):
+                value.flags.writeable = False
+        key = self.key(uuid, cache_key)
+        with self.__lock:
+            self.__alive[key] = data
+            self.__keep(key, data)
+        return data
+
+    def clear(self):
+        """Forget every memoized result."""
+        with self.__lock:
+            self.__recent.clear()
+            self.__alive.clear()
+
+    @property
+    def bytes(self) -> int:
+        """Size of the results kept alive, in bytes."""
+        with self.__lock:
+            return sum(size for _, size in self.__recent.values())
+
+    def __keep(self, key: Hashable, data: ProviderData):
+        self.__recent.pop(key, None)
+        self.__recent[key] = (data, _data_size(data))
+        total = sum(size for _, size in self.__recent.values())
+        # The most recent result is kept even if it alone is over the budget
+        while total > self.max_bytes and len(self.__recent) > 1:
+            _, (_, size) = self.__recent.popitem(last=False)
+            total -= size
+
+
+def _data_size(data: Dict[str, Any]) -> int:
+    """Get the size of the arrays of a provider's result, in bytes."""
+    return sum(value.nbytes for value in data.values() if isinstance(value, np.ndarray))
+
+
+# Memo shared by every provider of the process
+default_memo = ProviderMemo()
@@ -1,12 +1,15 @@
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List
 import numpy as np
 
 from .fit_files_template import FitFilesDataProviderTemplate
-from ..fitfile import FitFile
+from ..fitfile import FitFile, FitColumns
+from ..math import QuantileSketch, distance_grade, sliding_window_start
+from ..utils import pace_to_speed, difference, derivative
 
 
 class SpeedPowerFitFilesDataProvider(FitFilesDataProviderTemplate):
     uuid = "290e069f-80a7-422e-a568-66b8d3e23311"
+    fields = ["enhanced_speed", "Power", "distance", "heart_rate", "enhanced_altitude"]
 
     def __init__(
         self,
@@ -14,62 +17,160 @@ class SpeedPowerFitFilesDataProvider(FitFilesDataProviderTemplate):
         min_power=125,
         min_distance_change=0.1,
         grade_range: Optional[Tuple[float, float]] = None,
+        grade_window: Optional[float] = None,
+        max_altitude_deviation: Optional[float] = None,
         **kwargs
     ):
+        """
+        Args:
+            min_pace_per_mile: drop samples slower than this pace, in minutes per mile
+            min_power: drop samples with at most this power, in watts
+            min_distance_change: drop samples moving at most this many meters
+            grade_range: only keep samples with a grade (as a fraction) in this range
+            grade_window: compute grades over this many meters with distance_grade, rather
+                than from the previous sample alone
+            max_altitude_deviation: with grade_window, ignore altitudes further than this
+                many meters from the median altitude of the window
+        """
         super().__init__(**kwargs)
         self.min_pace_per_mile = min_pace_per_mile
         self.min_power = min_power
         self.min_distance_change = min_distance_change
         self.grade_range = grade_range
+        self.grade_window = grade_window
+        self.max_altitude_deviation = max_altitude_deviation
 
     @property
-    def cache_key(self):
+    def parameters(self):
         return (
-            super().cache_key,
             self.min_pace_per_mile,
             self.min_power,
             self.min_distance_change,
             self.grade_range,
+            self.grade_window,
+            self.max_altitude_deviation,
         )
 
-    def compute(self) -> Dict[str, Any]:
-        speeds = []
-        powers = []
-        grades = []
-        hrs = []
-        for filepath in self.files:
-            min_speed = pace_to_speed(self.min_pace_per_mile)
-            print(filepath)
-            with FitFile(filepath) as file:
-                df = load_pandas_from_fitfile(file)
-                speed = df["enhanced_speed"].to_numpy()
-                power = df["Power"].to_numpy()
-                distance = df["distance"].to_numpy()
-                hr = df["heart_rate"].to_numpy()
-                ddistance = difference(distance)
-                grade = derivative(df["enhanced_altitude"].to_numpy(), distance)
-                mask = (
-                    (speed > min_speed)
-                    & (power > self.min_power)
-                    & (ddistance > self.min_distance_change)
-                )
-                if self.grade_range is not None:
-                    mask &= (grade >= self.grade_range[0]) & (
-                        grade <= self.grade_range[1]
-                    )
-
-                masked_speed = speed[mask]
-                masked_power = power[mask]
-                masked_grade = grade[mask]
-                masked_hr = hr[mask]
-
-                speeds.append(masked_speed)
-                powers.append(masked_power)
-                grades.append(masked_grade)
-                hrs.append(masked_hr)
-
-        speeds = np.concatenate(speeds, 0)
-        powers = np.concatenate(powers, 0)
-        grades = 100 * np.concatenate(grades, 0)
-        hrs = np.concatenate(hrs)
-        return {"speeds": speeds, "powers": powers, "grades": grades, "hrs": hrs}
+    def compute_file(self, filepath: str) -> Dict[str, Any]:
+        sample_filter = _SampleFilter(
+            min_speed=pace_to_speed(self.min_pace_per_mile),
+            min_power=self.min_power,
+            min_distance_change=self.min_distance_change,
+            grade_range=self.grade_range,
+            grade_window=self.grade_window,
+            max_altitude_deviation=self.max_altitude_deviation,
+        )
+        with FitFile(filepath, native=True, cache=self.fit_cache) as file:
+            columns = file.read_columns(self.fields, where=sample_filter)
+        grades = 100 * columns.values["grade"]
+        return {
+            "speeds": columns.values["enhanced_speed"],
+            "powers": columns.values["Power"],
+            "grades": grades,
+            "hrs": columns.values["heart_rate"],
+            "grade_sketch": QuantileSketch().update(grades),
+        }
+
+    def merge(self, partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+        grade_sketch = QuantileSketch()
+        for partial in partials:
+            grade_sketch.merge(partial["grade_sketch"])
+        return {
+            "speeds": np.concatenate([partial["speeds"] for partial in partials], 0),
+            "powers": np.concatenate([partial["powers"] for partial in partials], 0),
+            "grades": np.concatenate([partial["grades"] for partial in partials], 0),
+            "hrs": np.concatenate([partial["hrs"] for partial in partials]),
+            "grade_sketch": grade_sketch,
+        }
+
+
+class _SampleFilter:
+    """Predicate for FitFile.read_columns keeping the samples used by the provider.
+
+    Adds a derived "grade" column. Distance and altitude deltas need the previous sample,
+    so the last sample of each chunk is carried over to the next one. Grades over a distance
+    window also carry over the samples their windows reach back to.
+    """
+
+    def __init__(
+        self,
+        min_speed: float,
+        min_power: float,
+        min_distance_change: float,
+        grade_range: Optional[Tuple[float, float]],
+        grade_window: Optional[float] = None,
+        max_altitude_deviation: Optional[float] = None,
+    ):
+        self.min_speed = min_speed
+        self.min_power = min_power
+        self.min_distance_change = min_distance_change
+        self.grade_range = grade_range
+        self.grade_window = grade_window
+        self.max_altitude_deviation = max_altitude_deviation
+        self.previous: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        self.tail = (np.zeros(0), np.zeros(0))
+
+    def __call__(self, chunk: FitColumns) -> np.ndarray:
+        distance = chunk.values["distance"]
+        altitude = chunk.values["enhanced_altitude"]
+        if self.previous is None:
+            self.previous = (distance[:1], altitude[:1])
+        previous_distance, previous_altitude = self.previous
+        distance = np.concatenate([previous_distance, distance])
+        altitude = np.concatenate([previous_altitude, altitude])
+        ddistance = difference(distance)[1:]
+        grade = derivative(altitude, distance)[1:]
+        if len(distance) > 1:
+            self.previous = (distance[-1:], altitude[-1:])
+        if self.grade_window is not None:
+            grade = self.__window_grade(
+                chunk.values["distance"], chunk.values["enhanced_altitude"]
+            )
+
+        speed = chunk.values["enhanced_speed"]
+        power = chunk.values["Power"]
+        mask = (
+            chunk.valid["enhanced_speed"]
+            & chunk.valid["Power"]
+            & (speed > self.min_speed)
+            & (power > self.min_power)
+            & (ddistance > self.min_distance_change)
+        )
+        if self.grade_range is not None:
+            mask &= (grade >= self.grade_range[0]) & (grade <= self.grade_range[1])
+
+        chunk.values["grade"] = grade
+        chunk.valid["grade"] = np.isfinite(grade)
+        if not chunk.valid["heart_rate"].all():
+            chunk.values["heart_rate"] = np.where(
+                chunk.valid["heart_rate"], chunk.values["heart_rate"], np.nan
+            )
+        return mask
+
+    def __window_grade(self, distance: np.ndarray, altitude: np.ndarray) -> np.ndarray:
+        tail_distance, tail_altitude = self.tail
+        distance = np.concatenate([tail_distance, distance])
+        altitude = np.concatenate([tail_altitude, altitude])
+        grade = distance_grade(
+            distance, altitude, self.grade_window, self.max_altitude_deviation
+        )[len(tail_distance) :]
+
+        # Keep the samples the windows of the next chunk can reach: the smoothed altitude
+        # at the start of the last grade window, and the medians it depends on
+        finite = np.flatnonzero(np.isfinite(distance) & np.isfinite(altitude))
+        if len(finite) == 0:
+            self.tail = (np.zeros(0), np.zeros(0))
+            return grade
+        window_start = sliding_window_start(distance[finite], self.grade_window)
+        last = max(
+            np.searchsorted(
+                distance[finite],
+                distance[finite[-1]] - self.grade_window,
+                side="right",
+            )
+            - 1,
+            0,
+        )
+        first = finite[window_start[window_start[last]]]
+        self.tail = (distance[first:], altitude[first:])
+        return grade
@@ -0,0 +1,99 @@
+import gzip
+import os
+import pickle
+import shutil
+import tempfile
+import numpy as np
+from typing import Any, Dict, Optional
+
+
+def load_cached(cache_file: str, cache_key: Any) -> Optional[Dict[str, Any]]:
+    """Load data cached by store_cached.
+
+    Args:
+        cache_file: path to the .pkl.gz file
+        cache_key: key the data must have been stored with
+
+    Returns:
+        the cached data, or None if missing or stored with another key
+    """
+    if not os.path.exists(cache_file):
+        return None
+    with gzip.open(cache_file, "rb") as f:
+        cached = pickle.load(f)
+    if cached["cache_key"] != cache_key:
+        return None
+    return cached["data"]
+
+
+def store_cached(cache_file: str, cache_key: Any, data: Dict[str, Any]):
+    """Store data in a gzipped pickle along with its cache key.
+
+    Args:
+        cache_file: path to the .pkl.gz file
+        cache_key: key the data depends on
+        data: data to store
+    """
+    # Write to a temporary file first, so readers never see a partial pickle
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(cache_file) or ".", suffix=".pkl.gz"
+    )
+    with os.fdopen(fd, "wb") as raw, gzip.open(raw, "wb") as f:
+        pickle.dump({"cache_key": cache_key, "data": data}, f)
+    os.replace(temp_path, cache_file)
+
+
+def load_arrays(entry_directory: str, cache_key: Any) -> Optional[Dict[str, Any]]:
+    """Load data cached by store_arrays, with arrays memory-mapped read-only.
+
+    Args:
+        entry_directory: directory the data was stored in
+        cache_key: key the data must have been stored with
+
+    Returns:
+        the cached data, or None if missing or stored with another key
+    """
+    meta = load_cached(os.path.join(entry_directory, "meta.pkl.gz"), cache_key)
+    if meta is None:
+        return None
+    data = dict(meta["values"])
+    for name, filename in meta["arrays"].items():
+        data[name] = np.load(os.path.join(entry_directory, filename), mmap_mode="r")
+    return data
+
+
+def store_arrays(entry_directory: str, cache_key: Any, data: Dict[str, Any]):
+    """Store data, writing its NumPy arrays as uncompressed .npy files.
+
+    Arrays can then be memory-mapped rather than decompressed and unpickled. Other values
+    (and arrays of Python objects) are stored in a gzipped pickle along with the cache key.
+
+    Args:
+        entry_directory: directory to store the data in. Replaced if it exists
+        cache_key: key the data depends on
+        data: data to store
+    """
+    parent = os.path.dirname(entry_directory) or "."
+    # Write to a temporary directory first, so readers never see a partial entry
+    temp_directory = tempfile.mkdtemp(dir=parent)
+    arrays = {}
+    values = {}
+    for i, (name, value) in enumerate(data.items()):
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            arrays[name] = "%d.npy" % i
+            np.save(os.path.join(temp_directory, arrays[name]), value)
+        else:
+            values[name] = value
+    store_cached(
+        os.path.join(temp_directory, "meta.pkl.gz"),
+        cache_key,
+        {"arrays": arrays, "values": values},
+    )
+    # A directory can't be renamed over another, so move the old entry aside first
+    old_directory = None
+    if os.path.exists(entry_directory):
+        old_directory = tempfile.mkdtemp(dir=parent)
+        os.rename(entry_directory, os.path.join(old_directory, "entry"))
+    os.rename(temp_directory, entry_directory)
+    if old_directory is not None:
+        shutil.rmtree(old_directory)
@@ -1,17 +1,47 @@
 from abc import ABC, abstractmethod
 import os
-import gzip
-import pickle
-from typing import Dict, Any
+import shutil
+from typing import Dict, Any, Optional
+
+from .cache_manager import CacheManager
+from .memo import ProviderData, ProviderMemo, default_memo
 
 
 class DataProviderTemplate(ABC):
     uuid = None
 
-    def __init__(self, cache_directory: str = "cache"):
+    def __init__(
+        self,
+        cache_directory: str = "cache",
+        cache_manager: Optional[CacheManager] = None,
+        memo: Optional[ProviderMemo] = default_memo,
+    ):
+        """
+        Args:
+            cache_directory: where cached data is stored
+            cache_manager: store of the provider's results. Defaults to a CacheManager in
+                <cache_directory>/providers, whose budget also covers the other caches of
+                cache_directory
+            memo: in-process memo of the provider's results, shared by default with every
+                provider of the process. None to always load from the cache
+        """
         os.makedirs(cache_directory, exist_ok=True)
         assert self.uuid is not None
         self.cache_directory = cache_directory
+        if cache_manager is None:
+            cache_manager = CacheManager(
+                os.path.join(cache_directory, "providers"),
+                shared_directory=cache_directory,
+            )
+        self.cache_manager = cache_manager
+        self.memo = memo
+
+    def __getstate__(self):
+        # The memo is local to the process, and holds a lock which can't be pickled, so
+        # providers sent to worker processes go without it
+        state = self.__dict__.copy()
+        state["memo"] = None
+        return state
 
     @property
     @abstractmethod
@@ -22,16 +52,31 @@ class DataProviderTemplate(ABC):
     def compute(self) -> Dict[str, Any]:
         pass
 
-    def get(self):
+    def get(self) -> ProviderData:
         cache_key = self.cache_key
-        cache_file = os.path.join(self.cache_directory, self.uuid + ".pkl.gz")
-        if os.path.exists(cache_file):
-            with gzip.open(cache_file, "rb") as f:
-                cached = pickle.load(f)
-            if cached["cache_key"] == cache_key:
-                return cached["data"]
-        out = self.compute()
-        out = {"cache_key": cache_key, "data": out}
-        with gzip.open(cache_file, "wb") as f:
-            pickle.dump(out, f)
-        return out["data"]
+        if self.memo is not None:
+            memoized = self.memo.load(self.uuid, cache_key)
+            if memoized is not None:
+                return memoized
+        out = self.cache_manager.load(self.uuid, cache_key)
+        if out is None:
+            computed = self.compute()
+            self.cache_manager.store(self.uuid, cache_key, computed)
+            self.__drop_legacy_cache()
+            # Serve the stored copy, so its arrays are memory-mapped like cache hits. It
+            # may already be evicted by another provider sharing the cache
+            out = self.cache_manager.load(self.uuid, cache_key)
+            if out is None:
+                out = computed
+        if self.memo is None:
+            return ProviderData(out)
+        return self.memo.store(self.uuid, cache_key, out)
+
+    def __drop_legacy_cache(self):
+        # Drop the single cached result of older versions
+        for legacy in (self.uuid + ".pkl.gz", self.uuid + ".data"):
+            legacy_path = os.path.join(self.cache_directory, legacy)
+            if os.path.isdir(legacy_path):
+                shutil.rmtree(legacy_path, ignore_errors=True)
+            elif os.path.exists(legacy_path):
+                os.remove(legacy_path)
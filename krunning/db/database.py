@@ -1,6 +1,8 @@
 from contextlib import ExitStack, contextmanager
 import datetime
-from typing import ContextManager, Any, Union, Dict
+import io
+import weakref
+from typing import ContextManager, Any, Union, Dict, Iterable, List, Optional, Tuple
 
 import psycopg2
 from abc import ABC, abstractmethod
@@ -18,6 +20,7 @@ class NoConnectionAvailable(IOError):
 
 class PGConnectionPool(ConnectionPool):
     def __init__(self, connection_dict: Dict[str, Any], size: int):
+        self.__connection_dict = connection_dict
         self.__pool = []
         for _ in range(size):
             self.__pool.append(psycopg2.connect(**connection_dict))
@@ -27,6 +30,9 @@ class PGConnectionPool(ConnectionPool):
         if len(self.__pool) == 0:
             raise NoConnectionAvailable
         conn = self.__pool.pop()
+        if conn.closed:
+            # Closed after a failed rollback
+            conn = psycopg2.connect(**self.__connection_dict)
         try:
             yield conn
         finally:
@@ -58,54 +64,143 @@ class ActivityBuilder(ABC):
 
 
 class Field(object):
+    """Column of an activity's header.
+
+    Values are read from and written to the builder's in-memory header, which is loaded
+    with the activity and written back in one UPDATE at commit.
+    """
+
     def __init__(self, name: str, type):
         self.name = name
         self.type = type
 
     def __get__(self, instance, owner):
-        cur = instance.cursor
-        cur.execute(
-            f"SELECT {self.name} FROM {instance.table} WHERE id = %s LIMIT 1;",
-            [instance.id],
-        )
-        (value,) = cur.fetchone()
-        return value
+        if instance is None:
+            return self
+        return instance.get_header(self.name)
 
     def __set__(self, instance, value):
         if not isinstance(value, self.type):
             raise TypeError(
                 "Expected %s for %s, received %r" % (self.type, self.name, value)
             )
-        cur = instance.cursor
-        cur.execute(
-            f"UPDATE {instance.table} SET {self.name} = %s WHERE id = %s;",
-            [value, instance.id],
+        instance.set_header(self.name, value)
+
+
+FieldKey = Tuple[str, Optional[str]]
+
+
+class FieldIdCache:
+    """Ids of the rows of the `fields` table, by (field_name, field_units).
+
+    Warmed from the whole table on first use, so samples don't look up their fields. Ids of
+    fields inserted by the current transaction are kept apart until it commits, as a
+    rollback drops them.
+    """
+
+    def __init__(self):
+        self.__committed: Optional[Dict[FieldKey, int]] = None
+        self.__pending: Dict[FieldKey, int] = {}
+
+    def get(self, cursor, keys: Iterable[FieldKey]) -> Dict[FieldKey, int]:
+        """Get the ids of fields, inserting the missing ones.
+
+        Args:
+            cursor: cursor of the cache's connection
+            keys: (field_name, field_units) of the fields
+
+        Returns:
+            id of each field
+        """
+        if self.__committed is None:
+            cursor.execute("SELECT field_name, field_units, id FROM fields;")
+            self.__committed = {
+                (field_name, field_units): field_id
+                for field_name, field_units, field_id in cursor.fetchall()
+            }
+        ids = {}
+        missing = []
+        for key in keys:
+            field_id = self.__committed.get(key, self.__pending.get(key))
+            if field_id is None:
+                missing.append(key)
+            else:
+                ids[key] = field_id
+        if missing:
+            inserted = _insert_fields(cursor, missing)
+            self.__pending.update(inserted)
+            ids.update(inserted)
+        return ids
+
+    def commit(self):
+        """Keep the ids of the fields inserted by the committed transaction."""
+        if self.__committed is not None:
+            self.__committed.update(self.__pending)
+        self.__pending = {}
+
+    def rollback(self):
+        """Forget the ids of the fields inserted by the rolled back transaction."""
+        self.__pending = {}
+
+
+# Field id cache of each open connection
+_field_id_caches = weakref.WeakKeyDictionary()
+
+
+def field_id_cache(connection) -> FieldIdCache:
+    """Get the field id cache of a connection."""
+    if connection not in _field_id_caches:
+        _field_id_caches[connection] = FieldIdCache()
+    return _field_id_caches[connection]
+
+
+def _insert_fields(cursor, keys: List[FieldKey]) -> Dict[FieldKey, int]:
+    """Insert the fields which don't exist yet, and get the ids of the fields."""
+    names, units = zip(*keys)
+    params = dict(names=list(names), units=list(units))
+    # Units may be NULL, which the unique constraint doesn't deduplicate
+    cursor.execute(
+        """
+        INSERT INTO fields (field_name, field_units)
+        SELECT new.field_name, new.field_units
+        FROM unnest(%(names)s::text[], %(units)s::text[]) AS new(field_name, field_units)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM fields f
+            WHERE f.field_name = new.field_name
+            AND f.field_units IS NOT DISTINCT FROM new.field_units
         )
+        ON CONFLICT (field_name, field_units) DO NOTHING;
+        """,
+        params,
+    )
+    cursor.execute(
+        """
+        SELECT DISTINCT ON (new.field_name, new.field_units)
+            new.field_name, new.field_units, f.id
+        FROM unnest(%(names)s::text[], %(units)s::text[]) AS new(field_name, field_units)
+        INNER JOIN fields f ON f.field_name = new.field_name
+            AND f.field_units IS NOT DISTINCT FROM new.field_units
+        ORDER BY new.field_name, new.field_units, f.id;
+        """,
+        params,
+    )
+    return {
+        (field_name, field_units): field_id
+        for field_name, field_units, field_id in cursor.fetchall()
+    }
 
 
 class Sample:
-    def __init__(self, cursor, id):
+    def __init__(self, cursor, id, field_ids: FieldIdCache):
         self.__cursor = cursor
         self.__id = id
+        self.__field_ids = field_ids
 
     def add_value(
         self, field_name: str, field_units: str, field_value: Union[float, int]
     ):
-        self.__cursor.execute(
-            """
-            INSERT INTO fields (field_name, field_units)
-            VALUES (%s, %s)
-            ON CONFLICT (field_name, field_units) DO NOTHING;
-        """,
-            [field_name, field_units],
-        )
-        self.__cursor.execute(
-            """
-            SELECT id FROM fields WHERE field_name = %s AND field_units = %s LIMIT 1;
-        """,
-            [field_name, field_units],
-        )
-        (field_id,) = self.__cursor.fetchone()
+        key = (field_name, field_units)
+        field_id = self.__field_ids.get(self.__cursor, [key])[key]
         self.__cursor.execute(
             """
             INSERT INTO sample_values (sample_id, field_id, int_value, float_value) 
@@ -121,6 +216,50 @@ class Sample:
         )
 
 
+class BufferedSample:
+    """Sample of a bulk DatabaseActivityBuilder, whose values are written at commit."""
+
+    def __init__(self, message_id: int, timestamp: datetime.datetime):
+        self.message_id = message_id
+        self.timestamp = timestamp
+        # Value of each (field_name, field_units), the last one winning like upserts do
+        self.values: Dict[FieldKey, Union[float, int]] = {}
+
+    def add_value(
+        self, field_name: str, field_units: str, field_value: Union[float, int]
+    ):
+        self.values[(field_name, field_units)] = field_value
+
+
+def copy_buffer(rows: Iterable[Iterable[Any]]) -> io.StringIO:
+    """Encode rows in the text format of COPY ... FROM STDIN.
+
+    Args:
+        rows: rows of values. None is written as NULL
+
+    Returns:
+        the encoded rows, rewound
+    """
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(map(_copy_text, row)))
+        buffer.write("\n")
+    buffer.seek(0)
+    return buffer
+
+
+def _copy_text(value: Any) -> str:
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
 class ActivityAlreadyExistsError(ValueError):
     pass
 
@@ -129,12 +268,31 @@ class DatabaseActivityBuilder(ActivityBuilder):
     table = "activities"
 
     def __init__(
-        self, connection_pool: ConnectionPool, fitfile_name: str, replace: bool
+        self,
+        connection_pool: ConnectionPool,
+        fitfile_name: str,
+        replace: bool,
+        bulk: bool = False,
     ):
+        """
+        Args:
+            connection_pool: pool to get the connection from
+            fitfile_name: name of the activity's .fit file
+            replace: replace the activity if it already exists, rather than raising
+                ActivityAlreadyExistsError
+            bulk: buffer the samples and timer events of the activity, and write them with
+                a few COPY statements at commit rather than a few statements each
+        """
         self.__exit_stack = ExitStack()
         self.__connection_pool = connection_pool
         self.__connection = None
         self.__replace = replace
+        self.__bulk = bulk
+        self.__samples: List[BufferedSample] = []
+        self.__timer_events: List[Tuple[Any, ...]] = []
+        self.__field_ids: Optional[FieldIdCache] = None
+        self.__header: Dict[str, Any] = {}
+        self.__changed_header: Dict[str, Any] = {}
         self.cursor = None
         self.id = None
         self.__fitfile_name = fitfile_name
@@ -166,6 +324,11 @@ class DatabaseActivityBuilder(ActivityBuilder):
         timer_trigger: str,
         timestamp: datetime.datetime,
     ):
+        if self.__bulk:
+            self.__timer_events.append(
+                (self.id, message_id, event_type, timer_trigger, timestamp)
+            )
+            return
         self.cursor.execute(
             """
             INSERT INTO timer_events (activity_id, message_id, event_type, timer_trigger, created) 
@@ -182,7 +345,13 @@ class DatabaseActivityBuilder(ActivityBuilder):
             ),
         )
 
-    def add_sample(self, message_id: int, timestamp: datetime.datetime) -> Sample:
+    def add_sample(
+        self, message_id: int, timestamp: datetime.datetime
+    ) -> Union[Sample, BufferedSample]:
+        if self.__bulk:
+            sample = BufferedSample(message_id, timestamp)
+            self.__samples.append(sample)
+            return sample
         self.cursor.execute(
             """
             INSERT INTO samples (activity_id, message_id, sampled_at) 
@@ -193,13 +362,22 @@ class DatabaseActivityBuilder(ActivityBuilder):
             dict(activity_id=self.id, message_id=message_id, sampled_at=timestamp),
         )
         (sample_id,) = self.cursor.fetchone()
-        return Sample(self.cursor, sample_id)
+        return Sample(self.cursor, sample_id, self.__field_ids)
 
     def start(self):
         self.__connection = self.__exit_stack.enter_context(
             self.__connection_pool.get_connection()
         )
+        try:
+            self.__start()
+        except Exception:
+            # Not exited as a context manager, so the connection goes back to the pool here
+            self.rollback()
+            raise
+
+    def __start(self):
         self.cursor = self.__connection.cursor()
+        self.__field_ids = field_id_cache(self.__connection)
 
         self.cursor.execute(
             """
@@ -220,19 +398,125 @@ class DatabaseActivityBuilder(ActivityBuilder):
             """,
             [self.__fitfile_name],
         )
+        # The header is read along with the id, for the Fields to read from memory
+        columns = self.header_columns()
         self.cursor.execute(
-            """SELECT id FROM activities WHERE fitfile_name = %s LIMIT 1;""",
+            f"""
+            SELECT id, {", ".join(columns)} FROM {self.table}
+            WHERE fitfile_name = %s LIMIT 1;
+            """,
             [self.__fitfile_name],
         )
-        (self.id,) = self.cursor.fetchone()
+        self.id, *values = self.cursor.fetchone()
+        self.__header = dict(zip(columns, values))
+        self.__changed_header = {}
+
+    @classmethod
+    def header_columns(cls) -> List[str]:
+        """Get the columns of the activity's header, set through Fields."""
+        fields = [getattr(cls, name) for name in dir(cls)]
+        return [field.name for field in fields if isinstance(field, Field)]
+
+    def get_header(self, column: str) -> Any:
+        """Get a column of the activity's header."""
+        return self.__header[column]
+
+    def set_header(self, column: str, value: Any):
+        """Set a column of the activity's header, written at commit."""
+        self.__header[column] = value
+        self.__changed_header[column] = value
+
+    def __write_header(self):
+        if not self.__changed_header:
+            return
+        assignments = ", ".join("%s = %%s" % column for column in self.__changed_header)
+        self.cursor.execute(
+            f"UPDATE {self.table} SET {assignments} WHERE id = %s;",
+            list(self.__changed_header.values()) + [self.id],
+        )
+        self.__changed_header = {}
+
+    def __write_buffered(self):
+        """Write the buffered samples and timer events of a bulk builder."""
+        if self.__replace:
+            # Rows of the replaced activity are dropped rather than upserted one by one
+            self.cursor.execute(
+                "DELETE FROM samples WHERE activity_id = %s;", [self.id]
+            )
+            self.cursor.execute(
+                "DELETE FROM timer_events WHERE activity_id = %s;", [self.id]
+            )
+        self.cursor.copy_expert(
+            """
+            COPY timer_events (activity_id, message_id, event_type, timer_trigger, created)
+            FROM STDIN
+            """,
+            copy_buffer(self.__timer_events),
+        )
+        if not self.__samples:
+            return
+
+        field_ids = self.__field_ids.get(
+            self.cursor, {key for sample in self.__samples for key in sample.values}
+        )
+        # Sample ids are drawn from the sequence up front, so values can reference them
+        self.cursor.execute(
+            """
+            SELECT nextval(pg_get_serial_sequence('samples', 'id'))
+            FROM generate_series(1, %s);
+            """,
+            [len(self.__samples)],
+        )
+        sample_ids = [sample_id for (sample_id,) in self.cursor.fetchall()]
+        self.cursor.copy_expert(
+            "COPY samples (id, activity_id, message_id, sampled_at) FROM STDIN",
+            copy_buffer(
+                (sample_id, self.id, sample.message_id, sample.timestamp)
+                for sample_id, sample in zip(sample_ids, self.__samples)
+            ),
+        )
+        self.cursor.copy_expert(
+            """
+            COPY sample_values (sample_id, field_id, int_value, float_value)
+            FROM STDIN
+            """,
+            copy_buffer(
+                (
+                    sample_id,
+                    field_ids[key],
+                    value if isinstance(value, int) else None,
+                    value if isinstance(value, float) else None,
+                )
+                for sample_id, sample in zip(sample_ids, self.__samples)
+                for key, value in sample.values.items()
+            ),
+        )
 
     def commit(self):
-        self.__connection.commit()
-        self.__exit_stack.close()
+        try:
+            self.__write_header()
+            if self.__bulk:
+                self.__write_buffered()
+            self.__connection.commit()
+        except Exception:
+            self.rollback()
+            raise
+        try:
+            self.__field_ids.commit()
+        finally:
+            self.__exit_stack.close()
 
     def rollback(self):
-        self.__connection.rollback()
-        self.__connection.close()
+        try:
+            self.__connection.rollback()
+        except Exception:
+            # The connection is broken, the pool replaces it
+            self.__connection.close()
+            raise
+        finally:
+            if self.__field_ids is not None:
+                self.__field_ids.rollback()
+            self.__exit_stack.close()
 
 
 class Database:
@@ -255,6 +539,8 @@ class Database:
                     )
 
     def activity_builder(
-        self, fitfile_name: str, replace: bool
+        self, fitfile_name: str, replace: bool, bulk: bool = False
     ) -> DatabaseActivityBuilder:
-        return DatabaseActivityBuilder(self.__connection_pool, fitfile_name, replace)
+        return DatabaseActivityBuilder(
+            self.__connection_pool, fitfile_name, replace, bulk=bulk
+        )
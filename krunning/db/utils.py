@@ -1,5 +1,5 @@
 from contextlib import contextmanager
-from typing import Union
+from typing import Any, Dict, Optional, Union
 
 import psycopg2
 
@@ -7,16 +7,21 @@ from krunning.db import conn_dict_from_env
 
 
 @contextmanager
-def get_conn(expected_schema: Union[int, str]):
-    conn = psycopg2.connect(**conn_dict_from_env())
-    with conn:
-        cur = conn.cursor()
+def get_conn(
+    expected_schema: Union[int, str], conn_dict: Optional[Dict[str, Any]] = None
+):
+    conn = psycopg2.connect(**(conn_dict or conn_dict_from_env()))
+    try:
+        with conn:
+            cur = conn.cursor()
 
-        # Make sure the DB schema is at the expected migration
-        cur.execute("SELECT version FROM migration LIMIT 1;")
-        (version,) = cur.fetchone()
-        if isinstance(expected_schema, int):
-            expected_schema = "%04d" % expected_schema
-        assert version == expected_schema
+            # Make sure the DB schema is at the expected migration
+            cur.execute("SELECT version FROM migration LIMIT 1;")
+            (version,) = cur.fetchone()
+            if isinstance(expected_schema, int):
+                expected_schema = "%04d" % expected_schema
+            assert version == expected_schema
 
-        yield cur
+            yield cur
+    finally:
+        conn.close()
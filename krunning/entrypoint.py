@@ -1,6 +1,8 @@
 import argparse
+import os
 from typing import Dict
 
+from .data_provider import CacheManager
 from .reports_gen import ReportGenerator, PDFReportsReportBuilder, reports
 
 
@@ -24,3 +26,55 @@ def report_main(args=None):
     report_builder = PDFReportsReportBuilder()
     report.generate_report(parsed_args, report_builder)
     report_builder.write_to(parsed_args.output)
+
+
+def cache_main(args=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-d",
+        "--directory",
+        default="cache",
+        help="cache directory. Its providers subdirectory holds the data provider cache, "
+        "and its other subdirectories share the budget",
+    )
+    subparsers = parser.add_subparsers(title="command", dest="command", required=True)
+    subparsers.add_parser("stats", help="show the size and hit rate of the cache")
+    prune_parser = subparsers.add_parser(
+        "prune", help="evict least recently used entries"
+    )
+    prune_group = prune_parser.add_mutually_exclusive_group(required=True)
+    prune_group.add_argument(
+        "--max-mb", type=float, help="evict entries until the cache fits in this size"
+    )
+    prune_group.add_argument("--all", action="store_true", help="evict every entry")
+
+    parsed_args = parser.parse_args(args)
+    cache_manager = CacheManager(
+        os.path.join(parsed_args.directory, "providers"),
+        shared_directory=parsed_args.directory,
+    )
+    if parsed_args.command == "prune":
+        max_bytes = 0 if parsed_args.all else int(parsed_args.max_mb * (1 << 20))
+        evicted = cache_manager.prune(max_bytes)
+        print("Evicted %d entries" % evicted)
+    stats = cache_manager.stats()
+    lookups = stats.hits + stats.misses
+    entries = stats.entries + sum(usage["entries"] for usage in stats.stores.values())
+    print(
+        "%d entries, %.1f MB of %.1f MB"
+        % (entries, stats.bytes / (1 << 20), stats.max_bytes / (1 << 20))
+    )
+    print(
+        "%d hits, %d misses (%.1f%% hit rate)"
+        % (stats.hits, stats.misses, 100 * stats.hits / max(lookups, 1))
+    )
+    for uuid, usage in sorted(stats.providers.items()):
+        print(
+            "  %s: %d entries, %.1f MB"
+            % (uuid, usage["entries"], usage["bytes"] / (1 << 20))
+        )
+    for store, usage in sorted(stats.stores.items()):
+        print(
+            "  %s/: %d entries, %.1f MB"
+            % (store, usage["entries"], usage["bytes"] / (1 << 20))
+        )
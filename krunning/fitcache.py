@@ -0,0 +1,143 @@
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+from typing import Dict, Optional
+
+from .fitdecode import FitColumns
+from .manifest import FileManifest
+
+# Bump when the layout of cached activities changes, so old entries get decoded again
+CACHE_VERSION = 2
+
+
+class FitCache:
+    """Store of decoded fit files, so reports don't re-parse unchanged .fit files.
+
+    Each activity is a directory named after the SHA-1 of the .fit file's content, holding
+    one uncompressed .npy file per field (and one for its validity mask) plus a small
+    meta.json. Cached columns are memory-mapped read-only rather than copied into memory.
+
+    A FileManifest maps each .fit path to its size, modification time and content hash,
+    so unchanged files are recognized from a stat, without reading them.
+    """
+
+    def __init__(
+        self, directory: str = "cache/fit", manifest: Optional[FileManifest] = None
+    ):
+        """
+        Args:
+            directory: where the decoded activities are stored
+            manifest: manifest of the .fit files' content hashes. Defaults to a manifest.json
+                in the directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        if manifest is None:
+            manifest = FileManifest(os.path.join(directory, "manifest.json"))
+        self.manifest = manifest
+
+    def fingerprint(self, path: str) -> str:
+        """Get the content hash of a file, only reading it if its size or mtime changed.
+
+        Args:
+            path: path to the file
+
+        Returns:
+            hex SHA-1 of the file's content
+        """
+        return self.manifest.fingerprint(path)
+
+    def entry_directory(self, path: str) -> str:
+        """Get the directory holding the decoded columns of a fit file."""
+        return os.path.join(self.directory, self.fingerprint(path))
+
+    def load(self, path: str) -> Optional[FitColumns]:
+        """Load the decoded records of a fit file, memory-mapped.
+
+        Args:
+            path: path to the .fit file
+
+        Returns:
+            FitColumns with every record field, or None if the file is not cached yet
+        """
+        entry_directory = self.entry_directory(path)
+        meta = _read_meta(entry_directory)
+        if meta is None:
+            return None
+        values = {}
+        valid = {}
+        for i, (name, dtype) in enumerate(meta["fields"]):
+            # Arrays of Python objects can't be memory-mapped
+            mmap_mode = None if dtype == "object" else "r"
+            values[name] = np.load(
+                os.path.join(entry_directory, "%d.values.npy" % i),
+                mmap_mode=mmap_mode,
+                allow_pickle=mmap_mode is None,
+            )
+            valid[name] = np.load(
+                os.path.join(entry_directory, "%d.valid.npy" % i), mmap_mode="r"
+            )
+        return FitColumns(
+            length=meta["length"],
+            values=values,
+            valid=valid,
+            units=meta["units"],
+            base_types=meta["base_types"],
+        )
+
+    def store(self, path: str, columns: FitColumns):
+        """Store the decoded records of a fit file.
+
+        Args:
+            path: path to the .fit file the columns were decoded from
+            columns: FitColumns with every record field of the file
+        """
+        entry_directory = self.entry_directory(path)
+        if _read_meta(entry_directory) is not None:
+            return
+        # Drop entries left by older versions of the cache
+        shutil.rmtree(entry_directory, ignore_errors=True)
+        # Write to a temporary directory first, so readers never see a partial entry
+        temp_directory = tempfile.mkdtemp(dir=self.directory)
+        fields = []
+        for i, name in enumerate(columns.values):
+            column = columns.values[name]
+            np.save(
+                os.path.join(temp_directory, "%d.values.npy" % i),
+                column,
+                allow_pickle=column.dtype == object,
+            )
+            np.save(
+                os.path.join(temp_directory, "%d.valid.npy" % i), columns.valid[name]
+            )
+            fields.append((name, str(column.dtype)))
+        with open(os.path.join(temp_directory, "meta.json"), "w") as f:
+            json.dump(
+                dict(
+                    version=CACHE_VERSION,
+                    length=columns.length,
+                    units=columns.units,
+                    base_types=columns.base_types,
+                    fields=fields,
+                ),
+                f,
+            )
+        try:
+            os.rename(temp_directory, entry_directory)
+        except OSError:
+            # Another process stored the same activity first
+            shutil.rmtree(temp_directory)
+
+
+def _read_meta(entry_directory: str) -> Optional[Dict[str, object]]:
+    """Read the meta.json of a cached activity, None if missing or from another cache version."""
+    meta_path = os.path.join(entry_directory, "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    if meta["version"] != CACHE_VERSION:
+        return None
+    return meta
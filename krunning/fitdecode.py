@@ -0,0 +1,559 @@
+import datetime
+import struct
+import numpy as np
+from fitparse.processors import UTC_REFERENCE
+from fitparse.profile import MESSAGE_TYPES, FIELD_TYPE_TIMESTAMP
+from fitparse.records import BaseType, BASE_TYPE_BYTE
+from fitparse.records import BASE_TYPES as FIT_BASE_TYPES
+from typing import Dict, List, Optional, Set, Tuple, NamedTuple
+
+FILE_ID_MESG_NUM = 0
+SESSION_MESG_NUM = 18
+RECORD_MESG_NUM = 20
+FIELD_DESCRIPTION_MESG_NUM = 206
+
+# Seconds since the fit epoch below which date_time values are relative, not absolute
+MIN_ABSOLUTE_DATE_TIME = 0x10000000
+
+# Numeric fit base types: base type id -> (NumPy dtype, invalid value)
+BASE_TYPES = {
+    0x00: ("u1", 0xFF),  # enum
+    0x01: ("i1", 0x7F),  # sint8
+    0x02: ("u1", 0xFF),  # uint8
+    0x83: ("i2", 0x7FFF),  # sint16
+    0x84: ("u2", 0xFFFF),  # uint16
+    0x85: ("i4", 0x7FFFFFFF),  # sint32
+    0x86: ("u4", 0xFFFFFFFF),  # uint32
+    0x88: ("f4", None),  # float32
+    0x89: ("f8", None),  # float64
+    0x0A: ("u1", 0),  # uint8z
+    0x8B: ("u2", 0),  # uint16z
+    0x8C: ("u4", 0),  # uint32z
+    0x8E: ("i8", 0x7FFFFFFFFFFFFFFF),  # sint64
+    0x8F: ("u8", 0xFFFFFFFFFFFFFFFF),  # uint64
+    0x90: ("u8", 0),  # uint64z
+}
+
+
+class FitColumns(NamedTuple):
+    """Record messages of a fit file, decoded into one array per field.
+
+    Attributes:
+        length: number of records in the fit file
+        values: dictionary mapping field name to a length-long array of values.
+            Where a record does not have the field, the array holds a filler value
+            (NaN for floats, NaT for datetimes, 0 for integers, None for objects).
+        valid: dictionary mapping field name to a length-long boolean array, True where
+            the record has a value for the field
+        units: dictionary mapping field name to unit, for every field in the fit file
+            (not only the loaded ones). Fields without units will have unit, None
+        base_types: dictionary mapping field name to the name of its fit base type
+            (uint8, sint32, float32...), for every field in the fit file
+    """
+
+    length: int
+    values: Dict[str, np.ndarray]
+    valid: Dict[str, np.ndarray]
+    units: Dict[str, Optional[str]]
+    base_types: Dict[str, str]
+
+
+class ActivitySummary(NamedTuple):
+    """Overview of an activity, from the file_id and session messages of its fit file.
+
+    Attributes:
+        start_time: UTC start of the first session, or creation time of the file
+        sport: sport of the first session (running, cycling...)
+        duration: total timer time of the sessions, in seconds
+        distance: total distance of the sessions, in meters
+        fields: names of the fields defined for record messages
+    """
+
+    start_time: Optional[datetime.datetime]
+    sport: Optional[str]
+    duration: Optional[float]
+    distance: Optional[float]
+    fields: List[str]
+
+
+class UnsupportedFitFileError(ValueError):
+    """Raised when a fit file uses a feature the native decoder does not handle."""
+
+    pass
+
+
+class _Definition(NamedTuple):
+    mesg_num: int
+    endian: str
+    # (field definition number, size, base type id)
+    fields: List[Tuple[int, int, int]]
+    # (field definition number, size, developer data index)
+    dev_fields: List[Tuple[int, int, int]]
+    size: int
+
+
+class _Column(NamedTuple):
+    name: str
+    units: Optional[str]
+    base_type: str
+    # Name of the field in the structured dtype, None if the field is not decoded
+    key: Optional[str]
+    invalid: Optional[int]
+    scale: Optional[float]
+    offset: Optional[float]
+    is_date_time: bool
+
+
+class _RecordLayout(NamedTuple):
+    dtype: np.dtype
+    columns: List[_Column]
+
+
+class _PendingRecords(NamedTuple):
+    layout: _RecordLayout
+    # Byte offset of each record message using the layout, and its row in the output
+    positions: List[int]
+    rows: List[int]
+
+
+def decode_records(data: bytes, names: Optional[List[str]] = None) -> FitColumns:
+    """Decode the record messages of a fit file without going through fitparse's per-field objects.
+
+    Definition messages are cached by local message type. The offsets of the record messages
+    sharing a definition are collected in one walk over the message headers, then all of them
+    are gathered and decoded in bulk through a structured dtype. Scale and offset from
+    the fit profile are applied, and developer fields are named after their field descriptions.
+    Values match what fitparse produces; CRCs are not checked.
+
+    Args:
+        data: raw contents of the .fit file
+        names: only decode these fields. If not specified, decodes all fields in the file.
+            Fields that are not in the file are left out of the result.
+
+    Returns:
+        FitColumns with the requested record fields, and the units of every record field
+
+    Raises:
+        UnsupportedFitFileError: the file uses something only fitparse handles (compressed
+            timestamps, components, subfields, enums, arrays, strings...). Use fitparse instead.
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    wanted = None if names is None else set(names)
+    chunks: Dict[str, List[Tuple[np.ndarray, np.ndarray, np.ndarray]]] = {}
+    units: Dict[str, Optional[str]] = {}
+    base_types: Dict[str, str] = {}
+    dev_fields: Dict[Tuple[int, int], Tuple[str, Optional[str], int]] = {}
+    length = 0
+
+    def flush(pending: _PendingRecords):
+        """Decode every record message seen for one definition in a single pass."""
+        if len(pending.positions) == 0:
+            return
+        stride = pending.layout.dtype.itemsize
+        positions = np.array(pending.positions)
+        gathered = buffer[positions[:, None] + np.arange(stride)]
+        records = gathered.reshape(-1).view(pending.layout.dtype)
+        rows = np.array(pending.rows)
+        for column in pending.layout.columns:
+            if column.name not in units:
+                units[column.name] = column.units
+                base_types[column.name] = column.base_type
+                chunks[column.name] = []
+            if column.key is None:
+                continue
+            values, valid = _decode_column(records[column.key], column)
+            chunks[column.name].append((rows, values, valid))
+
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < 12 or data[offset + 8 : offset + 12] != b".FIT":
+            raise UnsupportedFitFileError("Invalid .FIT file header")
+        header_size = data[offset]
+        (data_size,) = struct.unpack_from("<I", data, offset + 4)
+        pos = offset + header_size
+        end = pos + data_size
+        if end + 2 > len(data):
+            raise UnsupportedFitFileError("Truncated .FIT file")
+
+        definitions: Dict[int, _Definition] = {}
+        pending: Dict[int, _PendingRecords] = {}
+        while pos < end:
+            header = data[pos]
+            if header & 0x80:
+                # Compressed timestamp header
+                definition = definitions.get((header >> 5) & 0x3)
+                if definition is None or definition.mesg_num == RECORD_MESG_NUM:
+                    raise UnsupportedFitFileError("Compressed timestamp record")
+                pos += 1 + definition.size
+            elif header & 0x40:
+                local_mesg_num = header & 0xF
+                definition, pos = _parse_definition(data, pos, bool(header & 0x20))
+                definitions[local_mesg_num] = definition
+                if local_mesg_num in pending:
+                    flush(pending.pop(local_mesg_num))
+                if definition.mesg_num == RECORD_MESG_NUM:
+                    pending[local_mesg_num] = _PendingRecords(
+                        _record_layout(definition, dev_fields, wanted), [], []
+                    )
+            else:
+                local_mesg_num = header & 0xF
+                definition = definitions.get(local_mesg_num)
+                if definition is None:
+                    raise UnsupportedFitFileError(
+                        "Data message with undefined local message type %d"
+                        % local_mesg_num
+                    )
+                if definition.mesg_num == RECORD_MESG_NUM:
+                    records = pending[local_mesg_num]
+                    records.positions.append(pos)
+                    records.rows.append(length)
+                    length += 1
+                elif definition.mesg_num == FIELD_DESCRIPTION_MESG_NUM:
+                    index, number, description = _parse_field_description(
+                        data, pos + 1, definition
+                    )
+                    dev_fields[(index, number)] = description
+                pos += 1 + definition.size
+        if pos != end:
+            raise UnsupportedFitFileError("Message crosses the end of the data")
+        for records in pending.values():
+            flush(records)
+        # Skip the CRC
+        offset = end + 2
+
+    columns = {
+        name: _assemble(chunks[name], length)
+        for name in units
+        if wanted is None or name in wanted
+    }
+    return FitColumns(
+        length=length,
+        values={name: column for name, (column, _) in columns.items()},
+        valid={name: valid for name, (_, valid) in columns.items()},
+        units=units,
+        base_types=base_types,
+    )
+
+
+def read_activity_summary(data: bytes) -> ActivitySummary:
+    """Read the overview of an activity without decoding its records.
+
+    Only the file_id and session messages are decoded. Record messages are skipped over,
+    only the names of the fields in their definitions are collected.
+
+    Args:
+        data: raw contents of the .fit file
+
+    Returns:
+        ActivitySummary of the file
+
+    Raises:
+        UnsupportedFitFileError: the file can't be walked natively. Use fitparse instead.
+    """
+    time_created = None
+    sessions = []
+    fields: Dict[str, None] = {}
+    dev_fields: Dict[Tuple[int, int], Tuple[str, Optional[str], int]] = {}
+    offset = 0
+    while offset < len(data):
+        if len(data) - offset < 12 or data[offset + 8 : offset + 12] != b".FIT":
+            raise UnsupportedFitFileError("Invalid .FIT file header")
+        header_size = data[offset]
+        (data_size,) = struct.unpack_from("<I", data, offset + 4)
+        pos = offset + header_size
+        end = pos + data_size
+        if end + 2 > len(data):
+            raise UnsupportedFitFileError("Truncated .FIT file")
+
+        definitions: Dict[int, _Definition] = {}
+        while pos < end:
+            header = data[pos]
+            if header & 0x80:
+                # Compressed timestamp header
+                definition = definitions.get((header >> 5) & 0x3)
+                if definition is None or definition.mesg_num in (
+                    FILE_ID_MESG_NUM,
+                    SESSION_MESG_NUM,
+                ):
+                    raise UnsupportedFitFileError("Compressed timestamp message")
+                pos += 1 + definition.size
+                continue
+            if header & 0x40:
+                definition, pos = _parse_definition(data, pos, bool(header & 0x20))
+                definitions[header & 0xF] = definition
+                if definition.mesg_num == RECORD_MESG_NUM:
+                    for name in _record_field_names(definition, dev_fields):
+                        fields[name] = None
+                continue
+            definition = definitions.get(header & 0xF)
+            if definition is None:
+                raise UnsupportedFitFileError(
+                    "Data message with undefined local message type %d" % (header & 0xF)
+                )
+            if definition.mesg_num == FIELD_DESCRIPTION_MESG_NUM:
+                index, number, description = _parse_field_description(
+                    data, pos + 1, definition
+                )
+                dev_fields[(index, number)] = description
+            elif definition.mesg_num == FILE_ID_MESG_NUM:
+                time_created = _parse_message(data, pos + 1, definition).get(
+                    "time_created"
+                )
+            elif definition.mesg_num == SESSION_MESG_NUM:
+                sessions.append(_parse_message(data, pos + 1, definition))
+            pos += 1 + definition.size
+        if pos != end:
+            raise UnsupportedFitFileError("Message crosses the end of the data")
+        # Skip the CRC
+        offset = end + 2
+
+    def total(name: str) -> Optional[float]:
+        values = [session[name] for session in sessions if name in session]
+        return sum(values) if values else None
+
+    first = sessions[0] if sessions else {}
+    return ActivitySummary(
+        start_time=first.get("start_time", time_created),
+        sport=first.get("sport"),
+        duration=total("total_timer_time"),
+        distance=total("total_distance"),
+        fields=list(fields),
+    )
+
+
+def _parse_message(data: bytes, pos: int, definition: _Definition) -> Dict[str, object]:
+    """Decode the scalar fields of a data message like fitparse does.
+
+    Numbers get scaled, date_times become datetimes, and enums are named after the profile.
+    Invalid values, unknown fields, arrays and strings are left out.
+    """
+    profile = MESSAGE_TYPES[definition.mesg_num].fields
+    values = {}
+    for number, size, base_type_id in definition.fields:
+        field = profile.get(number)
+        dtype, invalid = BASE_TYPES.get(base_type_id, (None, None))
+        if (
+            field is None
+            or field.components
+            or field.subfields
+            or dtype is None
+            or np.dtype(dtype).itemsize != size
+        ):
+            pos += size
+            continue
+        (raw,) = np.frombuffer(
+            data, dtype=definition.endian + dtype, count=1, offset=pos
+        ).tolist()
+        pos += size
+        if (invalid is None and raw != raw) or raw == invalid:
+            continue
+        if field.type is FIELD_TYPE_TIMESTAMP.type or field.type.name == "date_time":
+            if raw < MIN_ABSOLUTE_DATE_TIME:
+                continue
+            # Naive UTC datetime, like fitparse
+            value = datetime.datetime.fromtimestamp(
+                raw + UTC_REFERENCE, datetime.timezone.utc
+            ).replace(tzinfo=None)
+        elif isinstance(field.type, BaseType):
+            value = raw
+            if field.scale:
+                value = value / field.scale
+            if field.offset:
+                value = value - field.offset
+        else:
+            value = field.type.values.get(raw, raw)
+        values[field.name] = value
+    return values
+
+
+def _record_field_names(
+    definition: _Definition,
+    dev_fields: Dict[Tuple[int, int], Tuple[str, Optional[str], int]],
+) -> List[str]:
+    """Get the names of the fields of a record definition, as fitparse names them."""
+    profile = MESSAGE_TYPES[RECORD_MESG_NUM].fields
+    names = []
+    for number, _, _ in definition.fields:
+        field = profile.get(number)
+        names.append("unknown_%d" % number if field is None else field.name)
+    for number, _, index in definition.dev_fields:
+        description = dev_fields.get((index, number))
+        if description is not None:
+            names.append(description[0])
+    return names
+
+
+def _parse_definition(
+    data: bytes, pos: int, has_dev_fields: bool
+) -> Tuple[_Definition, int]:
+    endian = ">" if data[pos + 2] else "<"
+    mesg_num, num_fields = struct.unpack_from(endian + "HB", data, pos + 3)
+    pos += 6
+    fields = list(zip(*[iter(data[pos : pos + 3 * num_fields])] * 3))
+    pos += 3 * num_fields
+    dev_fields = []
+    if has_dev_fields:
+        num_dev_fields = data[pos]
+        pos += 1
+        dev_fields = list(zip(*[iter(data[pos : pos + 3 * num_dev_fields])] * 3))
+        pos += 3 * num_dev_fields
+    size = sum(size for _, size, _ in fields) + sum(size for _, size, _ in dev_fields)
+    return _Definition(mesg_num, endian, fields, dev_fields, size), pos
+
+
+def _parse_field_description(
+    data: bytes, pos: int, definition: _Definition
+) -> Tuple[int, int, Tuple[str, Optional[str], int]]:
+    raw = {}
+    for number, size, _ in definition.fields:
+        raw[number] = data[pos : pos + size]
+        pos += size
+    index = raw[0][0]
+    number = raw[1][0]
+    base_type_id = raw[2][0]
+    name = _parse_string(raw.get(3, b"")) or "unnamed_dev_field_%s" % number
+    units = _parse_string(raw.get(8, b""))
+    return index, number, (name, units, base_type_id)
+
+
+def _parse_string(raw: bytes) -> Optional[str]:
+    return raw.split(b"\x00", 1)[0].decode("utf-8", errors="replace") or None
+
+
+def _record_layout(
+    definition: _Definition,
+    dev_fields: Dict[Tuple[int, int], Tuple[str, Optional[str], int]],
+    names: Optional[Set[str]],
+) -> _RecordLayout:
+    """Build the structured dtype of a record data message (header byte included).
+
+    Only the fields in names (all fields if None) get a place in the dtype, so the other fields
+    are never decoded. They are still listed, with key None, for their units.
+    """
+    keys = []
+    formats = []
+    offsets = []
+    columns = []
+    offset = 1
+    profile = MESSAGE_TYPES[RECORD_MESG_NUM].fields
+
+    def add(name, units, size, base_type_id, scale, field_offset, is_date_time):
+        if any(column.name == name for column in columns):
+            raise UnsupportedFitFileError("Field %s is defined twice" % name)
+        # Named like fitparse names them, which treats unknown base types as bytes
+        base_type = FIT_BASE_TYPES.get(base_type_id, BASE_TYPE_BYTE).name
+        if names is not None and name not in names:
+            columns.append(
+                _Column(name, units, base_type, None, None, None, None, False)
+            )
+            return
+        if base_type_id not in BASE_TYPES:
+            raise UnsupportedFitFileError("Field %s has a non-numeric type" % name)
+        dtype, invalid = BASE_TYPES[base_type_id]
+        if np.dtype(dtype).itemsize != size:
+            raise UnsupportedFitFileError("Field %s is an array" % name)
+        key = "f%d" % len(keys)
+        keys.append(key)
+        formats.append(definition.endian + dtype)
+        offsets.append(offset)
+        columns.append(
+            _Column(
+                name,
+                units,
+                base_type,
+                key,
+                invalid,
+                scale,
+                field_offset,
+                is_date_time,
+            )
+        )
+
+    for number, size, base_type_id in definition.fields:
+        field = profile.get(number)
+        if field is None:
+            add("unknown_%d" % number, None, size, base_type_id, None, None, False)
+        elif field.components or field.subfields:
+            # Components add fields to the record, so even the field names would be wrong
+            raise UnsupportedFitFileError("Field %s has components" % field.name)
+        elif field.type is FIELD_TYPE_TIMESTAMP.type:
+            add(field.name, None, size, base_type_id, None, None, True)
+        elif isinstance(field.type, BaseType):
+            add(
+                field.name,
+                field.units,
+                size,
+                base_type_id,
+                field.scale,
+                field.offset,
+                False,
+            )
+        elif names is not None and field.name not in names:
+            add(field.name, field.units, size, base_type_id, None, None, False)
+        else:
+            raise UnsupportedFitFileError(
+                "Field %s has type %s" % (field.name, field.type.name)
+            )
+        offset += size
+    for number, size, index in definition.dev_fields:
+        if (index, number) not in dev_fields:
+            raise UnsupportedFitFileError(
+                "No description for developer field %d of %d" % (number, index)
+            )
+        name, units, base_type_id = dev_fields[(index, number)]
+        # Like fitparse, developer fields are not scaled
+        add(name, units, size, base_type_id, None, None, False)
+        offset += size
+
+    dtype = np.dtype(
+        dict(
+            names=keys,
+            formats=formats,
+            offsets=offsets,
+            itemsize=1 + definition.size,
+        )
+    )
+    return _RecordLayout(dtype, columns)
+
+
+def _decode_column(raw: np.ndarray, column: _Column) -> Tuple[np.ndarray, np.ndarray]:
+    if column.invalid is None:
+        valid = ~np.isnan(raw)
+    else:
+        valid = raw != column.invalid
+    if column.is_date_time:
+        if np.any(raw[valid] < MIN_ABSOLUTE_DATE_TIME):
+            raise UnsupportedFitFileError("Relative date_time in %s" % column.name)
+        values = (raw.astype(np.int64) + UTC_REFERENCE).astype("datetime64[s]")
+    elif raw.dtype.kind == "f":
+        values = raw.astype(np.float64)
+    else:
+        values = raw.astype(np.int64)
+    if column.scale:
+        values = values / column.scale
+    if column.offset:
+        values = values - column.offset
+    return values, valid
+
+
+def _assemble(
+    chunks: List[Tuple[np.ndarray, np.ndarray, np.ndarray]], length: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Scatter the decoded chunks of a field into one length-long column."""
+    valid = np.zeros(length, dtype=bool)
+    for rows, _, chunk_valid in chunks:
+        valid[rows] = chunk_valid
+    if not valid.any():
+        return np.full(length, np.nan), valid
+    dtype = np.result_type(*[values.dtype for _, values, _ in chunks])
+    if dtype.kind == "M":
+        filler = np.datetime64("NaT")
+    elif dtype.kind == "f":
+        filler = np.nan
+    else:
+        filler = 0
+    column = np.full(length, filler, dtype=dtype)
+    for rows, values, _ in chunks:
+        column[rows] = values
+    column[~valid] = filler
+    return column, valid
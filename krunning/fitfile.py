@@ -1,24 +1,71 @@
+import datetime
+import multiprocessing
+import tempfile
+from contextlib import ExitStack
 import fitparse
+import numpy as np
 import pandas as pd
-from typing import Dict, List, Optional, Iterator, Any
+from typing import Callable, Dict, List, Optional, Iterator, Any, Tuple
+
+from .fitcache import FitCache
+from .manifest import FileManifest
+from .fitdecode import FitColumns, UnsupportedFitFileError, decode_records
+
+# Number of records handed at once to the where predicate of read_columns
+CHUNK_SIZE = 4096
+
+# Smallest NumPy dtype holding the integer values of each fit base type
+COMPACT_INTEGER_DTYPES = {
+    "enum": np.uint8,
+    "byte": np.uint8,
+    "sint8": np.int8,
+    "uint8": np.uint8,
+    "uint8z": np.uint8,
+    "sint16": np.int16,
+    "uint16": np.uint16,
+    "uint16z": np.uint16,
+    "sint32": np.int32,
+    "uint32": np.uint32,
+    "uint32z": np.uint32,
+    "sint64": np.int64,
+    "uint64": np.uint64,
+    "uint64z": np.uint64,
+}
 
 
 class FitFile:
     """Used to read Garmin's raw fit file."""
 
-    def __init__(self, path: str):
+    def __init__(
+        self, path: str, native: bool = False, cache: Optional[FitCache] = None
+    ):
         """Open fit file
 
         Args:
             path: Path to the .fit file
+            native: decode record messages with the built-in NumPy decoder (see
+                krunning.fitdecode) instead of fitparse, falling back to fitparse for
+                files it does not support
+            cache: read decoded records from this cache (memory-mapped) when the file is in it.
+                Otherwise every record field is decoded once and stored in the cache.
         """
-        self.__fitfile = fitparse.FitFile(path)
-        self.__fields = None
-        self.__length = None
+        self.__path = path
+        self.__native = native
+        self.__cache = cache
+        self.__fitfile = None
+        self.__columns = None
+
+    @property
+    def __parser(self) -> fitparse.FitFile:
+        """fitparse's reader, only opened when records can't come from elsewhere."""
+        if self.__fitfile is None:
+            self.__fitfile = fitparse.FitFile(self.__path)
+        return self.__fitfile
 
     def close(self):
         """Close the fit file."""
-        self.__fitfile.close()
+        if self.__fitfile is not None:
+            self.__fitfile.close()
 
     def __enter__(self):
         return self
@@ -26,16 +73,132 @@ class FitFile:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
-    def __populate(self):
-        """Populate lazily populated fields."""
-        fields = {}
+    def __populate(self, names: Optional[List[str]] = None):
+        """Populate lazily populated fields by decoding every record in a single pass.
+
+        Args:
+            names: only decode and keep these fields. If not specified, decodes all fields.
+                The units and the number of records are populated either way.
+        """
+        columns = self.__decode(names)
+        if self.__columns is None:
+            self.__columns = columns
+        else:
+            self.__columns.values.update(columns.values)
+            self.__columns.valid.update(columns.valid)
+
+    def __decode(self, names: Optional[List[str]]) -> FitColumns:
+        if self.__cache is not None:
+            columns = self.__cache.load(self.__path)
+            if columns is None:
+                columns = self.__decode_file(None)
+                self.__cache.store(self.__path, columns)
+            if names is None:
+                return columns
+            return FitColumns(
+                length=columns.length,
+                values={n: columns.values[n] for n in names if n in columns.values},
+                valid={n: columns.valid[n] for n in names if n in columns.valid},
+                units=columns.units,
+                base_types=columns.base_types,
+            )
+        return self.__decode_file(names)
+
+    def __decode_native(self, names: Optional[List[str]]) -> Optional[FitColumns]:
+        """Decode with the built-in decoder, None if disabled or unsupported by the file."""
+        if not self.__native:
+            return None
+        with open(self.__path, "rb") as f:
+            data = f.read()
+        try:
+            return decode_records(data, names)
+        except UnsupportedFitFileError:
+            return None
+
+    def __decode_file(self, names: Optional[List[str]]) -> FitColumns:
+        columns = self.__decode_native(names)
+        if columns is not None:
+            return columns
+        wanted = None if names is None else set(names)
+        rows: Dict[str, List[int]] = {}
+        values: Dict[str, List[Any]] = {}
+        units: Dict[str, Optional[str]] = {}
+        base_types: Dict[str, str] = {}
         i = 0
-        for record in self.__fitfile.get_messages("record"):
-            i += 1
+        for i, record in enumerate(self.__parser.get_messages("record"), 1):
             for record_data in record:
-                fields[record_data.name] = record_data.units
-        self.__fields = fields
-        self.__length = i
+                name = record_data.name
+                if name not in units:
+                    units[name] = record_data.units
+                    base_types[name] = record_data.base_type.name
+                    rows[name] = []
+                    values[name] = []
+                if record_data.value is not None and (wanted is None or name in wanted):
+                    rows[name].append(i - 1)
+                    values[name].append(record_data.value)
+        columns = {
+            name: _build_column(rows[name], values[name], i)
+            for name in units
+            if wanted is None or name in wanted
+        }
+        return FitColumns(
+            length=i,
+            values={name: column for name, (column, _) in columns.items()},
+            valid={name: valid for name, (_, valid) in columns.items()},
+            units=units,
+            base_types=base_types,
+        )
+
+    def __decode_chunks(self, names: List[str]) -> Iterator[FitColumns]:
+        """Decode the requested fields of consecutive chunks of CHUNK_SIZE records.
+
+        Cached and natively decoded columns are sliced. Otherwise records are parsed with
+        fitparse one chunk at a time, so only a chunk of records is held in memory. Once
+        done, the units and the number of records are populated.
+        """
+        if self.__cache is not None:
+            columns = self.__decode(names)
+        else:
+            columns = self.__decode_native(names)
+        if columns is not None:
+            for name in names:
+                if name not in columns.units:
+                    raise KeyError(name)
+            yield from _split_columns(columns)
+            length, units, base_types = (
+                columns.length,
+                columns.units,
+                columns.base_types,
+            )
+        else:
+            wanted = set(names)
+            units: Dict[str, Optional[str]] = {}
+            base_types: Dict[str, str] = {}
+            rows: Dict[str, List[int]] = {name: [] for name in names}
+            values: Dict[str, List[Any]] = {name: [] for name in names}
+            start = length = 0
+            for length, record in enumerate(self.__parser.get_messages("record"), 1):
+                for record_data in record:
+                    name = record_data.name
+                    if name not in units:
+                        units[name] = record_data.units
+                        base_types[name] = record_data.base_type.name
+                    if record_data.value is not None and name in wanted:
+                        rows[name].append(length - 1 - start)
+                        values[name].append(record_data.value)
+                if length - start == CHUNK_SIZE:
+                    yield _parsed_chunk(rows, values, length - start, units, base_types)
+                    start = length
+            # An empty file still gets one (empty) chunk
+            if length > start or length == 0:
+                yield _parsed_chunk(rows, values, length - start, units, base_types)
+            for name in names:
+                if name not in units:
+                    raise KeyError(name)
+        if self.__columns is None:
+            self.__columns = FitColumns(
+                length=length, values={}, valid={}, units=units, base_types=base_types
+            )
 
     @property
     def fields(self) -> Dict[str, Optional[str]]:
@@ -46,15 +209,73 @@ class FitFile:
         Returns:
             dictionary mapping field name to unit. Fields without units will have unit, None
         """
-        if self.__fields is None:
-            self.__populate()
-        return self.__fields
+        if self.__columns is None:
+            self.__populate([])
+        return self.__columns.units
 
     def __len__(self) -> int:
         """Get the number of records in the fit file"""
-        if self.__length is None:
-            self.__populate()
-        return self.__length
+        if self.__columns is None:
+            self.__populate([])
+        return self.__columns.length
+
+    def read_columns(
+        self,
+        names: Optional[List[str]] = None,
+        where: Optional[Callable[[FitColumns], np.ndarray]] = None,
+    ) -> FitColumns:
+        """Decode the records into one typed array per field.
+
+        Only the requested fields are decoded and kept, so memory and parse time scale with
+        the fields you ask for. Decoded columns are kept for later calls, except with where:
+        records are then filtered chunk by chunk as they are decoded, and only the kept
+        records are held on to.
+
+        Args:
+            names: field names you want to load. If not specified, loads all fields available in the fitfile
+            where: predicate evaluated on consecutive chunks of records, in order. It receives the
+                requested fields of a chunk and returns a boolean mask of the records to keep. It
+                may add derived columns to the chunk's values and valid dictionaries; they are
+                kept alongside the requested fields.
+
+        Returns:
+            FitColumns with the requested fields, only for the records kept by where
+        """
+        if where is not None and names is not None and not self.__decoded(names):
+            return _filter_chunks(self.__decode_chunks(names), where)
+        if self.__columns is None:
+            self.__populate(names)
+        if names is None:
+            names = list(self.__columns.units)
+        missing = [
+            name
+            for name in names
+            if name in self.__columns.units and name not in self.__columns.values
+        ]
+        if len(missing) > 0:
+            self.__populate(missing)
+        for name in names:
+            if name not in self.__columns.units:
+                raise KeyError(name)
+        columns = FitColumns(
+            length=self.__columns.length,
+            values={name: self.__columns.values[name] for name in names},
+            valid={name: self.__columns.valid[name] for name in names},
+            units=self.__columns.units,
+            base_types=self.__columns.base_types,
+        )
+        if where is not None:
+            columns = _filter_chunks(_split_columns(columns), where)
+        return columns
+
+    def __decoded(self, names: List[str]) -> bool:
+        """Whether the fields are decoded and kept already."""
+        if self.__columns is None:
+            return False
+        return all(
+            name in self.__columns.values or name not in self.__columns.units
+            for name in names
+        )
 
     def get_fields(self, names: List[str]) -> Iterator[List[Any]]:
         """Generate a list of records. Each yielded list will be parallel to the list of field names you request.
@@ -69,7 +290,7 @@ class FitFile:
             if name not in self.fields:
                 raise KeyError(name)
         class_map = {name: i for i, name in enumerate(names)}
-        for record in self.__fitfile.get_messages("record"):
+        for record in self.__parser.get_messages("record"):
             out = [None for _ in class_map]
             for record_data in record:
                 if record_data.name in class_map:
@@ -78,21 +299,263 @@ class FitFile:
 
 
 def load_pandas_from_fitfile(
-    fitfile: FitFile, fields: Optional[List[str]] = None
+    fitfile: FitFile, fields: Optional[List[str]] = None, typed: bool = False
 ) -> pd.DataFrame:
     """Load records from a fit file into a pandas DataFrame.
 
     Args:
         fitfile: the fit file to load from
         fields: only load these fields. If not specified, loads all fields available in the fitfile
+        typed: store each column in the smallest dtype holding its fit base type (uint8 heart rate,
+            uint16 power, float32 speed...), with pandas nullable integer dtypes for gaps, and
+            timestamps as int64 seconds since the Unix epoch.
 
     Returns:
         pd.DataFrame containing fit file records
     """
+    columns = fitfile.read_columns(fields)
     if fields is None:
-        fields = sorted(fitfile.fields)
-    data = {field: [] for field in fields}
-    for record in fitfile.get_fields(fields):
-        for key, value in zip(fields, record):
-            data[key].append(value)
-    return pd.DataFrame(data)
+        fields = sorted(columns.units)
+    data = {}
+    for field in fields:
+        column = columns.values[field]
+        valid = columns.valid[field]
+        if typed:
+            column = _compact_column(column, valid, columns.base_types[field])
+        elif column.dtype.kind in "iu" and not valid.all():
+            # Integer columns with gaps become floats with NaNs, like pandas does for None
+            column = np.where(valid, column, np.nan)
+        data[field] = column
+    return pd.DataFrame(data, index=pd.RangeIndex(columns.length))
+
+
+def load_many(
+    paths: List[str],
+    fields: Optional[List[str]] = None,
+    workers: Optional[int] = None,
+    cache: Optional[FitCache] = None,
+    native: bool = True,
+    ordered: bool = True,
+) -> Iterator[Tuple[str, FitColumns]]:
+    """Decode many fit files in a process pool.
+
+    Workers decode each file into the cache, and the columns are memory-mapped from it in this
+    process, so decoded arrays are never pickled between processes. Workers send back the
+    content hashes they computed, which are recorded in the cache's manifest, saved once.
+
+    Args:
+        paths: paths to the .fit files
+        fields: only load these fields. If not specified, loads all fields available in each fitfile
+        workers: number of processes. Defaults to the number of CPUs. With 1, files are
+            decoded in this process.
+        cache: cache to decode into. If not specified, a temporary cache is used, and removed
+            once every file has been yielded
+        native: decode with the built-in NumPy decoder, see FitFile
+        ordered: yield files in the order of paths. Otherwise, yield them as they complete
+
+    Yields:
+        (path, FitColumns) for every fit file
+    """
+    with ExitStack() as stack:
+        if cache is None:
+            cache = FitCache(stack.enter_context(tempfile.TemporaryDirectory()))
+        jobs = [
+            (path, native, cache.directory, cache.manifest.entry(path))
+            for path in paths
+        ]
+        if workers == 1:
+            done = map(_cache_fitfile, jobs)
+        else:
+            pool = stack.enter_context(multiprocessing.Pool(workers))
+            if ordered:
+                done = pool.imap(_cache_fitfile, jobs)
+            else:
+                done = pool.imap_unordered(_cache_fitfile, jobs)
+        manifest = stack.enter_context(cache.manifest.batch())
+        for path, entry in done:
+            manifest.record(path, entry)
+            with FitFile(path, cache=cache) as fitfile:
+                yield path, fitfile.read_columns(fields)
+
+
+def _cache_fitfile(
+    job: Tuple[str, bool, str, Optional[Dict[str, object]]],
+) -> Tuple[str, Dict[str, object]]:
+    """Decode a fit file into a cache directory (runs in load_many's workers).
+
+    Returns:
+        (path, entry of the file in the manifest), for load_many to record
+    """
+    path, native, cache_directory, entry = job
+    # Hashes are recorded by load_many, so workers don't race to save the manifest
+    manifest = FileManifest(None)
+    if entry is not None:
+        manifest.record(path, entry)
+    cache = FitCache(cache_directory, manifest=manifest)
+    with FitFile(path, native=native, cache=cache) as fitfile:
+        len(fitfile)
+    return path, manifest.entry(path)
+
+
+def _compact_column(column: np.ndarray, valid: np.ndarray, base_type: str):
+    """Convert a decoded column to the smallest dtype holding its values.
+
+    Args:
+        column: decoded values
+        valid: validity mask of the values
+        base_type: name of the field's fit base type
+
+    Returns:
+        ndarray, or pandas IntegerArray for integer columns with gaps
+    """
+    if column.dtype.kind == "M":
+        column = column.astype("datetime64[s]").astype(np.int64)
+    elif column.dtype.kind == "f":
+        # Floats keep NaN for gaps
+        if base_type == "float64":
+            return column.astype(np.float64)
+        return column.astype(np.float32)
+    elif column.dtype.kind in "iu":
+        dtype = COMPACT_INTEGER_DTYPES.get(base_type, np.int64)
+        if len(column) > 0:
+            # An offset may have moved the values out of the base type's range
+            limits = np.iinfo(dtype)
+            if column.min() < limits.min or column.max() > limits.max:
+                dtype = np.int64
+        column = column.astype(dtype)
+    else:
+        return column
+    if valid.all():
+        return column
+    return pd.arrays.IntegerArray(column, mask=~valid)
+
+
+def _split_columns(columns: FitColumns) -> Iterator[FitColumns]:
+    """Split decoded records into consecutive chunks of CHUNK_SIZE records."""
+    # An empty file still gets one (empty) chunk, so derived columns are always present
+    for start in range(0, max(columns.length, 1), CHUNK_SIZE):
+        stop = min(start + CHUNK_SIZE, columns.length)
+        yield FitColumns(
+            length=stop - start,
+            values={
+                name: column[start:stop] for name, column in columns.values.items()
+            },
+            valid={name: column[start:stop] for name, column in columns.valid.items()},
+            units=columns.units,
+            base_types=columns.base_types,
+        )
+
+
+def _parsed_chunk(
+    rows: Dict[str, List[int]],
+    values: Dict[str, List[Any]],
+    length: int,
+    units: Dict[str, Optional[str]],
+    base_types: Dict[str, str],
+) -> FitColumns:
+    """Build a chunk of records parsed by fitparse, emptying the rows and values lists."""
+    columns = {name: _build_column(rows[name], values[name], length) for name in rows}
+    for name in rows:
+        rows[name] = []
+        values[name] = []
+    return FitColumns(
+        length=length,
+        values={name: column for name, (column, _) in columns.items()},
+        valid={name: valid for name, (_, valid) in columns.items()},
+        units=units,
+        base_types=base_types,
+    )
+
+
+def _filter_chunks(
+    chunks: Iterator[FitColumns], where: Callable[[FitColumns], np.ndarray]
+) -> FitColumns:
+    """Keep the records of each chunk accepted by the where predicate.
+
+    Args:
+        chunks: consecutive chunks of decoded records
+        where: predicate, see FitFile.read_columns
+
+    Returns:
+        FitColumns with the kept records, including columns derived by the predicate
+    """
+    values: Dict[str, List[np.ndarray]] = {}
+    valid: Dict[str, List[np.ndarray]] = {}
+    length = 0
+    chunk = None
+    for chunk in chunks:
+        mask = np.asarray(where(chunk), dtype=bool)
+        for name in chunk.values:
+            values.setdefault(name, []).append(chunk.values[name][mask])
+            valid.setdefault(name, []).append(chunk.valid[name][mask])
+        length += int(np.count_nonzero(mask))
+    return FitColumns(
+        length=length,
+        values={
+            name: _concatenate_column(values[name], valid[name]) for name in values
+        },
+        valid={name: np.concatenate(masks) for name, masks in valid.items()},
+        units=chunk.units,
+        base_types=chunk.base_types,
+    )
+
+
+def _concatenate_column(columns: List[np.ndarray], valid: List[np.ndarray]):
+    """Concatenate the chunks of a column.
+
+    Chunks parsed by fitparse without any value for the field are typed as floats. They
+    take the type of the other chunks, so e.g. timestamps stay datetimes.
+    """
+    typed = [column for column, mask in zip(columns, valid) if mask.any()]
+    dtypes = {column.dtype for column in typed}
+    if len(typed) == 0 or {column.dtype for column in columns} == dtypes:
+        return np.concatenate(columns)
+    if any(dtype.kind == "M" for dtype in dtypes):
+        dtype, fill = np.dtype("datetime64[s]"), np.datetime64("NaT")
+    elif any(dtype == object for dtype in dtypes):
+        dtype, fill = np.dtype(object), None
+    else:
+        dtype = np.result_type(*dtypes)
+        fill = np.nan if dtype.kind == "f" else 0
+    return np.concatenate(
+        [
+            column.astype(dtype) if mask.any() else np.full(len(column), fill, dtype)
+            for column, mask in zip(columns, valid)
+        ]
+    )
+
+
+def _build_column(rows: List[int], values: List[Any], length: int):
+    """Scatter the values of a field into a typed array with a validity mask.
+
+    Args:
+        rows: index of the record each value belongs to
+        values: non-None values of the field
+        length: number of records
+
+    Returns:
+        (column, valid) arrays, each length long
+    """
+    valid = np.zeros(length, dtype=bool)
+    valid[rows] = True
+    if len(values) == 0:
+        return np.full(length, np.nan), valid
+    if all(isinstance(value, datetime.datetime) for value in values):
+        column = np.full(length, np.datetime64("NaT"), dtype="datetime64[s]")
+        column[rows] = np.array(values, dtype="datetime64[s]")
+        return column, valid
+    if all(
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+        for value in values
+    ):
+        dense = np.array(values)
+        if dense.dtype.kind == "f":
+            column = np.full(length, np.nan)
+        else:
+            column = np.zeros(length, dtype=np.int64)
+        column[rows] = dense
+        return column, valid
+    column = np.full(length, None, dtype=object)
+    for row, value in zip(rows, values):
+        column[row] = value
+    return column, valid
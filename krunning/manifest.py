@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+
+class FileManifest:
+    """Content hashes of files, so caches can tell when a file changed.
+
+    A manifest.json maps each file's absolute path to its size, modification time and content
+    hash. Files with the same size and mtime as recorded are taken as unchanged without being
+    read, and the others are hashed again. So caches keyed on the hash are both cheap to
+    validate and invalidated by edited or re-downloaded files.
+
+    The manifest is saved after each newly hashed file, or once at the end of a batch.
+    """
+
+    def __init__(self, path: Optional[str]):
+        """
+        Args:
+            path: path to the manifest.json. None keeps the manifest in memory only
+        """
+        directory = None
+        if path is not None:
+            directory = os.path.dirname(path) or "."
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.__directory = directory
+        self.__entries: Optional[Dict[str, Dict[str, object]]] = None
+        self.__dirty = False
+        self.__batches = 0
+
+    def __load(self) -> Dict[str, Dict[str, object]]:
+        if self.__entries is None:
+            self.__entries = {}
+            if self.path is not None and os.path.exists(self.path):
+                with open(self.path, "r") as f:
+                    self.__entries = json.load(f)
+        return self.__entries
+
+    def flush(self):
+        """Save the manifest if files were hashed since it was last saved."""
+        if not self.__dirty or self.path is None:
+            return
+        # Write to a temporary file first, so readers never see a partial manifest
+        fd, temp_path = tempfile.mkstemp(dir=self.__directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.__entries, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+        self.__dirty = False
+
+    @contextmanager
+    def batch(self) -> Iterator["FileManifest"]:
+        """Save the manifest once at the end of the block, rather than after each file."""
+        self.__batches += 1
+        try:
+            yield self
+        finally:
+            self.__batches -= 1
+            if self.__batches == 0:
+                self.flush()
+
+    def entry(self, path: str) -> Optional[Dict[str, object]]:
+        """Get the size, mtime_ns and sha1 recorded for a file, None if never hashed."""
+        return self.__load().get(os.path.abspath(path))
+
+    def record(self, path: str, entry: Dict[str, object]):
+        """Record the size, mtime_ns and sha1 of a file hashed elsewhere, e.g. by a worker.
+
+        Args:
+            path: path to the file
+            entry: entry of the file in the manifest that hashed it, see entry
+        """
+        key = os.path.abspath(path)
+        entries = self.__load()
+        if entries.get(key) != entry:
+            entries[key] = dict(entry)
+            self.__dirty = True
+            if self.__batches == 0:
+                self.flush()
+
+    def fingerprint(self, path: str) -> str:
+        """Get the content hash of a file, only reading it if its size or mtime changed.
+
+        Args:
+            path: path to the file
+
+        Returns:
+            hex SHA-1 of the file's content
+        """
+        entries = self.__load()
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = entries.get(key)
+        if (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return entry["sha1"]
+        sha1 = hashlib.sha1()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha1.update(block)
+        entries[key] = dict(
+            size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha1=sha1.hexdigest()
+        )
+        self.__dirty = True
+        if self.__batches == 0:
+            self.flush()
+        return entries[key]["sha1"]
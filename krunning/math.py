@@ -1,6 +1,28 @@
+import bisect
 import numpy as np
 import pandas as pd
-from typing import Tuple, Union
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+# Statistics supported by rolling_statistic
+ROLLING_STATISTICS = ("mean", "max", "min", "std", "median", "quantile")
+
+# Windows of at most this many samples are sorted all at once in NumPy, larger ones
+# are kept sorted incrementally while sliding
+SORTED_WINDOW_BATCH_MAX_SAMPLES = 32
+
+# Largest number of sliding windows evaluated at once by mean_maximal_power
+MEAN_MAXIMAL_BATCH_WINDOWS = 1 << 22
+
+
+class MeanMaximalPower(NamedTuple):
+    """Best average of a series for each window duration."""
+
+    # D int ndarray. durations, in samples
+    durations: np.ndarray
+    # D float ndarray. best average over a window of each duration, NaN if the series is shorter
+    power: np.ndarray
+    # D int ndarray. index of the first sample of the best window, -1 if the series is shorter
+    start: np.ndarray
 
 
 def smooth_sliding_time_window(
@@ -8,32 +30,658 @@ def smooth_sliding_time_window(
 ) -> np.ndarray:
     """Smooth a time series using a trailing time-window (so could be used in an online fashion).
 
+    Each output sample is the mean of the samples at most `window` seconds older than it.
+
+    Args:
+        time: T ndarray. timestamps of samples, in seconds, in increasing order
+        series: T ndarray, or TxC ndarray to smooth C channels sharing the same timestamps.
+            value of samples
+        window: size of window, in seconds
+
+    Returns:
+        ndarray with the shape and dtype of series. Smoothed series
+    """
+    time = np.asarray(time)
+    series = np.asarray(series)
+    if series.shape[:1] != time.shape:
+        raise ValueError(
+            "Series of shape %r doesn't match %d timestamps"
+            % (series.shape, time.shape[0])
+        )
+    start = sliding_window_start(time, window)
+    out = _rolling_mean(series, start)
+    return out.astype(series.dtype, copy=False)
+
+
+def sliding_window_start(time: np.ndarray, window: Union[int, float]) -> np.ndarray:
+    """Get the first sample of the trailing time-window ending at each sample.
+
     Args:
-        time: T ndarray. timestamps of samples, in seconds
-        series: T ndarray. value of samples
+        time: T ndarray. timestamps of samples, in seconds, in increasing order
         window: size of window, in seconds
 
     Returns:
-        T ndarray. Smoothed series
+        T int ndarray. index of the oldest sample at most `window` seconds older than each sample
+    """
+    time = np.asarray(time)
+    index = np.arange(time.shape[0])
+    start = np.minimum(np.searchsorted(time, time - window, side="left"), index)
+    # time - window may round differently than the differences of timestamps, so nudge the
+    # boundaries to match `now - time[start] <= window` exactly. Nudges move over every
+    # sample sharing the boundary's timestamp
+    while True:
+        before = np.maximum(start - 1, 0)
+        earlier = (start > 0) & (time - time[before] <= window)
+        if not earlier.any():
+            break
+        first = np.searchsorted(time, time[before], side="left")
+        start = np.where(earlier, first, start)
+    while True:
+        later = time - time[start] > window
+        if not later.any():
+            break
+        after = np.minimum(np.searchsorted(time, time[start], side="right"), index)
+        start = np.where(later, after, start)
+    return start
+
+
+def rolling_statistic(
+    time: np.ndarray,
+    series: np.ndarray,
+    window: Union[int, float],
+    statistic: str = "mean",
+    q: float = 0.5,
+    ddof: int = 0,
+) -> np.ndarray:
+    """Compute a statistic over a trailing time-window at every sample of a time series.
+
+    Windows are the same as in smooth_sliding_time_window: the samples at most `window`
+    seconds older than each sample, so timestamps don't need to be regularly spaced.
+
+    Args:
+        time: T ndarray. timestamps of samples, in seconds, in increasing order
+        series: T ndarray, or TxC ndarray to compute the statistic on C channels at once.
+            value of samples
+        window: size of window, in seconds
+        statistic: one of ROLLING_STATISTICS
+        q: quantile to compute, between 0 and 1, for the "quantile" statistic
+        ddof: delta degrees of freedom of the "std" statistic. Windows with at most ddof
+            samples get NaN
+
+    Returns:
+        ndarray with the shape of series. Float, except for "max" and "min" which keep the
+        dtype of series
+    """
+    if statistic not in ROLLING_STATISTICS:
+        raise ValueError(
+            "Unknown statistic %r, expected one of %s"
+            % (statistic, ", ".join(ROLLING_STATISTICS))
+        )
+    if statistic == "quantile" and not 0 <= q <= 1:
+        raise ValueError("Quantile %r is not between 0 and 1" % q)
+    time = np.asarray(time)
+    series = np.asarray(series)
+    if series.shape[:1] != time.shape:
+        raise ValueError(
+            "Series of shape %r doesn't match %d timestamps"
+            % (series.shape, time.shape[0])
+        )
+    start = sliding_window_start(time, window)
+    if statistic == "mean":
+        return _rolling_mean(series, start)
+    if statistic == "max":
+        return _rolling_extreme(series, start, np.maximum)
+    if statistic == "min":
+        return _rolling_extreme(series, start, np.minimum)
+    if statistic == "std":
+        return _rolling_std(series, start, ddof)
+    if statistic == "median":
+        q = 0.5
+    if series.ndim == 1:
+        return _rolling_quantile(series, start, q)
+    # Quantiles are computed one channel at a time
+    channels = series.reshape((series.shape[0], -1))
+    out = np.stack(
+        [_rolling_quantile(channel, start, q) for channel in channels.T], axis=1
+    )
+    return out.reshape(series.shape)
+
+
+def _window_lengths(start: np.ndarray, ndim: int) -> np.ndarray:
+    """Get the number of samples in each window, shaped to broadcast against the series."""
+    length = np.arange(1, start.shape[0] + 1) - start
+    return length.reshape((-1,) + (1,) * (ndim - 1))
+
+
+def _window_sums(series: np.ndarray, start: np.ndarray) -> np.ndarray:
+    """Sum the samples of each window as a difference of prefix sums."""
+    # Leading zero, so the window ending at i sums totals[i + 1] - totals[start]
+    totals = np.zeros((series.shape[0] + 1,) + series.shape[1:])
+    np.cumsum(series, axis=0, out=totals[1:])
+    return totals[1:] - totals[start]
+
+
+def _rolling_mean(series: np.ndarray, start: np.ndarray) -> np.ndarray:
+    return _window_sums(series, start) / _window_lengths(start, series.ndim)
+
+
+def _rolling_std(series: np.ndarray, start: np.ndarray, ddof: int) -> np.ndarray:
+    """Standard deviation of each window, merging the statistics of power-of-two blocks.
+
+    Level k of the table holds the mean and the sum of squared deviations of the 2**k
+    samples from each index. A window is split into one block per set bit of its length,
+    and the blocks are merged with Chan's parallel update, so sums of squares of the raw
+    values are never subtracted.
     """
-    out = np.zeros_like(series)
-    total = 0
-    length = 0
-    start = 0
-    for i in range(time.shape[0]):
-        total += series[i]
-        length += 1
-        now = time[i]
-        while now - time[start] > window:
-            total -= series[start]
-            length -= 1
-            start += 1
-        assert length == i - start + 1
-        out[i] = total / length
+    series = series.astype(np.float64)
+    out = np.empty(series.shape)
+    if series.shape[0] == 0:
+        return out
+    length = np.arange(1, series.shape[0] + 1) - start
+    # Count, mean and sum of squared deviations of the blocks merged so far
+    count = np.zeros(series.shape[0])
+    mean = np.zeros(series.shape)
+    squares = np.zeros(series.shape)
+    table_mean = series
+    table_squares = np.zeros(series.shape)
+    span = 1
+    for level in range(int(length.max()).bit_length()):
+        if level > 0:
+            delta = table_mean[span:] - table_mean[:-span]
+            table_squares = (
+                table_squares[:-span] + table_squares[span:] + delta * delta * span / 2
+            )
+            table_mean = table_mean[:-span] + delta / 2
+            span *= 2
+        rows = np.flatnonzero(length & span)
+        # Blocks of the lower bits come first in the window
+        offsets = start[rows] + (length[rows] & (span - 1))
+        shape = (-1,) + (1,) * (series.ndim - 1)
+        before = count[rows].reshape(shape)
+        total = before + span
+        delta = table_mean[offsets] - mean[rows]
+        mean[rows] += delta * span / total
+        squares[rows] += table_squares[offsets] + delta * delta * before * span / total
+        count[rows] += span
+    length = _window_lengths(start, series.ndim)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.where(length > ddof, squares / (length - ddof), np.nan)
+    return np.sqrt(variance)
+
+
+def _rolling_extreme(
+    series: np.ndarray, start: np.ndarray, reduce: Callable
+) -> np.ndarray:
+    """Maximum or minimum of each window, from a sparse table.
+
+    Level k of the table holds the extreme of the 2**k samples from each index, so any
+    window is covered by two, possibly overlapping, entries of a single level.
+    """
+    out = np.empty_like(series)
+    if series.shape[0] == 0:
+        return out
+    end = np.arange(series.shape[0])
+    length = end - start + 1
+    # Level of each window: largest power of two no longer than the window
+    levels = np.frexp(length)[1] - 1
+    table = series
+    span = 1
+    for level in range(levels.max() + 1):
+        if level > 0:
+            table = reduce(table[:-span], table[span:])
+            span *= 2
+        rows = levels == level
+        out[rows] = reduce(table[start[rows]], table[end[rows] - span + 1])
+    return out
+
+
+def _rolling_quantile(series: np.ndarray, start: np.ndarray, q: float) -> np.ndarray:
+    """Quantile of each window of a 1-D series, interpolated linearly like np.quantile."""
+    out = np.empty(series.shape[0])
+    if series.shape[0] == 0:
+        return out
+    length = np.arange(1, series.shape[0] + 1) - start
+    if length.max() <= SORTED_WINDOW_BATCH_MAX_SAMPLES:
+        return _rolling_quantile_batch(series, start, length, q)
+    values = series.tolist()
+    window = []
+    first = 0
+    for i, value in enumerate(values):
+        bisect.insort(window, value)
+        while first < start[i]:
+            del window[bisect.bisect_left(window, values[first])]
+            first += 1
+        position = q * (len(window) - 1)
+        low = int(position)
+        high = min(low + 1, len(window) - 1)
+        out[i] = window[low] + (window[high] - window[low]) * (position - low)
+    return out
+
+
+def _rolling_quantile_batch(
+    series: np.ndarray, start: np.ndarray, length: np.ndarray, q: float
+) -> np.ndarray:
+    """Quantile of each window of a 1-D series, sorting short windows as rows of a matrix."""
+    out = np.empty(series.shape[0])
+    width = length.max()
+    offsets = np.arange(width)
+    # Bound the size of the matrix of windows
+    rows = max(1, (1 << 20) // width)
+    for first in range(0, series.shape[0], rows):
+        last = min(first + rows, series.shape[0])
+        indices = start[first:last, None] + offsets
+        in_window = offsets < length[first:last, None]
+        # Padding sorts after every sample of the window
+        windows = np.where(
+            in_window, series[np.minimum(indices, series.shape[0] - 1)], np.inf
+        )
+        windows.sort(axis=1)
+        position = q * (length[first:last] - 1)
+        low = np.floor(position).astype(np.int64)
+        high = np.minimum(low + 1, length[first:last] - 1)
+        low_values = np.take_along_axis(windows, low[:, None], axis=1)[:, 0]
+        high_values = np.take_along_axis(windows, high[:, None], axis=1)[:, 0]
+        out[first:last] = low_values + (high_values - low_values) * (position - low)
     return out
 
 
-def percentile(x: np.ndarray, percentile: float = 99) -> Tuple[float, float]:
+def log_spaced_durations(max_duration: int, count: int = 100) -> np.ndarray:
+    """Get roughly log-spaced integer durations from 1 to max_duration.
+
+    Args:
+        max_duration: longest duration
+        count: number of durations to spread logarithmically. Fewer are returned when short
+            durations round to the same integer
+
+    Returns:
+        sorted int ndarray of unique durations, including 1 and max_duration
+    """
+    if max_duration < 1:
+        return np.zeros(0, dtype=np.int64)
+    durations = np.round(np.geomspace(1, max_duration, max(count, 2)))
+    return np.unique(durations.astype(np.int64))
+
+
+def mean_maximal_power(
+    power: np.ndarray,
+    durations: Optional[Sequence[int]] = None,
+    exact: bool = False,
+) -> MeanMaximalPower:
+    """Compute the mean-maximal power curve of a regularly sampled series.
+
+    For every duration, finds the window of that many consecutive samples with the highest
+    average. Windows are scored from differences of the cumulative sum of the series, a batch
+    of durations at a time.
+
+    Args:
+        power: T ndarray. samples, at regular intervals (e.g. power every second)
+        durations: window durations to evaluate, in samples. Defaults to log-spaced durations
+            up to the length of the series
+        exact: evaluate every duration from 1 to the length of the series. Ignores durations
+
+    Returns:
+        MeanMaximalPower with the best average and its window for each duration
+    """
+    power = np.asarray(power, dtype=np.float64)
+    length = power.shape[0]
+    if exact:
+        durations = np.arange(1, length + 1)
+    elif durations is None:
+        durations = log_spaced_durations(length)
+    durations = np.asarray(durations, dtype=np.int64)
+    if durations.ndim != 1 or np.any(durations < 1):
+        raise ValueError("Durations must be a list of positive integers")
+    best = np.full(durations.shape[0], np.nan)
+    start = np.full(durations.shape[0], -1, dtype=np.int64)
+    fits = np.flatnonzero(durations <= length)
+    if fits.shape[0] == 0:
+        return MeanMaximalPower(durations=durations, power=best, start=start)
+    totals = np.concatenate([[0], np.cumsum(power)])
+    # Batch similar durations together, so few of their windows are masked out
+    fits = fits[np.argsort(durations[fits], kind="stable")]
+    first = 0
+    while first < fits.shape[0]:
+        # Windows of the shortest duration of the batch; fewer fit for the longer ones
+        width = length - durations[fits[first]] + 1
+        batch = fits[first : first + max(1, MEAN_MAXIMAL_BATCH_WINDOWS // width)]
+        first += batch.shape[0]
+        duration = durations[batch, None]
+        offsets = np.arange(width)
+        # Windows running past the end of the series are clipped, then masked out
+        ends = np.minimum(offsets + duration, length)
+        averages = (totals[ends] - totals[offsets]) / duration
+        averages[offsets + duration > length] = -np.inf
+        start[batch] = np.argmax(averages, axis=1)
+        best[batch] = averages[np.arange(batch.shape[0]), start[batch]]
+    return MeanMaximalPower(durations=durations, power=best, start=start)
+
+
+def best_of_power_curves(curves: Sequence[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """Combine power curves of several activities into their element-wise max.
+
+    Args:
+        curves: float ndarrays of the best average power for durations 1, 2, ... of each
+            activity. Curves may have different lengths
+
+    Returns:
+        (power, index): D float ndarray of the best power for each duration over all curves,
+        where D is the length of the longest curve, and D int ndarray of the curve it comes from
+    """
+    longest = max((len(curve) for curve in curves), default=0)
+    stacked = np.full((len(curves), longest), -np.inf)
+    for i, curve in enumerate(curves):
+        stacked[i, : len(curve)] = np.where(np.isnan(curve), -np.inf, curve)
+    index = np.argmax(stacked, axis=0) if len(curves) > 0 else np.zeros(0, np.int64)
+    power = stacked[index, np.arange(longest)]
+    return power, index
+
+
+class QuantileSketch:
+    """Mergeable streaming sketch of a distribution, to estimate its quantiles.
+
+    KLL-style: values are kept in levels, where each value of level h stands for 2**h samples.
+    When a level grows past its capacity, it is sorted and every other value is promoted to
+    the next level. Capacities shrink geometrically for lower levels, so a sketch holds
+    between k and 2 * k values whatever the number of samples (never more than 3 * k), and
+    estimates every quantile within about 4 / k in rank (2% at the default k of 200), whether
+    it was built by updates or merges.
+
+    Sketches of different series (e.g. one per fit file) can be merged into a sketch of all
+    of them, and are picklable, so they can be cached.
+    """
+
+    def __init__(self, k: int = 200):
+        """
+        Args:
+            k: capacity of the top level. Larger is more accurate, and uses more memory
+        """
+        if k < 2:
+            raise ValueError("Sketch capacity must be at least 2, got %r" % k)
+        self.k = k
+        self.count = 0
+        # Extremes are tracked exactly, as compactions may drop them
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.levels: List[np.ndarray] = [np.zeros(0)]
+        # Which of every other value gets promoted alternates, to balance the errors
+        self.__offset = 0
+
+    def __len__(self) -> int:
+        """Get the number of samples summarized by the sketch."""
+        return self.count
+
+    def update(self, values: np.ndarray) -> "QuantileSketch":
+        """Add samples to the sketch. NaNs are ignored.
+
+        Args:
+            values: ndarray of samples
+
+        Returns:
+            self
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.count += values.shape[0]
+        if values.shape[0] > 0:
+            self.minimum = min(self.minimum, values.min())
+            self.maximum = max(self.maximum, values.max())
+        self.__compress()
+        return self
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        """Add the samples summarized by another sketch to this one.
+
+        Args:
+            other: sketch to merge in. Unchanged
+
+        Returns:
+            self
+        """
+        for h, level in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.zeros(0))
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.count += other.count
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.__compress()
+        return self
+
+    def quantile(self, q: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        """Estimate quantiles of the samples.
+
+        Args:
+            q: quantile, or ndarray of quantiles, between 0 and 1
+
+        Returns:
+            estimated quantile(s), NaN if the sketch is empty
+        """
+        q = np.asarray(q, dtype=np.float64)
+        if np.any((q < 0) | (q > 1)):
+            raise ValueError("Quantiles must be between 0 and 1")
+        if self.count == 0:
+            out = np.full(q.shape, np.nan)
+        else:
+            values = np.concatenate(self.levels)
+            weights = np.concatenate(
+                [np.full(level.shape[0], 2.0**h) for h, level in enumerate(self.levels)]
+            )
+            order = np.argsort(values, kind="stable")
+            values = values[order]
+            ranks = np.cumsum(weights[order])
+            index = np.searchsorted(ranks, q * ranks[-1], side="left")
+            out = values[np.minimum(index, values.shape[0] - 1)]
+            out = np.where(q == 0, self.minimum, np.where(q == 1, self.maximum, out))
+        return out if out.ndim > 0 else float(out)
+
+    def percentile(self, p: Union[float, np.ndarray]) -> Union[float, np.ndarray]:
+        """Estimate percentiles of the samples, like np.percentile.
+
+        Args:
+            p: percentile, or ndarray of percentiles, between 0 and 100
+
+        Returns:
+            estimated percentile(s), NaN if the sketch is empty
+        """
+        return self.quantile(np.asarray(p, dtype=np.float64) / 100)
+
+    def __capacity(self, h: int) -> int:
+        return max(2, int(np.ceil(self.k * (2 / 3) ** (len(self.levels) - 1 - h))))
+
+    def __compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if level.shape[0] > self.__capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                level = np.sort(level)
+                # An odd value out stays on this level
+                kept = level[: level.shape[0] % 2]
+                paired = level[level.shape[0] % 2 :]
+                promoted = paired[self.__offset :: 2]
+                self.__offset ^= 1
+                self.levels[h] = kept
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+                # Adding a level shrinks the capacities of the lower ones
+                h = 0
+                continue
+            h += 1
+
+
+class ResampledSpan(NamedTuple):
+    """Contiguous span of a time series resampled onto a uniform grid."""
+
+    # N ndarray. timestamps of the grid, in seconds
+    time: np.ndarray
+    # N ndarray, or NxC ndarray. values interpolated at the grid timestamps
+    series: np.ndarray
+
+
+def timer_spans(
+    event_times: Sequence[float], event_types: Sequence[str]
+) -> List[Tuple[float, float]]:
+    """Get the spans of time the watch timer was running, from its timer events.
+
+    A "start" event starts the timer, and any "stop..." event ("stop", "stop_all",
+    "stop_disable"...) stops it. Other events are ignored. The timer is taken as running
+    before a leading stop event and after a trailing start event.
+
+    Args:
+        event_times: timestamps of the timer events, in seconds
+        event_types: type of each timer event
+
+    Returns:
+        (start, stop) timestamps of each span the timer was running, in order. Open ends are
+        -inf or inf
+    """
+    spans = []
+    start = None
+    # Other events (e.g. "marker") neither start nor stop the timer
+    events = [
+        (time, event_type)
+        for time, event_type in sorted(
+            zip(event_times, event_types), key=lambda event: event[0]
+        )
+        if event_type == "start" or event_type.startswith("stop")
+    ]
+    if len(events) == 0 or events[0][1] != "start":
+        start = -np.inf
+    for time, event_type in events:
+        if event_type == "start":
+            if start is None:
+                start = time
+        else:
+            if start is not None:
+                spans.append((start, time))
+            start = None
+    if start is not None:
+        spans.append((start, np.inf))
+    return spans
+
+
+def resample_spans(
+    time: np.ndarray,
+    series: np.ndarray,
+    spans: Optional[Sequence[Tuple[float, float]]] = None,
+    period: float = 1.0,
+    max_gap: Optional[float] = None,
+) -> List[ResampledSpan]:
+    """Cut a time series into contiguous spans and resample each onto a uniform grid.
+
+    Samples outside of the spans (e.g. while the watch was paused) are dropped, and nothing
+    gets interpolated between two spans. Each grid starts at the first sample of its span.
+
+    Args:
+        time: T ndarray. timestamps of samples, in seconds, in increasing order
+        series: T ndarray, or TxC ndarray to resample C channels at once. value of samples
+        spans: (start, stop) timestamps of the spans to keep, inclusive, like timer_spans
+            returns. Defaults to a single span covering the whole series
+        period: interval between resampled values, in seconds
+        max_gap: also cut spans where consecutive samples are more than this many seconds
+            apart, rather than interpolating across the gap
+
+    Returns:
+        ResampledSpan for every contiguous span holding samples, in order
+    """
+    time = np.asarray(time, dtype=np.float64)
+    series = np.asarray(series)
+    if series.shape[:1] != time.shape:
+        raise ValueError(
+            "Series of shape %r doesn't match %d timestamps"
+            % (series.shape, time.shape[0])
+        )
+    if spans is None:
+        spans = [(-np.inf, np.inf)]
+    channels = series.reshape((series.shape[0], -1))
+    out = []
+    for span_start, span_stop in spans:
+        first = np.searchsorted(time, span_start, side="left")
+        last = np.searchsorted(time, span_stop, side="right")
+        bounds = [first, last]
+        if max_gap is not None:
+            gaps = np.flatnonzero(np.diff(time[first:last]) > max_gap) + first + 1
+            bounds = [first] + gaps.tolist() + [last]
+        for begin, end in zip(bounds[:-1], bounds[1:]):
+            if end <= begin:
+                continue
+            span_time = time[begin:end]
+            steps = np.floor((span_time[-1] - span_time[0]) / period)
+            grid = span_time[0] + np.arange(steps + 1) * period
+            resampled = np.stack(
+                [
+                    np.interp(grid, span_time, channel[begin:end])
+                    for channel in channels.T
+                ],
+                axis=1,
+            )
+            out.append(
+                ResampledSpan(
+                    time=grid,
+                    series=resampled.reshape(grid.shape + series.shape[1:]),
+                )
+            )
+    return out
+
+
+def distance_grade(
+    distance: np.ndarray,
+    altitude: np.ndarray,
+    window: float = 20.0,
+    max_altitude_deviation: Optional[float] = None,
+) -> np.ndarray:
+    """Compute the grade of each sample over a trailing distance window.
+
+    Altitude is first smoothed with the mean over the trailing `window` meters. The grade of
+    a sample is then the change of smoothed altitude since the last sample at least `window`
+    meters behind it (or the first sample), over the distance covered since.
+
+    Args:
+        distance: T ndarray. cumulative distance of samples, in meters, non-decreasing
+        altitude: T ndarray. altitude of samples, in meters
+        window: length of the smoothing and grade windows, in meters
+        max_altitude_deviation: ignore altitudes further than this many meters from the
+            median altitude over the trailing window, such as spikes of a barometric altimeter
+
+    Returns:
+        T float ndarray. grade as a fraction (0.01 being 1%), NaN where the distance or altitude
+        is missing, or the window covers no distance
+    """
+    distance = np.asarray(distance, dtype=np.float64)
+    altitude = np.asarray(altitude, dtype=np.float64)
+    grade = np.full(distance.shape[0], np.nan)
+    finite = np.flatnonzero(np.isfinite(distance) & np.isfinite(altitude))
+    if finite.shape[0] == 0:
+        return grade
+    distance = distance[finite]
+    # Relative to the first altitude, to keep the cumulative sums small
+    altitude = altitude[finite] - altitude[finite[0]]
+    start = sliding_window_start(distance, window)
+    inlier = np.ones(distance.shape[0])
+    if max_altitude_deviation is not None:
+        median = _rolling_quantile(altitude, start, 0.5)
+        inlier = (np.abs(altitude - median) <= max_altitude_deviation).astype(
+            np.float64
+        )
+    # Mean of the inlier altitudes of each window
+    counts = _window_sums(inlier, start)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        smoothed = _window_sums(inlier * altitude, start) / counts
+    before = np.maximum(
+        np.searchsorted(distance, distance - window, side="right") - 1, 0
+    )
+    covered = distance - distance[before]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        grade[finite] = np.where(
+            covered > 0, (smoothed - smoothed[before]) / covered, np.nan
+        )
+    return grade
+
+
+def percentile(
+    x: Union[np.ndarray, QuantileSketch], percentile: float = 99
+) -> Tuple[float, float]:
     """Get the (low, high) limit for the series by only including the data within the given percentile.
 
     For example, if percentile is 99, (1st percentile, 99th percentile) will be returned.
@@ -41,13 +689,15 @@ def percentile(x: np.ndarray, percentile: float = 99) -> Tuple[float, float]:
     Also, if percentile is 1, (1st percentile, 99th percentile) will be returned.
 
     Args:
-        x: the series
+        x: the series, or a QuantileSketch of it to estimate the limits without every sample
         percentile: the percentile, beyond which to exclude data.
 
     Returns:
         (low, high) percentiles of series
     """
     percentile = max(percentile, 100 - percentile)
+    if isinstance(x, QuantileSketch):
+        return (x.percentile(100 - percentile), x.percentile(percentile))
     high = np.percentile(x, percentile)
     low = np.percentile(x, 100 - percentile)
     return (low, high)
@@ -6,18 +6,26 @@ import scipy.stats
 import matplotlib.pyplot as plt
 import psycopg2
 from collections import deque
-from typing import NamedTuple, List, Union
+from typing import Dict, NamedTuple, List, Optional, Union
 import datetime
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.interpolate
 import logging
+import os
 
 from krunning.db import conn_dict_from_env
 
 from ..constants import KG_PER_LB
 from ..data_provider import SpeedPowerFitFilesDataProvider
 from ..db.utils import get_conn
+from ..curvecache import PowerCurveCache
+from ..math import (
+    mean_maximal_power,
+    best_of_power_curves,
+    resample_spans,
+    timer_spans,
+)
 from ..reports_gen import reports, ReportGenerator, ReportBuilder
 
 
@@ -36,95 +44,171 @@ class PowerEvent(NamedTuple):
 @reports.register("power_curve")
 class PowerCurveGenerator(ReportGenerator):
     def build_parser(self, parser: argparse.ArgumentParser):
-        pass
+        parser.add_argument(
+            "--max-gap-seconds",
+            type=float,
+            default=10,
+            help="Don't interpolate power across gaps between samples longer than this",
+        )
+        parser.add_argument(
+            "--cache-directory",
+            default="cache",
+            help="Directory of the cache. Power curves are stored in its power_curves "
+            "subdirectory",
+        )
+
+    @staticmethod
+    def activity_signatures(
+        cur, activity_ids: List[int], max_gap: Optional[float] = None
+    ) -> Dict[int, str]:
+        """Get a signature of what the power curve of each activity is computed from.
+
+        The signature holds checksums of the activity's power samples and timer events, so
+        a re-uploaded or corrected activity gets recomputed, even with as many samples
+        ending at the same time.
+
+        Args:
+            cur: database cursor
+            activity_ids: ids of the activities
+            max_gap: max_gap the curves are computed with
+
+        Returns:
+            signature of each activity, by id
+        """
+        cur.execute(
+            """
+            SELECT s.activity_id, COUNT(*), MAX(s.sampled_at), md5(string_agg(
+                EXTRACT(EPOCH FROM s.sampled_at) || '=' || COALESCE(sv.int_value::text, ''),
+                ',' ORDER BY s.sampled_at, s.message_id
+            )) FROM samples s
+            INNER JOIN sample_values sv ON s.id = sv.sample_id AND sv.field_id = (
+                SELECT id FROM fields
+                WHERE field_name = 'Power'
+            )
+            WHERE s.activity_id = ANY(%s)
+            GROUP BY s.activity_id;
+            """,
+            [list(activity_ids)],
+        )
+        samples = {row[0]: "%d:%s:%s" % row[1:] for row in cur}
+        # Curves also depend on where activities get paused
+        cur.execute(
+            """
+            SELECT activity_id, COUNT(*), MAX(created), md5(string_agg(
+                EXTRACT(EPOCH FROM created) || '=' || event_type, ',' ORDER BY message_id
+            )) FROM timer_events
+            WHERE activity_id = ANY(%s)
+            GROUP BY activity_id;
+            """,
+            [list(activity_ids)],
+        )
+        timer_events = {row[0]: "%d:%s:%s" % row[1:] for row in cur}
+        # And on where they get split
+        return {
+            activity_id: "%s/%s/%s"
+            % (samples.get(activity_id), timer_events.get(activity_id), max_gap)
+            for activity_id in activity_ids
+        }
+
+    @staticmethod
+    def compute_activity_power_curve(
+        cur, activity_id: int, max_gap: Optional[float] = None
+    ) -> np.ndarray:
+        """Compute the best average power of an activity for every duration.
+
+        Args:
+            cur: database cursor
+            activity_id: id of the activity
+            max_gap: split the activity where consecutive power samples are more than this
+                many seconds apart
+
+        Returns:
+            float ndarray of the best average power for durations 1, 2, ... seconds
+        """
+        # Get places the watch was started and stopped
+        cur.execute(
+            """
+            SELECT message_id, created, event_type FROM timer_events
+            WHERE activity_id = %s;
+            """,
+            [activity_id],
+        )
+        timer_events = [TimerEvent(*row) for row in list(cur)]
+
+        # Get samples with power
+        cur.execute(
+            """
+            SELECT s.message_id, s.sampled_at, sv_power.int_value as power FROM samples s
+            INNER JOIN sample_values sv_power on s.id = sv_power.sample_id AND sv_power.field_id = (
+                SELECT id FROM fields
+                WHERE field_name = 'Power'
+            )
+            WHERE activity_id = %s;
+            """,
+            [activity_id],
+        )
+        power_events = sorted(PowerEvent(*row) for row in list(cur))
+
+        # Resample the power every second, over each span of contiguous running between
+        # starting and pausing the watch
+        spans = timer_spans(
+            [event.created.timestamp() for event in timer_events],
+            [event.event_type for event in timer_events],
+        )
+        resampled = resample_spans(
+            np.array([event.created.timestamp() for event in power_events]),
+            np.array([event.power for event in power_events], dtype=np.float64),
+            spans,
+            max_gap=max_gap,
+        )
+
+        # The power curve is defined as the max average power for the duration,
+        # for every possible duration:
+        curves = [
+            mean_maximal_power(span.series, exact=True).power for span in resampled
+        ]
+        power, _ = best_of_power_curves(curves)
+        return power
 
     def generate_report(self, args, report_builder: ReportBuilder):
+        curve_cache = PowerCurveCache(
+            os.path.join(args.cache_directory, "power_curves")
+        )
+        curves = []
+        ages = []
         with get_conn(1) as cur:
             # Get activities within 90 days
             cur.execute(
                 "SELECT id, (NOW() - created) as age FROM activities WHERE (NOW() - created) < '90 days'::interval;"
             )
+            activities = list(cur)
 
-            power_curve_buckets = {}
-            for (activity_id, age) in list(cur):
+            # Signature of each activity, to notice re-uploaded or corrected activities
+            signatures = self.activity_signatures(
+                cur,
+                [activity_id for activity_id, _ in activities],
+                args.max_gap_seconds,
+            )
+
+            for activity_id, age in activities:
                 age: datetime.timedelta
-                logging.info("ACTIVITY %d", activity_id)
-                # Get places the watch was started and stopped
-                cur.execute(
-                    """
-                    SELECT message_id, created, event_type FROM timer_events
-                    WHERE activity_id = %s;
-                    """,
-                    [activity_id],
-                )
-                timer_events = [TimerEvent(*row) for row in list(cur)]
-
-                # Get samples with power
-                cur.execute(
-                    """
-                    SELECT s.message_id, s.sampled_at, sv_power.int_value as power FROM samples s
-                    INNER JOIN sample_values sv_power on s.id = sv_power.sample_id AND sv_power.field_id = (
-                        SELECT id FROM fields
-                        WHERE field_name = 'Power'
+                signature = signatures[activity_id]
+                curve = curve_cache.load(activity_id, signature)
+                if curve is None:
+                    logging.info("ACTIVITY %d", activity_id)
+                    curve = self.compute_activity_power_curve(
+                        cur, activity_id, args.max_gap_seconds
                     )
-                    WHERE activity_id = %s;
-                    """,
-                    [activity_id],
-                )
-                power_events = [PowerEvent(*row) for row in list(cur)]
-                events = sorted(timer_events + power_events)
-
-                powers = []
-                times = []
-                start_time = None
-
-                # Extract spans of running between starting and pausing watch
-                spans = []
-                for i, event in enumerate(events):
-                    if isinstance(event, PowerEvent):
-                        powers.append(event.power)
-                        if start_time is None:
-                            start_time = event.created
-                        times.append((event.created - start_time).total_seconds())
-                    elif isinstance(event, TimerEvent):
-                        pass
-                    else:
-                        raise NotImplementedError(event)
-                spans.append((times, powers))
-
-                # For every span of contiguous running...
-                for times, powers in spans:
-                    # Interpolate the power samples, 1 every second:
-                    if len(times) == 0:
-                        continue
-                    X = np.arange(0, np.floor(np.max(times) + 1))
-                    interpolator = scipy.interpolate.interp1d(times, powers)
-                    Y = interpolator(X)
-
-                    # Cumulative sum the powers and find the average power sliding window
-                    # for every possible duration:
-                    Ysum = np.concatenate([[0], np.cumsum(Y)])
-                    for duration in range(1, Ysum.shape[0]):
-                        # The power curve is defined as the max average power for the duration
-                        average_power_at_duration = np.max(
-                            (Ysum[duration:] - Ysum[:-duration]) / duration
-                        )
-                        value = (
-                            average_power_at_duration,
-                            age.total_seconds() / (24 * 3600),
-                            activity_id,
-                        )
-                        if (
-                            duration not in power_curve_buckets
-                            or power_curve_buckets[duration] < value
-                        ):
-                            power_curve_buckets[duration] = value
+                    curve_cache.store(activity_id, signature, curve)
+                curves.append(curve)
+                ages.append(age.total_seconds() / (24 * 3600))
 
-        # Plot
-        durations = np.array(sorted(power_curve_buckets.keys()))
-        powers = np.array([power_curve_buckets[duration][0] for duration in durations])
-        ages = np.array([power_curve_buckets[duration][1] for duration in durations])
+        # The power curve is the element-wise max of the activities' curves
+        powers, best = best_of_power_curves(curves)
+        durations = np.arange(1, powers.shape[0] + 1)
+        ages = np.array(ages)[best]
 
+        # Plot
         body = report_builder.body()
         body.add_title("Power Curve")
         body.add_paragraph(
@@ -8,6 +8,7 @@ import seaborn as sns
 
 from ..constants import KG_PER_LB
 from ..data_provider import SpeedPowerFitFilesDataProvider
+from ..math import percentile
 from ..reports_gen import reports, ReportGenerator, ReportBuilder
 
 
@@ -21,6 +22,20 @@ class RacePaceGenerator(ReportGenerator):
             "--race-powers-from-stryd", required=True, nargs="+", type=int
         )
         parser.add_argument("--race-distance-meters", required=True, type=int)
+        parser.add_argument(
+            "--grade-window-meters",
+            type=float,
+            default=None,
+            help="Compute grades over this distance (e.g. 20) rather than from sample to "
+            "sample",
+        )
+        parser.add_argument(
+            "--max-altitude-deviation-meters",
+            type=float,
+            default=5,
+            help="With --grade-window-meters, ignore altitudes further than this from "
+            "the median altitude of the window (default: 5)",
+        )
         pass
 
     def generate_report(self, args, report_builder: ReportBuilder):
@@ -32,7 +47,13 @@ class RacePaceGenerator(ReportGenerator):
         race_distance: int = args.race_distance_meters
 
         # Load Data
-        provider = SpeedPowerFitFilesDataProvider()
+        if args.grade_window_meters:
+            provider = SpeedPowerFitFilesDataProvider(
+                grade_window=args.grade_window_meters,
+                max_altitude_deviation=args.max_altitude_deviation_meters,
+            )
+        else:
+            provider = SpeedPowerFitFilesDataProvider()
         data = provider.get()
         powers = data["powers"]
         speeds = data["speeds"]
@@ -40,9 +61,8 @@ class RacePaceGenerator(ReportGenerator):
 
         # Color range for grade
         grade_color_range_percentile = 5
-        grade_color_range = (
-            np.percentile(grades, grade_color_range_percentile),
-            np.percentile(grades, 100 - grade_color_range_percentile),
+        grade_color_range = percentile(
+            data["grade_sketch"], grade_color_range_percentile
         )
 
         # If only flat, drop samples from lower or higher grades
@@ -0,0 +1,55 @@
+import datetime
+import shutil
+
+import krunning.activity_index
+from krunning import ActivityIndex, UnsupportedFitFileError, read_activity_summary
+
+
+def test_read_activity_summary():
+    with open("test/resources/2020-05-14.fit", "rb") as f:
+        summary = read_activity_summary(f.read())
+    assert summary.start_time == datetime.datetime(2020, 5, 14, 11, 16, 32)
+    assert summary.sport == "running"
+    assert summary.duration == 1753.436
+    assert summary.distance == 5901.8
+    assert "Power" in summary.fields and "heart_rate" in summary.fields
+
+
+def test_activity_index(tmp_path, monkeypatch):
+    path = str(tmp_path / "activity.fit")
+    shutil.copy("test/resources/2020-05-14.fit", path)
+    index = ActivityIndex(str(tmp_path / "cache" / "activities.json"))
+    (summary,) = index.summaries([path])
+    with open(path, "rb") as f:
+        assert summary == read_activity_summary(f.read())
+
+    # Unchanged files are not read again
+    def fail(path):
+        raise AssertionError("Summary read again")
+
+    monkeypatch.setattr(krunning.activity_index, "_read_summary", fail)
+    index = ActivityIndex(str(tmp_path / "cache" / "activities.json"))
+    assert index.summaries([path]) == [summary]
+
+    may = datetime.datetime(2020, 5, 1)
+    june = datetime.datetime(2020, 6, 1)
+    assert index.select([path], since=may, until=june) == [path]
+    assert index.select([path], since=june) == []
+    assert index.select([path], until=may) == []
+    assert index.select([path], sport="running") == [path]
+    assert index.select([path], sport="cycling") == []
+
+
+def test_activity_index_fitparse_fallback(tmp_path, monkeypatch):
+    with open("test/resources/2020-05-14.fit", "rb") as f:
+        expected = read_activity_summary(f.read())
+
+    def unsupported(data):
+        raise UnsupportedFitFileError("Unsupported")
+
+    monkeypatch.setattr(krunning.activity_index, "read_activity_summary", unsupported)
+    index = ActivityIndex(str(tmp_path / "activities.json"))
+    (summary,) = index.summaries(["test/resources/2020-05-14.fit"])
+    assert summary._replace(fields=sorted(summary.fields)) == expected._replace(
+        fields=sorted(expected.fields)
+    )
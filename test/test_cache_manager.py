@@ -0,0 +1,103 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from krunning import cache_main
+from krunning.data_provider import CacheManager
+
+
+def test_cache_manager_keeps_parameterizations(tmp_path):
+    cache = CacheManager(str(tmp_path / "providers"))
+    assert cache.load("provider", ("a", 1)) is None
+    cache.store("provider", ("a", 1), {"x": np.arange(10), "name": "one"})
+    cache.store("provider", ("a", 2), {"x": np.arange(5), "name": "two"})
+
+    data = cache.load("provider", ("a", 1))
+    assert isinstance(data["x"], np.memmap)
+    assert data["x"].tolist() == list(range(10))
+    assert data["name"] == "one"
+    assert cache.load("provider", ("a", 2))["name"] == "two"
+    assert cache.load("other", ("a", 2)) is None
+
+    stats = CacheManager(str(tmp_path / "providers")).stats()
+    assert (stats.entries, stats.hits, stats.misses) == (2, 2, 2)
+    assert stats.providers["provider"]["entries"] == 2
+    assert stats.bytes == stats.providers["provider"]["bytes"] > 0
+
+
+def test_cache_manager_evicts_least_recently_used(tmp_path):
+    directory = str(tmp_path / "providers")
+    cache = CacheManager(directory)
+    for i in range(3):
+        cache.store("provider", i, {"x": np.zeros(1000)})
+    entry_bytes = cache.stats().bytes // 3
+    cache.load("provider", 0)
+
+    # Over budget, the least recently used entry goes
+    cache = CacheManager(directory, max_bytes=3 * entry_bytes)
+    cache.store("provider", 3, {"x": np.zeros(1000)})
+    assert cache.load("provider", 1) is None
+    assert cache.load("provider", 0) is not None
+    assert cache.stats().entries == 3
+    assert len(os.listdir(directory)) == 4
+
+    assert cache.prune(entry_bytes) == 2
+    assert cache.load("provider", 0) is not None
+    assert cache.stats().entries == 1
+
+
+def test_cache_main(tmp_path, capsys):
+    directory = str(tmp_path / "providers")
+    cache = CacheManager(directory)
+    cache.store("provider", 1, {"x": np.zeros(1000)})
+    cache.load("provider", 1)
+    (tmp_path / "power_curves").mkdir()
+    (tmp_path / "power_curves" / "1.npz").write_bytes(b"\0" * 100)
+
+    cache_main(["-d", str(tmp_path), "stats"])
+    out = capsys.readouterr().out
+    assert "2 entries" in out
+    assert "1 hits, 0 misses" in out
+    assert "power_curves/: 1 entries" in out
+
+    cache_main(["-d", str(tmp_path), "prune", "--all"])
+    assert "Evicted 2 entries" in capsys.readouterr().out
+    assert cache.load("provider", 1) is None
+    assert os.listdir(tmp_path / "power_curves") == []
+
+
+def test_cache_manager_shared_stores(tmp_path):
+    fit_directory = tmp_path / "fit"
+    fit_directory.mkdir()
+    (fit_directory / "manifest.json").write_text("{}")
+    for i, name in enumerate(("old", "new")):
+        (fit_directory / name).mkdir()
+        (fit_directory / name / "0.npy").write_bytes(b"\0" * 10000)
+        os.utime(fit_directory / name / "0.npy", (1000 + i, 1000 + i))
+        os.utime(fit_directory / name, (1000 + i, 1000 + i))
+
+    cache = CacheManager(str(tmp_path / "providers"), shared_directory=str(tmp_path))
+    stats = cache.stats()
+    assert stats.stores == {"fit": dict(entries=2, bytes=20000)}
+    assert stats.bytes == 20000
+
+    # Stores share the budget, and their least recently used entries go first
+    cache = CacheManager(
+        str(tmp_path / "providers"), max_bytes=15000, shared_directory=str(tmp_path)
+    )
+    cache.store("provider", 1, {"x": np.zeros(100)})
+    assert sorted(os.listdir(fit_directory)) == ["manifest.json", "new"]
+    assert cache.load("provider", 1) is not None
+
+
+def test_cache_manager_threads(tmp_path):
+    cache = CacheManager(str(tmp_path / "providers"))
+
+    def store(i):
+        cache.store("provider", i, {"x": np.full(100, i)})
+        return cache.load("provider", i)["x"][0]
+
+    with ThreadPoolExecutor(8) as executor:
+        assert list(executor.map(store, range(16))) == list(range(16))
+    stats = cache.stats()
+    assert (stats.entries, stats.hits, stats.misses) == (16, 16, 0)
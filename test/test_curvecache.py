@@ -0,0 +1,87 @@
+import datetime
+import os
+import uuid
+import numpy as np
+import pytest
+
+from krunning import PowerCurveCache, best_of_power_curves
+from krunning.db import Database, PGConnectionPool, conn_dict_from_env
+from krunning.reports.power_curve import PowerCurveGenerator
+
+
+def test_power_curve_cache_roundtrip(tmp_path):
+    cache = PowerCurveCache(str(tmp_path / "curves"))
+    assert cache.load(1, "10:2020-05-14") is None
+    cache.store(1, "10:2020-05-14", np.array([300.0, 280.5, 250.0]))
+
+    cache = PowerCurveCache(str(tmp_path / "curves"))
+    assert cache.load(1, "10:2020-05-14").tolist() == [300.0, 280.5, 250.0]
+    # A re-uploaded activity has other samples
+    assert cache.load(1, "11:2020-05-14") is None
+    assert cache.load(2, "10:2020-05-14") is None
+
+
+def test_best_of_power_curves():
+    power, index = best_of_power_curves(
+        [np.array([300.0, 250.0]), np.array([280.0, 260.0, 240.0]), np.zeros(0)]
+    )
+    assert power.tolist() == [300.0, 260.0, 240.0]
+    assert index.tolist() == [0, 1, 1]
+
+    power, index = best_of_power_curves([])
+    assert power.shape == (0,) and index.shape == (0,)
+
+
+def _upload_activity(db, fitfile_name, power, stopped_at):
+    created = datetime.datetime(1990, 1, 1, tzinfo=datetime.timezone.utc)
+    with db.activity_builder(fitfile_name, True, bulk=True) as builder:
+        builder.f_created = created
+        for i, value in enumerate(power):
+            sample = builder.add_sample(i, created + datetime.timedelta(seconds=i))
+            sample.add_value("Power", "Watts", value)
+        for message_id, event_type, seconds in [
+            (100, "start", 0),
+            (101, "stop_all", stopped_at),
+        ]:
+            builder.add_timer_event(
+                message_id=message_id,
+                event_type=event_type,
+                timer_trigger="manual",
+                timestamp=created + datetime.timedelta(seconds=seconds),
+            )
+    with db.activity_builder(fitfile_name, True) as builder:
+        return builder.id
+
+
+@pytest.mark.skipif(
+    "PG_PASSWORD" not in os.environ, reason="needs a database, see conn_dict_from_env"
+)
+def test_power_curve_signatures():
+    pool = PGConnectionPool(conn_dict_from_env(), 1)
+    db = Database(pool)
+    fitfile_name = "test-%s.fit" % uuid.uuid4()
+
+    def signature(power, stopped_at, max_gap=10):
+        activity_id = _upload_activity(db, fitfile_name, power, stopped_at)
+        with pool.get_connection() as connection:
+            with connection:
+                cur = connection.cursor()
+                return PowerCurveGenerator.activity_signatures(
+                    cur, [activity_id], max_gap
+                )[activity_id]
+
+    try:
+        original = signature([250, 260, 270], 3)
+        # Uploading the same activity again keeps its curve
+        assert signature([250, 260, 270], 3) == original
+        # As many samples ending at the same time, but corrected power
+        assert signature([250, 265, 270], 3) != original
+        # Same samples, paused elsewhere
+        assert signature([250, 260, 270], 2) != original
+        assert signature([250, 260, 270], 3, max_gap=5) != original
+    finally:
+        with pool.get_connection() as connection:
+            with connection:
+                connection.cursor().execute(
+                    "DELETE FROM activities WHERE fitfile_name = %s;", [fitfile_name]
+                )
@@ -0,0 +1,445 @@
+import datetime
+import io
+import multiprocessing
+import os
+import shutil
+import uuid
+import numpy as np
+import pytest
+
+import krunning.data_provider
+import krunning.data_provider.database_template as database_template
+import krunning.data_provider.fit_files_template as fit_files_template
+import krunning.fitfile
+
+from krunning import FitFile, load_pandas_from_fitfile
+from krunning.data_provider import (
+    CacheManager,
+    DataProviderTemplate,
+    DerivedDataProviderTemplate,
+    EfficiencyDataProvider,
+    ProviderMemo,
+    SamplesDatabaseDataProvider,
+    SpeedPowerFitFilesDataProvider,
+    decode_samples_csv,
+    resolve,
+)
+from krunning.db import Database, PGConnectionPool, conn_dict_from_env
+from krunning.math import QuantileSketch, distance_grade
+from krunning.utils import pace_to_speed, difference, derivative
+
+
+def make_data_directory(tmp_path):
+    data_directory = tmp_path / "data"
+    data_directory.mkdir()
+    shutil.copy("test/resources/2020-05-14.fit", data_directory / "2020-05-14.fit")
+    return str(data_directory)
+
+
+def test_speed_power_provider(tmp_path):
+    provider = SpeedPowerFitFilesDataProvider(
+        directory=make_data_directory(tmp_path),
+        cache_directory=str(tmp_path / "cache"),
+    )
+    data = provider.get()
+    assert set(data) == {"speeds", "powers", "grades", "hrs", "grade_sketch"}
+    assert len(data["speeds"]) > 0
+    for key in ("powers", "grades", "hrs"):
+        assert len(data[key]) == len(data["speeds"])
+    assert np.all(data["powers"] > 125)
+    assert os.listdir(tmp_path / "cache")
+
+    # Cached arrays are memory-mapped
+    cached = SpeedPowerFitFilesDataProvider(
+        directory=provider.directory,
+        cache_directory=str(tmp_path / "cache"),
+    ).get()
+    assert set(cached) == set(data)
+    for key in ("speeds", "powers", "grades", "hrs"):
+        assert isinstance(cached[key], np.memmap)
+        assert np.array_equal(cached[key], data[key])
+    assert len(cached["grade_sketch"]) == len(data["grade_sketch"])
+
+
+def test_speed_power_provider_matches_unfiltered(tmp_path, monkeypatch):
+    # Small chunks, so samples are carried across chunk boundaries
+    monkeypatch.setattr(krunning.fitfile, "CHUNK_SIZE", 100)
+    provider = SpeedPowerFitFilesDataProvider(
+        directory=make_data_directory(tmp_path),
+        cache_directory=str(tmp_path / "cache"),
+        grade_range=(-0.05, 0.05),
+    )
+    data = provider.compute()
+
+    with FitFile("test/resources/2020-05-14.fit") as fit_file:
+        df = load_pandas_from_fitfile(fit_file)
+    speed = df["enhanced_speed"].to_numpy()
+    power = df["Power"].to_numpy()
+    distance = df["distance"].to_numpy()
+    grade = derivative(df["enhanced_altitude"].to_numpy(), distance)
+    mask = (
+        (speed > pace_to_speed(12))
+        & (power > 125)
+        & (difference(distance) > 0.1)
+        & (grade >= -0.05)
+        & (grade <= 0.05)
+    )
+    assert np.array_equal(data["speeds"], speed[mask])
+    assert np.array_equal(data["powers"], power[mask])
+    assert np.array_equal(data["grades"], 100 * grade[mask])
+    assert np.array_equal(data["hrs"], df["heart_rate"].to_numpy()[mask])
+    assert len(data["grade_sketch"]) == len(data["grades"])
+
+
+def test_speed_power_provider_grade_window(tmp_path, monkeypatch):
+    monkeypatch.setattr(krunning.fitfile, "CHUNK_SIZE", 100)
+    provider = SpeedPowerFitFilesDataProvider(
+        directory=make_data_directory(tmp_path),
+        cache_directory=str(tmp_path / "cache"),
+        grade_window=30,
+        max_altitude_deviation=3,
+        grade_range=(-0.05, 0.05),
+    )
+    data = provider.compute()
+
+    with FitFile("test/resources/2020-05-14.fit") as fit_file:
+        df = load_pandas_from_fitfile(fit_file)
+    speed = df["enhanced_speed"].to_numpy()
+    power = df["Power"].to_numpy()
+    distance = df["distance"].to_numpy()
+    grade = distance_grade(distance, df["enhanced_altitude"].to_numpy(), 30, 3)
+    mask = (
+        (speed > pace_to_speed(12))
+        & (power > 125)
+        & (difference(distance) > 0.1)
+        & (grade >= -0.05)
+        & (grade <= 0.05)
+    )
+    assert np.array_equal(data["speeds"], speed[mask])
+    assert np.allclose(data["grades"], 100 * grade[mask])
+
+
+def test_speed_power_provider_caches_files(tmp_path, monkeypatch):
+    data_directory = make_data_directory(tmp_path)
+    computed = []
+    compute_file = SpeedPowerFitFilesDataProvider.compute_file
+
+    def counting_compute_file(self, filepath):
+        computed.append(os.path.basename(filepath))
+        return compute_file(self, filepath)
+
+    monkeypatch.setattr(
+        SpeedPowerFitFilesDataProvider, "compute_file", counting_compute_file
+    )
+
+    def get():
+        return SpeedPowerFitFilesDataProvider(
+            directory=data_directory, cache_directory=str(tmp_path / "cache"), workers=1
+        ).get()
+
+    data = get()
+    assert computed == ["2020-05-14.fit"]
+
+    # Only the new file gets computed
+    shutil.copy("test/resources/2020-05-14.fit", os.path.join(data_directory, "b.fit"))
+    both = get()
+    assert computed == ["2020-05-14.fit", "b.fit"]
+    assert len(both["speeds"]) == 2 * len(data["speeds"])
+    assert len(both["grade_sketch"]) == 2 * len(data["grade_sketch"])
+
+    # Other parameters compute every file again
+    SpeedPowerFitFilesDataProvider(
+        directory=data_directory,
+        cache_directory=str(tmp_path / "cache"),
+        min_power=200,
+        workers=1,
+    ).get()
+    assert computed[2:] == ["2020-05-14.fit", "b.fit"]
+
+    # Partials of removed files are dropped
+    partials = tmp_path / "cache" / SpeedPowerFitFilesDataProvider.uuid
+    assert len(os.listdir(partials)) == 2
+    os.remove(os.path.join(data_directory, "b.fit"))
+    assert np.array_equal(get()["speeds"], data["speeds"])
+    assert len(computed) == 4
+    assert len(os.listdir(partials)) == 1
+
+
+def test_speed_power_provider_recomputes_changed_files(tmp_path, monkeypatch):
+    data_directory = make_data_directory(tmp_path)
+    path = os.path.join(data_directory, "2020-05-14.fit")
+    computed = []
+
+    def compute_file(self, filepath):
+        computed.append(filepath)
+        with open(filepath, "rb") as f:
+            speeds = np.frombuffer(f.read(8), dtype=np.uint8).astype(np.float64)
+        return {
+            "speeds": speeds,
+            "powers": speeds,
+            "grades": speeds,
+            "hrs": speeds,
+            "grade_sketch": QuantileSketch().update(speeds),
+        }
+
+    monkeypatch.setattr(SpeedPowerFitFilesDataProvider, "compute_file", compute_file)
+
+    def get():
+        return SpeedPowerFitFilesDataProvider(
+            directory=data_directory, cache_directory=str(tmp_path / "cache")
+        ).get()
+
+    first = get()["speeds"]
+    assert len(computed) == 1
+
+    # Touching the file doesn't change its content
+    os.utime(path, ns=(0, 0))
+    assert np.array_equal(get()["speeds"], first)
+    assert len(computed) == 1
+
+    # Same name, new content
+    with open(path, "r+b") as f:
+        f.write(b"\xff")
+    assert get()["speeds"][0] == 255
+    assert len(computed) == 2
+
+
+def test_speed_power_provider_workers(tmp_path):
+    data_directory = make_data_directory(tmp_path)
+    for name in ("b.fit", "c.fit"):
+        shutil.copy("test/resources/2020-05-14.fit", os.path.join(data_directory, name))
+    serial = SpeedPowerFitFilesDataProvider(
+        directory=data_directory, cache_directory=str(tmp_path / "serial"), workers=1
+    ).compute()
+    provider = SpeedPowerFitFilesDataProvider(
+        directory=data_directory, cache_directory=str(tmp_path / "parallel"), workers=3
+    )
+    parallel = provider.compute()
+    for key in ("speeds", "powers", "grades", "hrs"):
+        assert np.array_equal(parallel[key], serial[key])
+    assert len(parallel["grade_sketch"]) == len(serial["grade_sketch"])
+    # Workers cached every partial, as memory-mappable arrays
+    for filepath in provider.files:
+        assert isinstance(provider.load_file(filepath)["speeds"], np.memmap)
+
+
+def test_speed_power_provider_spawn_workers(tmp_path, monkeypatch):
+    # Spawned workers (the default on macOS and Windows) get the provider pickled
+    spawn = multiprocessing.get_context("spawn")
+    monkeypatch.setattr(fit_files_template.multiprocessing, "Pool", spawn.Pool)
+    data_directory = make_data_directory(tmp_path)
+    shutil.copy("test/resources/2020-05-14.fit", os.path.join(data_directory, "b.fit"))
+    provider = SpeedPowerFitFilesDataProvider(
+        directory=data_directory, cache_directory=str(tmp_path / "cache"), workers=2
+    )
+    data = provider.get()
+    assert len(data["speeds"]) > 0
+    assert provider.memo is not None
+
+
+def test_decode_samples_csv():
+    buffer = io.StringIO("3,1589456192,250,74\n3,1589456193.5,,75\n4,1589500000,300,\n")
+    samples = decode_samples_csv(buffer, ["Power", "heart_rate"])
+    assert list(samples) == ["activity_id", "timestamp", "Power", "heart_rate"]
+    assert samples["activity_id"].dtype == np.int64
+    assert samples["activity_id"].tolist() == [3, 3, 4]
+    assert samples["timestamp"].tolist() == [1589456192, 1589456193.5, 1589500000]
+    assert np.array_equal(samples["Power"], [250, np.nan, 300], equal_nan=True)
+    assert np.array_equal(samples["heart_rate"], [74, 75, np.nan], equal_nan=True)
+
+    samples = decode_samples_csv(io.StringIO(""), ["Power"])
+    assert all(len(values) == 0 for values in samples.values())
+
+
+@pytest.mark.skipif(
+    "PG_PASSWORD" not in os.environ, reason="needs a database, see conn_dict_from_env"
+)
+def test_samples_database_provider_exact_values(tmp_path):
+    pool = PGConnectionPool(conn_dict_from_env(), 1)
+    fitfile_name = "test-%s.fit" % uuid.uuid4()
+    created = datetime.datetime(1990, 1, 1, tzinfo=datetime.timezone.utc)
+    with Database(pool).activity_builder(fitfile_name, False) as builder:
+        builder.f_created = created
+        # Positions need more than the 24 bits of precision of a REAL
+        sample = builder.add_sample(0, created)
+        sample.add_value("position_lat", "semicircles", 506371079)
+        sample.add_value("enhanced_speed", "m/s", 2.5)
+        sample = builder.add_sample(1, created + datetime.timedelta(seconds=1))
+        sample.add_value("position_lat", "semicircles", -1073741823)
+    try:
+        provider = SamplesDatabaseDataProvider(
+            ["position_lat", "enhanced_speed"],
+            since=created,
+            until=created + datetime.timedelta(days=1),
+            cache_directory=str(tmp_path / "cache"),
+            memo=None,
+        )
+        data = provider.get()
+        assert data["position_lat"].tolist() == [506371079, -1073741823]
+        assert np.array_equal(data["enhanced_speed"], [2.5, np.nan], equal_nan=True)
+        assert data["timestamp"].tolist() == [
+            created.timestamp(),
+            created.timestamp() + 1,
+        ]
+    finally:
+        with pool.get_connection() as connection:
+            with connection:
+                connection.cursor().execute(
+                    "DELETE FROM activities WHERE fitfile_name = %s;", [fitfile_name]
+                )
+
+
+def test_samples_csv_decoder_chunks():
+    text = "".join(
+        "%d,%d,%s,%d\n" % (i // 100, 1589456192 + i, "" if i % 7 else i, i % 200)
+        for i in range(1000)
+    )
+    expected = decode_samples_csv(io.StringIO(text), ["Power", "heart_rate"])
+    for chunk_size in [1, 64, 1000, len(text) + 1]:
+        decoder = database_template._SamplesCsvDecoder(
+            ["Power", "heart_rate"], chunk_size=chunk_size
+        )
+        # COPY writes a row at a time, split here at arbitrary points
+        for start in range(0, len(text), 37):
+            decoder.write(text[start : start + 37])
+        samples = decoder.samples()
+        assert list(samples) == list(expected)
+        for name, values in expected.items():
+            assert samples[name].dtype == values.dtype
+            assert np.array_equal(samples[name], values, equal_nan=True)
+
+    samples = database_template._SamplesCsvDecoder(["Power"]).samples()
+    assert all(len(values) == 0 for values in samples.values())
+
+
+def test_speed_power_provider_time_window(tmp_path):
+    data_directory = make_data_directory(tmp_path)
+    kwargs = dict(directory=data_directory, cache_directory=str(tmp_path / "cache"))
+    provider = SpeedPowerFitFilesDataProvider(
+        since=datetime.datetime(2020, 5, 14), sport="running", **kwargs
+    )
+    assert provider.files == [os.path.join(data_directory, "2020-05-14.fit")]
+    provider.get()
+
+    provider = SpeedPowerFitFilesDataProvider(
+        until=datetime.datetime(2020, 5, 14), **kwargs
+    )
+    assert provider.files == []
+    # Files outside of the window keep their cached partials
+    provider.drop_removed_files()
+    partials = tmp_path / "cache" / SpeedPowerFitFilesDataProvider.uuid
+    assert len(os.listdir(partials)) == 1
+
+
+def test_provider_memo(tmp_path, monkeypatch):
+    kwargs = dict(
+        directory=make_data_directory(tmp_path),
+        cache_directory=str(tmp_path / "cache"),
+        memo=ProviderMemo(),
+    )
+    data = SpeedPowerFitFilesDataProvider(**kwargs).get()
+    assert not data["speeds"].flags.writeable
+
+    # Same key, same data, without loading the cache again
+    def load(self, uuid, cache_key):
+        raise AssertionError("loaded from the cache")
+
+    monkeypatch.setattr(krunning.data_provider.CacheManager, "load", load)
+    assert SpeedPowerFitFilesDataProvider(**kwargs).get() is data
+
+
+def test_provider_memo_budget():
+    memo = ProviderMemo(max_bytes=2000)
+    first = memo.store("provider", ["a", 1], {"x": np.zeros(100)})
+    memo.store("provider", ["a", 2], {"x": np.zeros(100)})
+    assert memo.bytes == 1600
+    assert memo.load("provider", ["a", 1]) is first
+    assert memo.load("provider", ["a", 3]) is None
+
+    # Over budget, the least recently used result is only kept while referenced
+    memo.store("provider", ["a", 3], {"x": np.zeros(100)})
+    assert memo.bytes == 1600
+    assert memo.load("provider", ["a", 2]) is None
+    assert memo.load("provider", ["a", 1]) is first
+    memo.store("provider", ["a", 4], {"x": np.zeros(100)})
+    memo.store("provider", ["a", 5], {"x": np.zeros(100)})
+    del first
+    assert memo.load("provider", ["a", 1]) is None
+
+
+class _ValueProvider(DataProviderTemplate):
+    uuid = "value"
+
+    def __init__(self, value, computed, **kwargs):
+        super().__init__(**kwargs)
+        self.value = value
+        self.computed = computed
+
+    @property
+    def cache_key(self):
+        return self.value
+
+    def compute(self):
+        self.computed.append(self.uuid)
+        return {"x": np.array([self.value])}
+
+
+class _SumProvider(DerivedDataProviderTemplate):
+    uuid = "sum"
+
+    def __init__(self, computed, **kwargs):
+        super().__init__(**kwargs)
+        self.computed = computed
+
+    def compute_derived(self, inputs):
+        self.computed.append(self.uuid)
+        return {"x": sum(data["x"] for data in inputs.values())}
+
+
+def test_derived_providers(tmp_path):
+    computed = []
+    kwargs = dict(cache_directory=str(tmp_path / "cache"), memo=ProviderMemo())
+
+    def graph(a, b):
+        left = _ValueProvider(a, computed, **kwargs)
+        right = _ValueProvider(b, computed, **kwargs)
+        middle = _SumProvider(computed, dependencies=dict(a=left, b=right), **kwargs)
+        top = _SumProvider(computed, dependencies=dict(a=left, m=middle), **kwargs)
+        return left, top
+
+    left, top = graph(1, 2)
+    assert resolve([top, left]) == [{"x": np.array([4])}, {"x": np.array([1])}]
+    # The shared dependency is only computed once
+    assert sorted(computed) == ["sum", "sum", "value", "value"]
+
+    computed.clear()
+    assert graph(1, 2)[1].get()["x"] == 4
+    assert computed == []
+
+    # Only what depends on the changed provider gets recomputed
+    computed.clear()
+    assert graph(1, 5)[1].get()["x"] == 7
+    assert computed == ["value", "sum", "sum"]
+
+
+def test_resolve_siblings_sharing_a_cache(tmp_path):
+    computed = []
+    # A budget for a single result, so siblings evict each other's
+    cache_manager = CacheManager(str(tmp_path / "providers"), max_bytes=1)
+    kwargs = dict(cache_directory=str(tmp_path / "cache"), cache_manager=cache_manager)
+    providers = [_ValueProvider(i, computed, memo=None, **kwargs) for i in range(8)]
+    assert [data["x"][0] for data in resolve(providers)] == list(range(8))
+    assert cache_manager.stats().entries == 1
+
+
+def test_efficiency_provider(tmp_path):
+    speed_power = SpeedPowerFitFilesDataProvider(
+        directory=make_data_directory(tmp_path),
+        cache_directory=str(tmp_path / "cache"),
+    )
+    data = EfficiencyDataProvider(
+        speed_power, cache_directory=str(tmp_path / "cache")
+    ).get()
+    parent = speed_power.get()
+    assert np.allclose(data["efficiencies"], 1000 * parent["speeds"] / parent["powers"])
+    assert np.array_equal(data["hrs"], parent["hrs"], equal_nan=True)
@@ -0,0 +1,141 @@
+import datetime
+from contextlib import contextmanager
+
+import pytest
+
+from krunning.db.database import (
+    ActivityAlreadyExistsError,
+    BufferedSample,
+    ConnectionPool,
+    DatabaseActivityBuilder,
+    FieldIdCache,
+    copy_buffer,
+)
+
+
+def test_copy_buffer():
+    rows = [
+        (1, "a\tb", None, 1.5),
+        (2, "back\\slash\nnewline", 3, datetime.datetime(2020, 5, 14, 11, 16, 32)),
+    ]
+    assert copy_buffer(rows).read() == (
+        "1\ta\\tb\t\\N\t1.5\n" "2\tback\\\\slash\\nnewline\t3\t2020-05-14 11:16:32\n"
+    )
+    assert copy_buffer([]).read() == ""
+
+
+def test_buffered_sample_keeps_last_value():
+    sample = BufferedSample(3, datetime.datetime(2020, 5, 14))
+    sample.add_value("Power", "Watts", 250)
+    sample.add_value("heart_rate", "bpm", 140)
+    sample.add_value("Power", "Watts", 260)
+    assert sample.values == {("Power", "Watts"): 260, ("heart_rate", "bpm"): 140}
+
+
+class _FieldsCursor:
+    """Cursor answering the queries of FieldIdCache from an in-memory fields table."""
+
+    def __init__(self, fields):
+        self.fields = dict(fields)
+        self.queries = []
+
+    def execute(self, query, params=None):
+        self.queries.append(query.split()[0])
+        if query.split()[0] == "INSERT":
+            for key in zip(params["names"], params["units"]):
+                self.fields.setdefault(key, len(self.fields) + 1)
+            self.rows = []
+        elif params is None:
+            self.rows = [key + (id,) for key, id in self.fields.items()]
+        else:
+            keys = zip(params["names"], params["units"])
+            self.rows = [key + (self.fields[key],) for key in keys]
+
+    def fetchall(self):
+        return self.rows
+
+
+def test_field_id_cache():
+    cursor = _FieldsCursor({("Power", "Watts"): 1, ("cadence", None): 2})
+    cache = FieldIdCache()
+    assert cache.get(cursor, [("Power", "Watts")]) == {("Power", "Watts"): 1}
+    assert cache.get(cursor, [("cadence", None)]) == {("cadence", None): 2}
+    # Warmed once, known fields need no query
+    assert cursor.queries == ["SELECT"]
+
+    assert cache.get(cursor, [("heart_rate", "bpm")]) == {("heart_rate", "bpm"): 3}
+    assert cache.get(cursor, [("heart_rate", "bpm")]) == {("heart_rate", "bpm"): 3}
+    assert cursor.queries == ["SELECT", "INSERT", "SELECT"]
+
+    # Fields inserted by a rolled back transaction are looked up again
+    cache.rollback()
+    del cursor.fields[("heart_rate", "bpm")]
+    assert cache.get(cursor, [("heart_rate", "bpm")]) == {("heart_rate", "bpm"): 3}
+    cache.commit()
+    assert cache.get(cursor, [("heart_rate", "bpm")]) == {("heart_rate", "bpm"): 3}
+    assert len(cursor.queries) == 5
+
+
+def test_activity_header_columns():
+    columns = DatabaseActivityBuilder.header_columns()
+    assert len(columns) == 16
+    assert {"fitfile_name", "created", "sport", "user_weight_kg"} <= set(columns)
+
+
+class _ActivityConnection:
+    """Connection to a database holding a single activity, whose commits can fail."""
+
+    def __init__(self, exists, fail_commit):
+        self.exists = exists
+        self.fail_commit = fail_commit
+        self.rolled_back = False
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params=None):
+        if "COUNT(*)" in query:
+            self.row = (self.exists,)
+        else:
+            self.row = (1,) + (None,) * len(DatabaseActivityBuilder.header_columns())
+
+    def fetchone(self):
+        return self.row
+
+    def commit(self):
+        if self.fail_commit:
+            raise IOError("commit failed")
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+class _ListConnectionPool(ConnectionPool):
+    def __init__(self, connection):
+        self.connections = [connection]
+
+    @contextmanager
+    def get_connection(self):
+        connection = self.connections.pop()
+        try:
+            yield connection
+        finally:
+            self.connections.append(connection)
+
+
+def test_activity_builder_returns_connection_on_failure():
+    connection = _ActivityConnection(exists=False, fail_commit=True)
+    pool = _ListConnectionPool(connection)
+    with pytest.raises(IOError):
+        with DatabaseActivityBuilder(pool, "a.fit", False) as builder:
+            builder.f_sport = "running"
+    assert connection.rolled_back
+    assert pool.connections == [connection]
+
+    connection = _ActivityConnection(exists=True, fail_commit=False)
+    pool = _ListConnectionPool(connection)
+    with pytest.raises(ActivityAlreadyExistsError):
+        with DatabaseActivityBuilder(pool, "a.fit", False):
+            pass
+    assert connection.rolled_back
+    assert pool.connections == [connection]
@@ -0,0 +1,70 @@
+import os
+import shutil
+import numpy as np
+
+import krunning.fitfile
+from krunning import FileManifest, FitCache, FitFile
+
+
+def test_fitcache_roundtrip(tmp_path):
+    cache = FitCache(str(tmp_path / "cache"))
+    assert cache.load("test/resources/2020-05-14.fit") is None
+    with FitFile("test/resources/2020-05-14.fit", native=True) as fit_file:
+        expected = fit_file.read_columns()
+    cache.store("test/resources/2020-05-14.fit", expected)
+
+    columns = FitCache(str(tmp_path / "cache")).load("test/resources/2020-05-14.fit")
+    assert columns.length == expected.length
+    assert columns.units == expected.units
+    for field in expected.values:
+        assert isinstance(columns.values[field], np.memmap)
+        assert columns.values[field].dtype == expected.values[field].dtype
+        assert np.array_equal(columns.valid[field], expected.valid[field])
+        valid = expected.valid[field]
+        assert np.array_equal(
+            columns.values[field][valid], expected.values[field][valid]
+        )
+
+
+def test_fitcache_fingerprint(tmp_path):
+    path = str(tmp_path / "activity.fit")
+    shutil.copy("test/resources/2020-05-14.fit", path)
+    cache = FitCache(str(tmp_path / "cache"))
+    fingerprint = cache.fingerprint(path)
+    assert FitCache(str(tmp_path / "cache")).fingerprint(path) == fingerprint
+
+    with open(path, "ab") as f:
+        f.write(b"\0")
+    assert cache.fingerprint(path) != fingerprint
+
+
+def test_manifest_batch(tmp_path):
+    paths = []
+    for name in ("a.fit", "b.fit"):
+        paths.append(str(tmp_path / name))
+        shutil.copy("test/resources/2020-05-14.fit", paths[-1])
+    manifest_path = str(tmp_path / "manifest.json")
+    manifest = FileManifest(manifest_path)
+    with manifest.batch():
+        fingerprints = [manifest.fingerprint(path) for path in paths]
+        # Saved once, at the end of the batch
+        assert not os.path.exists(manifest_path)
+    assert fingerprints[0] == fingerprints[1]
+    reloaded = FileManifest(manifest_path)
+    assert [reloaded.fingerprint(path) for path in paths] == fingerprints
+
+
+def test_fitfile_reads_from_cache(tmp_path, monkeypatch):
+    cache = FitCache(str(tmp_path / "cache"))
+    with FitFile("test/resources/2020-05-14.fit", native=True, cache=cache) as fit_file:
+        expected = fit_file.read_columns(["distance"])
+
+    def fail(*args, **kwargs):
+        raise AssertionError("decoded a cached file")
+
+    monkeypatch.setattr(krunning.fitfile, "decode_records", fail)
+    with FitFile("test/resources/2020-05-14.fit", native=True, cache=cache) as fit_file:
+        columns = fit_file.read_columns(["distance"])
+        assert len(fit_file.fields) == 21
+    assert list(columns.values) == ["distance"]
+    assert np.array_equal(columns.values["distance"], expected.values["distance"])
@@ -1,7 +1,23 @@
 import datetime
+import shutil
+import struct
+import numpy as np
 import pandas as pd
+import pytest
+from fitparse.records import Crc
 
-from krunning import FitFile, load_pandas_from_fitfile
+import krunning.fitfile
+import krunning.manifest
+
+from krunning import (
+    FileManifest,
+    FitCache,
+    FitFile,
+    UnsupportedFitFileError,
+    decode_records,
+    load_many,
+    load_pandas_from_fitfile,
+)
 
 
 def test_fitfile_fields():
@@ -105,3 +121,208 @@ def test_load_pandas_from_fitfile_all():
         assert df["distance"].to_numpy()[-1] == 5904.69
         assert df["timestamp"].to_list()[-1] == pd.Timestamp("2020-05-14 11:46:38")
         assert list(df.keys()) == sorted(fit_file.fields)
+
+
+def test_fitfile_read_columns():
+    with FitFile("test/resources/2020-05-14.fit") as fit_file:
+        columns = fit_file.read_columns(
+            ["timestamp", "heart_rate", "distance", "unknown_108"]
+        )
+        assert columns.length == 1757
+        assert list(columns.values) == [
+            "timestamp",
+            "heart_rate",
+            "distance",
+            "unknown_108",
+        ]
+        assert columns.units == fit_file.fields
+        assert columns.values["heart_rate"].dtype == np.int64
+        assert columns.values["distance"].dtype == np.float64
+        assert columns.values["timestamp"][1000] == np.datetime64("2020-05-14T11:33:27")
+        assert columns.values["heart_rate"][1000] == 151
+        assert columns.values["distance"][-1] == 5904.69
+        assert columns.valid["heart_rate"].all()
+        assert not columns.valid["unknown_108"][1000]
+
+
+def test_fitfile_read_columns_matches_get_fields():
+    with FitFile("test/resources/2020-05-14.fit") as fit_file:
+        fields = sorted(fit_file.fields)
+        columns = fit_file.read_columns(fields)
+        for i, record in enumerate(fit_file.get_fields(fields)):
+            for field, value in zip(fields, record):
+                assert columns.valid[field][i] == (value is not None)
+                if value is not None and field != "timestamp":
+                    assert columns.values[field][i] == value
+
+
+def test_fitfile_native_matches_fitparse():
+    with FitFile("test/resources/2020-05-14.fit") as fit_file:
+        expected = fit_file.read_columns()
+    with FitFile("test/resources/2020-05-14.fit", native=True) as fit_file:
+        columns = fit_file.read_columns()
+    assert columns.length == expected.length
+    assert columns.units == expected.units
+    assert columns.base_types == expected.base_types
+    for field in expected.values:
+        valid = expected.valid[field]
+        assert np.array_equal(columns.valid[field], valid)
+        assert columns.values[field].dtype == expected.values[field].dtype
+        assert np.array_equal(
+            columns.values[field][valid], expected.values[field][valid]
+        )
+
+
+def test_decode_records_unsupported():
+    with open("test/resources/2020-05-14.fit", "rb") as f:
+        data = f.read()
+    with pytest.raises(UnsupportedFitFileError):
+        decode_records(data[:-100])
+    with pytest.raises(UnsupportedFitFileError):
+        decode_records(b"not a fit file")
+
+
+def test_fitfile_native_falls_back_to_fitparse(tmp_path):
+    # A record with the speed field, whose enhanced_speed component only fitparse expands
+    messages = struct.pack("<BBBHB6B", 0x40, 0, 0, 20, 2, 253, 4, 0x86, 6, 2, 0x84)
+    messages += struct.pack("<BIH", 0, 958389392, 2781)
+    data = struct.pack("<BBHI4s", 12, 0x10, 2093, len(messages), b".FIT") + messages
+    data += struct.pack("<H", Crc.calculate(data))
+    path = tmp_path / "speed.fit"
+    path.write_bytes(data)
+    with pytest.raises(UnsupportedFitFileError):
+        decode_records(data)
+    with FitFile(str(path), native=True) as fit_file:
+        columns = fit_file.read_columns()
+    assert columns.length == 1
+    assert columns.values["speed"][0] == 2.781
+    assert columns.values["enhanced_speed"][0] == 2.781
+
+
+def test_fitfile_read_columns_projection():
+    for native in (False, True):
+        with FitFile("test/resources/2020-05-14.fit", native=native) as fit_file:
+            columns = fit_file.read_columns(["distance"])
+            assert list(columns.values) == ["distance"]
+            assert len(columns.units) == 21
+            assert len(fit_file) == 1757
+            columns = fit_file.read_columns(["heart_rate", "distance"])
+            assert list(columns.values) == ["heart_rate", "distance"]
+            assert columns.values["heart_rate"][1000] == 151
+
+
+def test_decode_records_projection():
+    with open("test/resources/2020-05-14.fit", "rb") as f:
+        data = f.read()
+    columns = decode_records(data, ["Power", "missing_key"])
+    assert list(columns.values) == ["Power"]
+    assert columns.length == 1757
+    assert columns.units["Power"] == "Watts"
+    assert len(columns.units) == 21
+
+
+def test_fitfile_read_columns_where():
+    chunk_lengths = []
+
+    def where(chunk):
+        chunk_lengths.append(chunk.length)
+        chunk.values["double_hr"] = 2 * chunk.values["heart_rate"]
+        chunk.valid["double_hr"] = chunk.valid["heart_rate"]
+        return chunk.values["heart_rate"] > 150
+
+    with FitFile("test/resources/2020-05-14.fit", native=True) as fit_file:
+        full = fit_file.read_columns(["heart_rate", "distance"])
+        columns = fit_file.read_columns(["heart_rate", "distance"], where=where)
+    mask = full.values["heart_rate"] > 150
+    assert sum(chunk_lengths) == 1757
+    assert columns.length == np.count_nonzero(mask)
+    assert np.array_equal(columns.values["distance"], full.values["distance"][mask])
+    assert np.array_equal(
+        columns.values["double_hr"], 2 * full.values["heart_rate"][mask]
+    )
+
+
+def test_fitfile_read_columns_where_decoders(tmp_path, monkeypatch):
+    monkeypatch.setattr(krunning.fitfile, "CHUNK_SIZE", 100)
+    names = ["timestamp", "heart_rate", "Power"]
+
+    def where(chunk):
+        return chunk.valid["heart_rate"] & (chunk.values["heart_rate"] > 150)
+
+    with FitFile("test/resources/2020-05-14.fit") as fit_file:
+        full = fit_file.read_columns(names)
+    mask = full.valid["heart_rate"] & (full.values["heart_rate"] > 150)
+    cache = FitCache(str(tmp_path / "fit"))
+    for kwargs in (dict(), dict(native=True), dict(cache=cache), dict(cache=cache)):
+        with FitFile("test/resources/2020-05-14.fit", **kwargs) as fit_file:
+            columns = fit_file.read_columns(names, where=where)
+            assert len(fit_file) == 1757
+            with pytest.raises(KeyError):
+                fit_file.read_columns(
+                    ["missing_key"], where=lambda chunk: np.ones(chunk.length, bool)
+                )
+        assert columns.length == np.count_nonzero(mask)
+        for name in names:
+            assert columns.values[name].dtype == full.values[name].dtype
+            assert np.array_equal(columns.values[name], full.values[name][mask])
+
+
+def test_load_many(tmp_path):
+    paths = []
+    for i in range(3):
+        path = tmp_path / ("%d.fit" % i)
+        shutil.copy("test/resources/2020-05-14.fit", path)
+        paths.append(str(path))
+    with FitFile("test/resources/2020-05-14.fit") as fit_file:
+        expected = fit_file.read_columns(["timestamp", "Power"])
+
+    for workers in (1, 2):
+        loaded = list(load_many(paths, ["timestamp", "Power"], workers=workers))
+        assert [path for path, _ in loaded] == paths
+        for _, columns in loaded:
+            assert list(columns.values) == ["timestamp", "Power"]
+            for field in expected.values:
+                assert np.array_equal(columns.values[field], expected.values[field])
+
+    unordered = load_many(paths, ["Power"], workers=2, ordered=False)
+    assert sorted(path for path, _ in unordered) == paths
+
+
+def test_load_many_records_worker_hashes(tmp_path, monkeypatch):
+    paths = []
+    for i in range(3):
+        paths.append(str(tmp_path / ("%d.fit" % i)))
+        shutil.copy("test/resources/2020-05-14.fit", paths[-1])
+    cache = FitCache(str(tmp_path / "cache"))
+    assert len(list(load_many(paths, ["Power"], workers=2, cache=cache))) == 3
+
+    # Hashes computed by the workers were saved, so files aren't hashed again
+    def sha1():
+        raise AssertionError("file hashed again")
+
+    monkeypatch.setattr(krunning.manifest.hashlib, "sha1", sha1)
+    manifest = FileManifest(cache.manifest.path)
+    assert len({manifest.fingerprint(path) for path in paths}) == 1
+
+
+def test_load_pandas_from_fitfile_typed():
+    with FitFile("test/resources/2020-05-14.fit", native=True) as fit_file:
+        df = load_pandas_from_fitfile(fit_file, typed=True)
+        untyped = load_pandas_from_fitfile(fit_file)
+    assert len(df) == 1757
+    assert df["heart_rate"].dtype == np.uint8
+    assert df["Power"].dtype == np.uint16
+    assert df["position_lat"].dtype == np.int32
+    assert df["enhanced_speed"].dtype == np.float32
+    assert df["timestamp"].dtype == np.int64
+    assert (
+        df["timestamp"].to_numpy()[-1]
+        == pd.Timestamp("2020-05-14 11:46:38").timestamp()
+    )
+    assert df["unknown_108"].dtype == pd.UInt16Dtype()
+    assert (
+        df["unknown_108"].isna().to_numpy().tolist()
+        == untyped["unknown_108"].isna().to_numpy().tolist()
+    )
+    assert np.allclose(df["distance"].to_numpy(), untyped["distance"].to_numpy())
+    assert df.memory_usage().sum() < untyped.memory_usage().sum() / 2
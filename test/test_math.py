@@ -1,12 +1,22 @@
 import numpy as np
 import datetime
+import pickle
 import pandas as pd
+import pytest
 
 from krunning import (
     smooth_sliding_time_window,
+    rolling_statistic,
+    mean_maximal_power,
+    log_spaced_durations,
+    timer_spans,
+    resample_spans,
+    distance_grade,
+    QuantileSketch,
     percentile,
     relative_seconds_from_timestamps,
 )
+from krunning.math import sliding_window_start
 
 
 def test_smooth_sliding_time_window():
@@ -20,6 +30,255 @@ def test_smooth_sliding_time_window():
     assert np.allclose(output, expected_output)
 
 
+def _smooth_sliding_time_window_loop(time, series, window):
+    out = np.zeros_like(series)
+    start = 0
+    for i in range(time.shape[0]):
+        while time[i] - time[start] > window:
+            start += 1
+        out[i] = series[start : i + 1].mean()
+    return out
+
+
+def test_smooth_sliding_time_window_matches_loop():
+    prng = np.random.RandomState(42)
+    timestamps = np.cumsum(prng.choice([0.1, 0.2, 1, 1, 1, 2.5, 7], size=2000))
+    series = prng.normal(250, 40, size=[2000])
+    for window in [0, 0.3, 1, 5, 30.2, 1e6]:
+        expected = _smooth_sliding_time_window_loop(timestamps, series, window)
+        output = smooth_sliding_time_window(timestamps, series, window)
+        assert np.allclose(output, expected)
+
+
+def test_sliding_window_start_duplicate_timestamps():
+    prng = np.random.RandomState(7)
+    for _ in range(300):
+        steps = prng.choice([0, 0, 0.1, 0.3, 1, 1.7], size=200)
+        timestamps = 1589456192 + np.cumsum(steps)
+        series = prng.normal(250, 40, size=[200])
+        window = prng.choice([0, 0.1, 0.3, 1, 2.7, 5])
+        expected = _smooth_sliding_time_window_loop(timestamps, series, window)
+        output = smooth_sliding_time_window(timestamps, series, window)
+        assert np.allclose(output, expected)
+        start = sliding_window_start(timestamps, window)
+        assert np.all(timestamps - timestamps[start] <= window)
+        before = np.maximum(start - 1, 0)
+        assert np.all((start == 0) | (timestamps - timestamps[before] > window))
+
+
+def test_smooth_sliding_time_window_channels():
+    prng = np.random.RandomState(42)
+    timestamps = np.arange(500) * 1.0
+    channels = prng.normal(0, 1, size=[500, 4])
+    output = smooth_sliding_time_window(timestamps, channels, 10)
+    assert output.shape == (500, 4)
+    for c in range(4):
+        expected = smooth_sliding_time_window(timestamps, channels[:, c], 10)
+        assert np.allclose(output[:, c], expected)
+
+
+def test_smooth_sliding_time_window_keeps_dtype():
+    timestamps = np.arange(4)
+    output = smooth_sliding_time_window(timestamps, np.array([1, 2, 4, 8]), 1)
+    assert output.dtype == np.array([1]).dtype
+    assert output.tolist() == [1, 1, 3, 6]
+
+
+def _rolling_statistic_loop(time, series, window, reduce):
+    out = []
+    start = 0
+    for i in range(time.shape[0]):
+        while time[i] - time[start] > window:
+            start += 1
+        out.append(reduce(series[start : i + 1]))
+    return np.array(out)
+
+
+def test_rolling_statistic_matches_loop():
+    prng = np.random.RandomState(42)
+    timestamps = np.cumsum(prng.choice([0.1, 0.2, 1, 1, 1, 2.5, 7], size=1000))
+    series = prng.normal(250, 40, size=[1000])
+    statistics = [
+        (dict(statistic="mean"), np.mean),
+        (dict(statistic="max"), np.max),
+        (dict(statistic="min"), np.min),
+        (dict(statistic="std"), np.std),
+        (
+            dict(statistic="std", ddof=1),
+            lambda x: np.std(x, ddof=1) if len(x) > 1 else np.nan,
+        ),
+        (dict(statistic="median"), np.median),
+        (dict(statistic="quantile", q=0.9), lambda x: np.quantile(x, 0.9)),
+    ]
+    # Small windows are sorted as a batch, large ones incrementally
+    for window in [0, 3, 30, 400]:
+        for kwargs, reduce in statistics:
+            expected = _rolling_statistic_loop(timestamps, series, window, reduce)
+            output = rolling_statistic(timestamps, series, window, **kwargs)
+            assert np.allclose(output, expected, equal_nan=True), (window, kwargs)
+
+
+def test_rolling_std_drifting_series():
+    prng = np.random.RandomState(42)
+    timestamps = np.arange(500000) * 1.0
+    # Noise on a drift to 1e6, which cancels in sums of squares of the raw values
+    series = np.linspace(0, 1e6, 500000) + prng.normal(0, 5, size=[500000])
+    for window, ddof in [(9, 0), (300, 1)]:
+        output = rolling_statistic(timestamps, series, window, "std", ddof=ddof)
+        for i in prng.randint(window, 500000, size=200):
+            expected = np.std(series[i - window : i + 1], ddof=ddof)
+            assert abs(output[i] - expected) < 1e-8 * expected
+
+
+def test_rolling_statistic_channels():
+    prng = np.random.RandomState(42)
+    timestamps = np.arange(300) * 1.0
+    channels = prng.randint(0, 400, size=[300, 3])
+    for statistic in ["max", "std", "median"]:
+        output = rolling_statistic(timestamps, channels, 10, statistic)
+        assert output.shape == (300, 3)
+        for c in range(3):
+            expected = rolling_statistic(timestamps, channels[:, c], 10, statistic)
+            assert np.allclose(output[:, c], expected)
+    assert rolling_statistic(timestamps, channels, 10, "max").dtype == channels.dtype
+
+
+def test_rolling_statistic_errors():
+    with pytest.raises(ValueError):
+        rolling_statistic(np.arange(3), np.arange(3), 1, "mode")
+    with pytest.raises(ValueError):
+        rolling_statistic(np.arange(3), np.arange(3), 1, "quantile", q=2)
+    with pytest.raises(ValueError):
+        rolling_statistic(np.arange(3), np.arange(4), 1)
+
+
+def test_mean_maximal_power_exact():
+    prng = np.random.RandomState(42)
+    power = prng.normal(250, 40, size=[300])
+    curve = mean_maximal_power(power, exact=True)
+    assert curve.durations.tolist() == list(range(1, 301))
+    totals = np.concatenate([[0], np.cumsum(power)])
+    for duration, best, start in zip(*curve):
+        averages = (totals[duration:] - totals[:-duration]) / duration
+        assert best == np.max(averages)
+        assert start == np.argmax(averages)
+        assert np.isclose(best, power[start : start + duration].mean())
+
+
+def test_mean_maximal_power_durations():
+    power = np.array([100, 300, 200, 400, 0, 0])
+    curve = mean_maximal_power(power, durations=[1, 2, 4, 10])
+    assert curve.power[:3].tolist() == [400, 300, 250]
+    assert curve.start.tolist() == [3, 2, 0, -1]
+    assert np.isnan(curve.power[3])
+
+    curve = mean_maximal_power(np.ones(4000))
+    assert curve.durations.tolist() == log_spaced_durations(4000).tolist()
+    assert curve.durations[0] == 1 and curve.durations[-1] == 4000
+    assert np.all(np.diff(curve.durations) > 0)
+    assert np.allclose(curve.power, 1)
+
+    with pytest.raises(ValueError):
+        mean_maximal_power(power, durations=[0, 1])
+
+
+def test_timer_spans():
+    assert timer_spans([], []) == [(-np.inf, np.inf)]
+    assert timer_spans(
+        [0, 360, 600, 620, 1000, 1040],
+        ["start", "marker", "stop_all", "start", "stop_all", "start"],
+    ) == [(0, 600), (620, 1000), (1040, np.inf)]
+    # The timer was already running, and repeated events change nothing
+    assert timer_spans([10, 20, 30, 40], ["stop", "stop", "start", "start"]) == [
+        (-np.inf, 10),
+        (30, np.inf),
+    ]
+    # Events other than starts and stops don't tell whether the timer was running
+    assert timer_spans([0, 5, 600], ["marker", "start", "stop_all"]) == [(5, 600)]
+    assert timer_spans([0, 5, 600], ["marker", "stop", "start"]) == [
+        (-np.inf, 5),
+        (600, np.inf),
+    ]
+    assert timer_spans([0], ["marker"]) == [(-np.inf, np.inf)]
+
+
+def test_resample_spans():
+    time = np.array([0, 1.5, 3, 10, 11, 12, 30, 31.5])
+    series = np.array([100, 130, 160, 500, 200, 220, 240, 270])
+    spans = resample_spans(time, series, [(0, 3), (11, np.inf)])
+    # Nothing is interpolated across the pause
+    assert [span.time.tolist() for span in spans] == [
+        [0, 1, 2, 3],
+        [
+            11,
+            12,
+            13,
+            14,
+            15,
+            16,
+            17,
+            18,
+            19,
+            20,
+            21,
+            22,
+            23,
+            24,
+            25,
+            26,
+            27,
+            28,
+            29,
+            30,
+            31,
+        ],
+    ]
+    assert spans[0].series.tolist() == [100, 120, 140, 160]
+    assert spans[1].series[:2].tolist() == [200, 220]
+    assert spans[1].series[-1] == 260
+
+    spans = resample_spans(time, series, [(0, 3), (11, np.inf)], max_gap=5)
+    assert [span.time.tolist() for span in spans] == [
+        [0, 1, 2, 3],
+        [11, 12],
+        [30, 31],
+    ]
+
+    spans = resample_spans(time, np.stack([series, -series], axis=1), period=2)
+    assert len(spans) == 1
+    assert spans[0].time.tolist() == list(range(0, 31, 2))
+    assert spans[0].series.shape == (16, 2)
+    assert np.array_equal(spans[0].series[:, 0], -spans[0].series[:, 1])
+    assert np.allclose(spans[0].series[:, 0], np.interp(spans[0].time, time, series))
+
+
+def test_distance_grade():
+    prng = np.random.RandomState(42)
+    distance = np.cumsum(prng.uniform(2, 4, size=[1000]))
+    # 5% uphill, then 3% downhill, with noisy altitude
+    altitude = np.where(distance < 1500, 0.05 * distance, 75 - 0.03 * (distance - 1500))
+    noisy = altitude + prng.normal(0, 0.3, size=[1000])
+    grade = distance_grade(distance, noisy, 50)
+    uphill = (distance > 200) & (distance < 1400)
+    downhill = distance > 1700
+    assert np.abs(grade[uphill] - 0.05).max() < 0.02
+    assert np.abs(grade[downhill] + 0.03).max() < 0.02
+    assert np.std(grade[uphill]) < np.std(np.diff(noisy) / np.diff(distance))
+
+    # Barometric spikes are ignored
+    spiky = altitude.copy()
+    spiky[[300, 301, 600]] += 30
+    grade = distance_grade(distance, spiky, 50, max_altitude_deviation=5)
+    assert np.abs(grade[uphill] - 0.05).max() < 0.01
+    assert np.abs(distance_grade(distance, spiky, 50)[uphill] - 0.05).max() > 0.05
+
+    # Missing samples, and windows not covering any distance
+    distance[10] = np.nan
+    grade = distance_grade(distance, altitude, 1)
+    assert np.isnan(grade[0]) and np.isnan(grade[10])
+    assert np.allclose(grade[100:200], 0.05)
+
+
 def test_percentile():
     N = 1000
     prng = np.random.RandomState(42)
@@ -30,6 +289,61 @@ def test_percentile():
     assert percentile(data, 2) == (np.percentile(data, 2), np.percentile(data, 98))
 
 
+def test_percentile_sketch():
+    prng = np.random.RandomState(42)
+    data = prng.normal(0, 1, size=[100000])
+    low, high = percentile(QuantileSketch().update(data), 5)
+    assert abs(np.mean(data < low) - 0.05) < 0.01
+    assert abs(np.mean(data < high) - 0.95) < 0.01
+
+
+def test_quantile_sketch():
+    prng = np.random.RandomState(42)
+    parts = [prng.normal(i, 1 + i, size=[prng.randint(0, 20000)]) for i in range(10)]
+    data = np.concatenate(parts)
+    sketch = QuantileSketch()
+    for part in parts:
+        sketch.merge(pickle.loads(pickle.dumps(QuantileSketch().update(part))))
+    assert len(sketch) == len(data)
+    assert sum(len(level) for level in sketch.levels) < 3 * sketch.k
+    q = np.linspace(0, 1, 21)
+    estimates = sketch.quantile(q)
+    ranks = np.searchsorted(np.sort(data), estimates) / len(data)
+    assert np.abs(ranks - q).max() < 0.02
+    assert sketch.quantile(0) == data.min()
+    assert sketch.percentile(100) == data.max()
+
+    assert np.isnan(QuantileSketch().quantile(0.5))
+    assert QuantileSketch().update([3, np.nan, 1, 2]).quantile(0.5) == 2
+    with pytest.raises(ValueError):
+        sketch.quantile(1.5)
+
+
+def _max_rank_error(sketch, data):
+    """Largest distance between quantiles and the ranks of the sketch's estimates."""
+    q = np.linspace(0.001, 0.999, 999)
+    estimates = sketch.quantile(q)
+    data = np.sort(data)
+    low = np.searchsorted(data, estimates, side="left") / len(data)
+    high = np.searchsorted(data, estimates, side="right") / len(data)
+    return np.max(np.maximum(low - q, q - high))
+
+
+def test_quantile_sketch_rank_error():
+    prng = np.random.RandomState(42)
+    for k in [100, 200]:
+        data = prng.normal(size=[200000]) * prng.choice([1, 5], size=[200000])
+        updated = QuantileSketch(k)
+        for chunk in np.array_split(data, 400):
+            updated.update(chunk)
+        merged = QuantileSketch(k)
+        for part in np.array_split(data, 50):
+            merged.merge(QuantileSketch(k).update(part))
+        for sketch in [updated, merged]:
+            assert _max_rank_error(sketch, data) < 4 / k
+            assert k <= sum(len(level) for level in sketch.levels) <= 2 * k
+
+
 def test_relative_seconds_from_timestamps():
     start = datetime.datetime(2020, 1, 1)
     second = datetime.timedelta(seconds=1)
@@ -9,10 +9,10 @@ from krunning.db import conn_dict_from_env
 from krunning.db.database import Database, PGConnectionPool, ActivityAlreadyExistsError
 
 
-def process_fitfile(db: Database, fitfile_path: str, replace: bool):
+def process_fitfile(db: Database, fitfile_path: str, replace: bool, bulk: bool = True):
     fitfile_name = os.path.basename(fitfile_path)
     try:
-        with db.activity_builder(fitfile_name, replace) as activity_builder:
+        with db.activity_builder(fitfile_name, replace, bulk=bulk) as activity_builder:
             logging.info("Processing %s", fitfile_name)
             with fitparse.FitFile(fitfile_path) as fitfile:
                 N = len(fitfile.messages)
@@ -117,19 +117,18 @@ class PGConnectionPoolFactory:
         return PGConnectionPool(self.conn_dict, self.n_connection)
 
 
-_subprocess_factory: PGConnectionPoolFactory = None
+# Database of the worker process, whose connection and field ids are kept across files
+_subprocess_db: Database = None
 
 
 def initialize_subprocess(factory: PGConnectionPoolFactory):
-    global _subprocess_factory
-    _subprocess_factory = factory
+    global _subprocess_db
+    _subprocess_db = Database(factory.make_connection_pool())
 
 
 def do_process_file(args):
-    filepath, replace = args
-    conn_pool = _subprocess_factory.make_connection_pool()
-    db = Database(conn_pool)
-    process_fitfile(db, filepath, replace)
+    filepath, replace, bulk = args
+    process_fitfile(_subprocess_db, filepath, replace, bulk)
 
 
 def main():
@@ -145,6 +144,13 @@ def main():
         action="store_true",
         help="Replace activities in DB which we have fit files for.",
     )
+    parser.add_argument(
+        "--no-bulk",
+        dest="bulk",
+        action="store_false",
+        help="Write samples one statement at a time rather than with COPY at the end "
+        "of each activity.",
+    )
     parser.add_argument(
         "--directory", default="data", help="Directory to search for fit files."
     )
@@ -163,7 +169,7 @@ def main():
     ) as pool:
         pool.map(
             do_process_file,
-            [(filename, args.replace) for filename in files],
+            [(filename, args.replace, args.bulk) for filename in files],
             chunksize=1,
         )
 